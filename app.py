@@ -3,17 +3,22 @@ from flask import Flask, render_template, request, jsonify, session, redirect, u
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-import pandas as pd
+import numpy as np
 import logging
 import json
 import os
 import uuid
-from datetime import datetime
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
 import sys
 
 # 先检查是否存在增强推荐系统文件
 try:
-    from enhanced_recommendation import EnhancedRecommendationSystem, BGGImageService
+    from enhanced_recommendation import (EnhancedRecommendationSystem, BGGImageService, ImagePrefetcher,
+                                         CLASSIC_GAME_IDS, CONTENT_CANDIDATES, DEFAULT_SNAPSHOT_DIR,
+                                         MAX_RECOMMENDATIONS, descending_order, find_data_file, process_memory)
 
     HAS_ENHANCED_SYSTEM = True
 except ImportError as e:
@@ -99,15 +104,171 @@ class SavedRecommendation(db.Model):
         }
 
 
+class RecommendationSessionState(db.Model):
+    """服务端保存的“上次推荐”状态，按不透明的会话ID索引"""
+    __tablename__ = 'recommendation_session_states'
+
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+# ===== 推荐会话存储 =====
+# 上次推荐结果（主推荐、高分精选、新品、更多匹配和偏好）保存在服务端，
+# cookie 中只保存一个不透明的会话ID，避免每次请求上传和校验数KB的签名cookie。
+
+# 推荐会话的有效期（秒），与“上次推荐超过1小时即过期”的规则一致
+RECOMMENDATION_SESSION_TTL = 3600
+
+
+class MemorySessionStore:
+    """进程内 LRU 会话存储，适用于单进程部署"""
+
+    def __init__(self, max_size=10000, ttl=RECOMMENDATION_SESSION_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            stored_at, data = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[session_id]
+                return None
+            self._entries.move_to_end(session_id)
+            return data
+
+    def set(self, session_id, data):
+        with self._lock:
+            self._entries[session_id] = (time.monotonic(), data)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class SQLiteSessionStore:
+    """基于数据库表的会话存储，多个 gunicorn worker 之间共享"""
+
+    # 每写入多少次清理一次过期记录
+    PURGE_INTERVAL = 100
+
+    def __init__(self, ttl=RECOMMENDATION_SESSION_TTL):
+        self.ttl = ttl
+        self._writes = 0
+
+    def get(self, session_id):
+        state = db.session.get(RecommendationSessionState, session_id)
+        if state is None:
+            return None
+        if datetime.utcnow() - state.updated_at > timedelta(seconds=self.ttl):
+            return None
+        return json.loads(state.data)
+
+    def set(self, session_id, data):
+        try:
+            db.session.merge(RecommendationSessionState(
+                id=session_id, data=json.dumps(data, ensure_ascii=False), updated_at=datetime.utcnow()
+            ))
+            self._writes += 1
+            if self._writes % self.PURGE_INTERVAL == 0:
+                cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+                RecommendationSessionState.query.filter(RecommendationSessionState.updated_at < cutoff).delete()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def create_session_store():
+    """按环境变量 RECOMMENDATION_SESSION_STORE 选择会话存储：sqlite（默认）或 memory"""
+    backend = os.environ.get('RECOMMENDATION_SESSION_STORE', 'sqlite').lower()
+    if backend == 'memory':
+        return MemorySessionStore(max_size=int(os.environ.get('RECOMMENDATION_SESSION_MAX', 10000)))
+    return SQLiteSessionStore()
+
+
+recommendation_sessions = create_session_store()
+
+
+def save_last_recommendations(data):
+    """保存当前用户的上次推荐结果，cookie 中只记录会话ID"""
+    session_id = session.get('recommendation_session_id')
+    if not session_id:
+        session_id = uuid.uuid4().hex
+        session['recommendation_session_id'] = session_id
+    # 清除旧版本保存在 cookie 中的完整推荐结果
+    session.pop('last_recommendations', None)
+    recommendation_sessions.set(session_id, data)
+
+
+def prefetch_images(games):
+    """把一组游戏的图片放入后台预取队列"""
+    if image_prefetcher is None:
+        return
+    try:
+        image_prefetcher.enqueue([game['id'] for game in games if 'id' in game])
+    except Exception as e:
+        logger.warning(f"图片预取入队失败: {e}")
+
+
+def load_last_recommendations():
+    """读取当前用户的上次推荐结果，不存在或已过期时返回 None"""
+    session_id = session.get('recommendation_session_id')
+    if not session_id:
+        return None
+    return recommendation_sessions.get(session_id)
+
+
 # 全局变量
 recommender = None
 image_service = None
+image_prefetcher = None
 data_loaded = False
 
+# “更多匹配”接在主推荐的12个之后分页，两者之和不超过 MAX_RECOMMENDATIONS（协同过滤近邻数按它确定）
+MAIN_RECOMMENDATIONS = 12
+MAX_MORE_GAMES = MAX_RECOMMENDATIONS - MAIN_RECOMMENDATIONS
+
+# 批量推荐接口单次允许的最大偏好数量和每组偏好的最大推荐数（不超过 MAX_RECOMMENDATIONS）
+MAX_BATCH_PREFERENCES = 5000
+MAX_BATCH_N = 50
+
+
+def _parse_batch_n(value):
+    """解析批量接口的 N：必须是 1..MAX_BATCH_N 的整数（允许整数字符串），否则返回 None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str) and value.strip().lstrip('-').isdigit():
+        value = int(value)
+    if not isinstance(value, int) or not 1 <= value <= MAX_BATCH_N:
+        return None
+    return value
+
+
+def _preference_payload_error(preferences):
+    """检查单组偏好的结构，合法时返回 None，否则返回错误说明"""
+    if not isinstance(preferences, dict):
+        return '偏好必须是对象'
+    for key in ('selectedGames', 'selectedMechanics', 'selectedDomains'):
+        values = preferences.get(key, [])
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            return f'{key} 必须是字符串列表'
+    settings = preferences.get('gameSettings', {})
+    if not isinstance(settings, dict):
+        return 'gameSettings 必须是对象'
+    for key, value in settings.items():
+        if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+            return f'gameSettings.{key} 必须是字符串或数字'
+    return None
+
 
 def load_data():
     """加载推荐系统数据"""
-    global recommender, image_service, data_loaded
+    global recommender, image_service, image_prefetcher, data_loaded
 
     if not HAS_ENHANCED_SYSTEM:
         logger.warning("增强推荐系统不可用，跳过数据加载")
@@ -116,22 +277,28 @@ def load_data():
 
     try:
         logger.info("开始加载推荐系统...")
-        recommender = EnhancedRecommendationSystem()
-        image_service = BGGImageService()
-
-        # 查找数据文件 - 多个可能的路径
-        possible_paths = [
-            'data/BGG_Data.csv',
-            'BGG_Data.csv',
-            '../data/BGG_Data.csv',
-            './data/BGG_Data.csv'
-        ]
-
-        data_path = None
-        for path in possible_paths:
-            if os.path.exists(path):
-                data_path = path
-                break
+        cf_factor_rank = int(os.environ['CF_FACTOR_RANK']) if os.environ.get('CF_FACTOR_RANK') else None
+        recommender = EnhancedRecommendationSystem(
+            cache_size=int(os.environ.get('RECOMMENDATION_CACHE_SIZE', 1024)),
+            cache_ttl=float(os.environ.get('RECOMMENDATION_CACHE_TTL', 3600)),
+            # 内容打分的近似候选检索（如 ivf），未设置时对全部游戏精确打分
+            content_index=os.environ.get('CONTENT_INDEX') or None,
+            content_candidates=int(os.environ.get('CONTENT_CANDIDATES', CONTENT_CANDIDATES)),
+            # 协同过滤隐因子的秩，未设置时按用户维度计算精确的物品相似度
+            cf_factor_rank=cf_factor_rank
+        )
+        # 图片URL缓存持久化在 instance 目录下，各 worker 共享，重启后无需重新请求 BGG
+        os.makedirs(app.instance_path, exist_ok=True)
+        image_service = BGGImageService(
+            cache_path=os.environ.get('BGG_IMAGE_CACHE_PATH', os.path.join(app.instance_path, 'bgg_image_cache.db')),
+            cache_max_size=int(os.environ.get('BGG_IMAGE_CACHE_SIZE', 50000)),
+            negative_ttl=float(os.environ.get('BGG_IMAGE_NEGATIVE_TTL', 600))
+        )
+        # 后台预取推荐结果中的图片，请求线程不等待 BGG
+        image_prefetcher = ImagePrefetcher(image_service)
+
+        # 查找数据文件 - 多个可能的路径（见 enhanced_recommendation.DATA_PATHS）
+        data_path = find_data_file()
 
         if not data_path:
             logger.error("未找到BGG数据文件，请确保BGG_Data.csv存在")
@@ -146,11 +313,12 @@ def load_data():
             './data/user_ratings.csv'
         ]
 
-        user_ratings_path = None
-        for path in user_ratings_paths:
-            if os.path.exists(path):
-                user_ratings_path = path
-                break
+        user_ratings_path = find_data_file(user_ratings_paths)
+        # 列式缓存（见 enhanced_recommendation.py ratings-cache）：有CSV时只作为CSV的缓存，
+        # 与CSV校验和不一致时重新解析CSV并更新缓存；没有CSV时才直接读取缓存
+        ratings_cache_path = 'data/user_ratings.npz'
+        if user_ratings_path is None and os.path.exists(ratings_cache_path):
+            user_ratings_path, ratings_cache_path = ratings_cache_path, None
 
         if user_ratings_path:
             logger.info(f"找到用户评分数据文件: {user_ratings_path}")
@@ -158,7 +326,15 @@ def load_data():
             logger.warning("未找到用户评分数据文件，将仅使用内容过滤推荐")
 
         logger.info(f"使用数据文件: {data_path}")
-        recommender.load_and_preprocess_data(data_path, user_ratings_path)
+
+        # 优先使用与源数据校验和一致的模型快照，跳过CSV解析
+        snapshot_dir = os.environ.get('RECOMMENDER_SNAPSHOT_DIR', DEFAULT_SNAPSHOT_DIR)
+        if EnhancedRecommendationSystem.snapshot_is_valid(snapshot_dir, data_path, user_ratings_path, cf_factor_rank):
+            logger.info(f"使用模型快照: {snapshot_dir}")
+            recommender.load_snapshot(snapshot_dir)
+        else:
+            logger.info("未找到可用的模型快照，从CSV加载数据")
+            recommender.load_and_preprocess_data(data_path, user_ratings_path, ratings_cache_path)
         data_loaded = True
         logger.info("推荐系统加载完成")
         return True
@@ -355,6 +531,40 @@ def saved_recommendations():
         return f"模板文件错误: {e}<br>请确保templates/saved.html文件存在且格式正确"
 
 
+def _catalog_value(catalog, column, row, default, cast=int):
+    """读取游戏目录中的单个数值，缺失时返回默认值"""
+    value = catalog.column(column)[row]
+    return default if np.isnan(value) else cast(value)
+
+
+def _classic_game_data(catalog, row):
+    """经典游戏选择卡片所需的字段"""
+    min_players = _catalog_value(catalog, 'Min Players', row, 1)
+    max_players = _catalog_value(catalog, 'Max Players', row, 4)
+    return {
+        'id': int(catalog.ids[row]),
+        'name': catalog.name(row),
+        'rating': float(catalog.column('Rating Average')[row]),
+        'users_rated': int(catalog.column('Users Rated')[row]),
+        'min_players': min_players,
+        'max_players': max_players,
+        'players_text': f"{min_players}-{max_players}人"
+    }
+
+
+def _catalog_game_data(catalog, row):
+    """“更多游戏”列表中每个游戏的公共字段"""
+    return {
+        'id': int(catalog.ids[row]),
+        'name': catalog.name(row),
+        'rating': float(catalog.column('Rating Average')[row]),
+        'year': _catalog_value(catalog, 'Year Published', row, 0),
+        'users_rated': int(catalog.column('Users Rated')[row]),
+        'min_players': _catalog_value(catalog, 'Min Players', row, 1),
+        'max_players': _catalog_value(catalog, 'Max Players', row, 4)
+    }
+
+
 @app.route('/api/classic-games')
 def get_classic_games():
     """获取经典游戏列表API - 精选各机制类型的代表作"""
@@ -362,83 +572,39 @@ def get_classic_games():
         return jsonify({'error': '系统未初始化', 'games': []}), 500
 
     try:
-        # 定义各类游戏的代表作ID（确保多样性）
-        classic_game_ids = [
-            174430,  # Gloomhaven - 角色扮演/战役
-            167791,  # Terraforming Mars - 引擎构建
-            161936,  # Pandemic Legacy: Season 1 - 合作/传承
-            169786,  # Scythe - 区域控制
-            120677,  # Terra Mystica - 策略建设
-            31260,  # Agricola - 工人放置
-            68448,  # Carcassonne - 板块拼放
-            178900,  # Codenames - 聚会/词汇
-            6249,  # 7 Wonders - 卡牌轮抽
-            521,  # Ticket to Ride - 家庭/路线建设
-            13,  # Settlers of Catan - 贸易/谈判
-            36218,  # Dominion - 卡组构建
-            224517,  # Azul - 抽象/图案
-            266192,  # Wingspan - 引擎构建/自然主题
-            170216,  # Splendor - 引擎构建/宝石
-            220308,  # Brass: Birmingham - 经济策略
-            295947,  # Dune: Imperium - 工人放置/卡组构建
-            316554,  # Everdell - 工人放置/手牌管理
-            295770,  # Root - 不对称游戏
-            30549,  # Pandemic - 合作游戏
-            148228,  # Love Letter - 推理/快速
-            39856,  # Dixit - 创意/聚会
-            230802,  # Kingdomino - 家庭/板块
-            182028,  # Through the Ages - 文明建设
-        ]
-
         games_list = []
 
-        # 先尝试获取预定义的经典游戏
-        if recommender and recommender.df is not None:
-            for game_id in classic_game_ids:
-                try:
-                    game = recommender.df.loc[game_id]
-                    if pd.notna(game['Name']):
-                        game_data = {
-                            'id': int(game_id),
-                            'name': str(game['Name']),
-                            'rating': float(game.get('Rating Average', 0)),
-                            'users_rated': int(game.get('Users Rated', 0)),
-                            'min_players': int(game.get('Min Players', 1)) if pd.notna(game.get('Min Players')) else 1,
-                            'max_players': int(game.get('Max Players', 4)) if pd.notna(game.get('Max Players')) else 4,
-                            'players_text': f"{int(game.get('Min Players', 1)) if pd.notna(game.get('Min Players')) else 1}-{int(game.get('Max Players', 4)) if pd.notna(game.get('Max Players')) else 4}人"
-                        }
-                        games_list.append(game_data)
-                except:
+        # 先尝试获取预定义的经典游戏（各类游戏的代表作，确保多样性）
+        catalog = recommender.catalog if recommender else None
+        if catalog is not None:
+            for game_id in CLASSIC_GAME_IDS:
+                row = catalog.row_of(game_id)
+                # 缺少评分人数的游戏无法展示，跳过
+                if row < 0 or np.isnan(catalog.column('Users Rated')[row]):
                     continue
+                games_list.append(_classic_game_data(catalog, row))
 
         # 如果预定义游戏不足24个，补充高评分游戏
-        if len(games_list) < 24 and recommender and recommender.df is not None:
+        if len(games_list) < 24 and catalog is not None:
             existing_ids = [g['id'] for g in games_list]
-            additional_games = recommender.df[
-                (~recommender.df.index.isin(existing_ids)) &
-                (recommender.df['Rating Average'] >= 7.5) &
-                (recommender.df['Users Rated'] >= 1000)
-                ].sort_values(['Rating Average', 'Users Rated'], ascending=[False, False])
-
-            for idx, game in additional_games.iterrows():
-                if len(games_list) >= 24:
-                    break
-
-                game_data = {
-                    'id': int(idx),
-                    'name': str(game['Name']),
-                    'rating': float(game.get('Rating Average', 0)),
-                    'users_rated': int(game.get('Users Rated', 0)),
-                    'min_players': int(game.get('Min Players', 1)) if pd.notna(game.get('Min Players')) else 1,
-                    'max_players': int(game.get('Max Players', 4)) if pd.notna(game.get('Max Players')) else 4,
-                    'players_text': f"{int(game.get('Min Players', 1)) if pd.notna(game.get('Min Players')) else 1}-{int(game.get('Max Players', 4)) if pd.notna(game.get('Max Players')) else 4}人"
-                }
-                games_list.append(game_data)
+            ratings = catalog.column('Rating Average')
+            users_rated = catalog.column('Users Rated')
+            additional_rows = np.flatnonzero(
+                ~np.isin(catalog.ids, existing_ids) & (ratings >= 7.5) & (users_rated >= 1000)
+            )
+            additional_rows = additional_rows[
+                descending_order(ratings[additional_rows], users_rated[additional_rows])
+            ]
+
+            for row in additional_rows[:24 - len(games_list)].tolist():
+                games_list.append(_classic_game_data(catalog, row))
 
         # 按评分排序
         games_list.sort(key=lambda x: x['rating'], reverse=True)
 
-        return jsonify({'games': games_list[:24]})
+        games_list = games_list[:24]
+        prefetch_images(games_list)
+        return jsonify({'games': games_list})
 
     except Exception as e:
         logger.error(f"获取经典游戏时出错: {e}")
@@ -487,8 +653,11 @@ def generate_recommendations():
         if not preferences:
             return jsonify({'error': '无效的偏好数据'}), 400
 
+        # 只打分一次，主推荐和更多匹配都从同一排序结果中切片（相同偏好直接复用缓存）
+        ranked = recommender.rank_recommendations(preferences) if recommender else None
+
         # 生成主推荐
-        main_recommendations = recommender.get_enhanced_recommendations(preferences, N=12) if recommender else []
+        main_recommendations = ranked.top(MAIN_RECOMMENDATIONS) if ranked else []
 
         # 获取高评分游戏
         top_rated = recommender.get_top_rated_games(N=4) if recommender else []
@@ -497,17 +666,20 @@ def generate_recommendations():
         newest_games = recommender.get_newest_games(N=4) if recommender else []
 
         # 获取更多匹配游戏
-        more_matches = recommender.get_enhanced_recommendations(preferences, N=20)[12:16] if recommender else []
+        more_matches = ranked.top(20)[12:16] if ranked else []
+
+        # 后台预取所有展示卡片的图片
+        prefetch_images(main_recommendations + top_rated + newest_games + more_matches)
 
-        # 存储到session中
-        session['last_recommendations'] = {
+        # 存储到服务端会话中
+        save_last_recommendations({
             'main': main_recommendations,
             'top_rated': top_rated,
             'newest': newest_games,
             'more_matches': more_matches,
             'preferences': preferences,
             'timestamp': datetime.now().isoformat()
-        }
+        })
 
         response_data = {
             'main_recommendations': main_recommendations,
@@ -544,6 +716,60 @@ def generate_recommendations():
         return jsonify(sample_data)
 
 
+@app.route('/api/recommendations/batch', methods=['POST'])
+def generate_recommendations_batch():
+    """批量生成推荐API - 一次请求为多组偏好生成推荐（用于离线任务）"""
+    if not data_loaded:
+        return jsonify({'error': '系统未初始化'}), 500
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': '请求体必须是JSON对象'}), 400
+
+    N = _parse_batch_n(data.get('N', 12))
+    if N is None:
+        return jsonify({'error': f'N 必须是 1 到 {MAX_BATCH_N} 之间的整数'}), 400
+
+    preferences_list = data.get('preferences', [])
+    if not isinstance(preferences_list, list) or not preferences_list:
+        return jsonify({'error': '无效的偏好数据'}), 400
+
+    # 限制单次批量请求的偏好数量
+    if len(preferences_list) > MAX_BATCH_PREFERENCES:
+        return jsonify({'error': f'单次最多 {MAX_BATCH_PREFERENCES} 组偏好'}), 400
+
+    for i, preferences in enumerate(preferences_list):
+        error = _preference_payload_error(preferences)
+        if error:
+            return jsonify({'error': f'第 {i} 组偏好无效: {error}'}), 400
+
+    try:
+        results = recommender.get_enhanced_recommendations_batch(preferences_list, N=N)
+
+        logger.info(f"成功批量生成推荐结果: {len(results)} 组偏好")
+        return jsonify({
+            'results': results,
+            'count': len(results),
+            'status': 'success'
+        })
+
+    except Exception as e:
+        logger.error(f"批量生成推荐时出错: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/games/search')
+def search_games():
+    """游戏名称搜索API - 用于向导中的自动补全"""
+    if not data_loaded or not recommender:
+        return jsonify({'games': [], 'count': 0})
+
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))  # 最多返回50个
+    games = recommender.search_games(query, limit)
+    return jsonify({'games': games, 'query': query, 'count': len(games)})
+
+
 @app.route('/api/game-image/<int:game_id>')
 def get_game_image(game_id):
     """获取单个游戏图片URL API"""
@@ -551,7 +777,11 @@ def get_game_image(game_id):
         return jsonify({'image_url': None}), 404
 
     try:
-        image_url = image_service.get_game_image_url(game_id)
+        # 只读缓存；未缓存的图片交给后台预取，返回 pending 由前端稍后重试
+        found, image_url = image_service.image_cache.lookup(game_id)
+        if not found:
+            image_prefetcher.enqueue([game_id])
+            return jsonify({'image_url': None, 'game_id': game_id, 'status': 'pending'}), 202
         if image_url:
             return jsonify({'image_url': image_url, 'game_id': game_id})
         else:
@@ -578,12 +808,17 @@ def get_multiple_game_images():
         # 限制批量请求数量
         game_ids = game_ids[:20]  # 最多20个
 
-        images = image_service.get_multiple_image_urls(game_ids)
+        # 只返回已缓存的图片，其余放入后台预取队列
+        known = image_service.image_cache.get_many(game_ids)
+        images = {game_id: known[game_id] for game_id in game_ids if known.get(game_id)}
+        pending = [game_id for game_id in dict.fromkeys(game_ids) if game_id not in known]
+        image_prefetcher.enqueue(pending)
 
         return jsonify({
             'images': images,
             'count': len(images),
-            'requested': len(game_ids)
+            'requested': len(game_ids),
+            'pending': pending
         })
 
     except Exception as e:
@@ -595,13 +830,12 @@ def get_multiple_game_images():
 def get_last_recommendations():
     """获取上次的推荐结果"""
     try:
-        last_recommendations = session.get('last_recommendations')
+        last_recommendations = load_last_recommendations()
 
         if not last_recommendations:
             return jsonify({'error': '没有找到推荐数据'}), 404
 
         # 检查推荐数据是否过期（比如超过1小时）
-        from datetime import datetime, timedelta
         timestamp_str = last_recommendations.get('timestamp')
         if timestamp_str:
             timestamp = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
@@ -631,65 +865,53 @@ def get_more_games():
         return jsonify({'error': '系统未初始化', 'games': []}), 500
 
     game_type = request.args.get('type', 'rating')
-    limit = min(int(request.args.get('limit', 20)), 50)  # 最多返回50个
+    limit = min(int(request.args.get('limit', 20)), MAX_MORE_GAMES)  # 最多返回50个
 
     try:
         games_list = []
 
         if game_type == 'rating':
             # 获取更多高评分游戏
-            if recommender and recommender.df is not None:
-                high_rated = recommender.df[
-                    (recommender.df['Rating Average'] >= 7.0) &
-                    (recommender.df['Users Rated'] >= 1000)
-                    ].sort_values(['Rating Average', 'Users Rated'], ascending=[False, False])
-
-            for idx, game in high_rated.head(limit).iterrows():
-                games_list.append({
-                    'id': int(idx),
-                    'name': str(game['Name']),
-                    'rating': float(game.get('Rating Average', 0)),
-                    'year': int(game.get('Year Published', 0)) if pd.notna(game.get('Year Published')) else 0,
-                    'users_rated': int(game.get('Users Rated', 0)),
-                    'min_players': int(game.get('Min Players', 1)) if pd.notna(game.get('Min Players')) else 1,
-                    'max_players': int(game.get('Max Players', 4)) if pd.notna(game.get('Max Players')) else 4,
-                    'complexity': float(game.get('Complexity', 0)) if pd.notna(
-                        game.get('Complexity')) else 0
-                })
+            if recommender and recommender.catalog is not None:
+                catalog = recommender.catalog
+                ratings = catalog.column('Rating Average')
+                users_rated = catalog.column('Users Rated')
+                high_rated = np.flatnonzero((ratings >= 7.0) & (users_rated >= 1000))
+                high_rated = high_rated[descending_order(ratings[high_rated], users_rated[high_rated])]
+
+            for row in high_rated[:limit].tolist():
+                game_data = _catalog_game_data(catalog, row)
+                game_data['complexity'] = _catalog_value(catalog, 'Complexity', row, 0, float)
+                games_list.append(game_data)
 
         elif game_type == 'newest':
             # 获取更多新游戏
-            if recommender and recommender.df is not None:
+            if recommender and recommender.catalog is not None:
+                catalog = recommender.catalog
                 current_year = 2025
-                newest = recommender.df[
-                    (recommender.df['Year Published'] >= current_year - 5) &
-                    (recommender.df['Users Rated'] >= 100)
-                    ].sort_values(['Year Published', 'Rating Average'], ascending=[False, False])
-
-            for idx, game in newest.head(limit).iterrows():
-                games_list.append({
-                    'id': int(idx),
-                    'name': str(game['Name']),
-                    'rating': float(game.get('Rating Average', 0)),
-                    'year': int(game.get('Year Published', 0)) if pd.notna(game.get('Year Published')) else 0,
-                    'users_rated': int(game.get('Users Rated', 0)),
-                    'min_players': int(game.get('Min Players', 1)) if pd.notna(game.get('Min Players')) else 1,
-                    'max_players': int(game.get('Max Players', 4)) if pd.notna(game.get('Max Players')) else 4,
-                    'play_time': int(game.get('Play Time', 0)) if pd.notna(game.get('Play Time')) else 0
-                })
+                years = catalog.column('Year Published')
+                ratings = catalog.column('Rating Average')
+                newest = np.flatnonzero((years >= current_year - 5) & (catalog.column('Users Rated') >= 100))
+                newest = newest[descending_order(years[newest], ratings[newest])]
+
+            for row in newest[:limit].tolist():
+                game_data = _catalog_game_data(catalog, row)
+                game_data['play_time'] = _catalog_value(catalog, 'Play Time', row, 0)
+                games_list.append(game_data)
 
         elif game_type == 'matches':
             # 获取更多匹配游戏（从会话中获取）
-            last_recommendations = session.get('last_recommendations', {})
+            last_recommendations = load_last_recommendations() or {}
 
             if last_recommendations and 'preferences' in last_recommendations:
-                # 生成更多推荐
+                # 生成更多推荐（复用生成主推荐时缓存的排序结果）
                 if recommender:
                     preferences = last_recommendations['preferences']
-                    more_recommendations = recommender.get_enhanced_recommendations(preferences, N=limit + 12)
+                    ranked = recommender.rank_recommendations(preferences)
+                    # 跳过前12个（已经在主推荐中显示）
+                    more_recommendations = ranked.page(MAIN_RECOMMENDATIONS, limit)
 
-                # 跳过前12个（已经在主推荐中显示）
-                for rec in more_recommendations[12:]:
+                for rec in more_recommendations:
                     games_list.append(rec)
             else:
                 # 如果没有会话数据，返回高评分游戏作为替代
@@ -850,6 +1072,11 @@ def health_check():
         'status': 'healthy' if data_loaded else 'initializing',
         'data_loaded': data_loaded,
         'enhanced_system': HAS_ENHANCED_SYSTEM,
+        'pid': os.getpid(),
+        'memory': process_memory() if HAS_ENHANCED_SYSTEM else {},
+        'recommendation_cache': recommender.result_cache.stats() if recommender else {},
+        'image_cache': image_service.image_cache.stats() if image_service else {},
+        'image_prefetch': image_prefetcher.stats() if image_prefetcher else {},
         'timestamp': datetime.now().isoformat()
     })
 
@@ -0,0 +1,828 @@
+# benchmark.py - 推荐系统性能测量脚本
+#
+# 用法:
+#   python benchmark.py workers --master-pid <gunicorn主进程PID>
+#   python benchmark.py scoring [--snapshot data/snapshot | --data data/BGG_Data.csv]
+#   python benchmark.py classic [--snapshot data/snapshot | --data data/BGG_Data.csv]
+#   python benchmark.py weighted [--snapshot data/snapshot | --data data/BGG_Data.csv]
+#   python benchmark.py search [--snapshot data/snapshot | --data data/BGG_Data.csv]
+#   python benchmark.py cache [--snapshot data/snapshot | --data data/BGG_Data.csv]
+#   python benchmark.py images [--ids 20 --latency 0.2 --rate 2]
+#   python benchmark.py ingest --ratings data/user_ratings.csv [--workers 4]
+#   python benchmark.py refresh --ratings data/user_ratings.csv [--delta-rows 50000]
+#   python benchmark.py content-index [--snapshot data/snapshot | --data data/BGG_Data.csv] [--candidates 100,200,400,800]
+#   python benchmark.py collaborative --ratings data/user_ratings.csv [--seeds 1,4,12,24]
+#   python benchmark.py latent --ratings data/user_ratings.csv [--ranks 32,64,128]
+#   python benchmark.py image-load [--snapshot data/snapshot | --data data/BGG_Data.csv] [--latency 1.0]
+import argparse
+import logging
+import multiprocessing as mp
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from sklearn.metrics.pairwise import cosine_similarity
+
+from enhanced_recommendation import (CONTENT_INDEXES, BGGImageService, CollaborativeFilteringRecommender,
+                                     EnhancedRecommendationSystem, ImagePrefetcher, RankedRecommendations,
+                                     TokenBucket, append_ratings_cache, load_ratings_cache, process_memory,
+                                     read_ratings_csv, save_ratings_cache)
+
+# 向导中可选的偏好取值
+WIZARD_MECHANICS = ['strategy', 'luck', 'cooperation', 'cards', 'territory', 'building', 'roleplay', 'reaction']
+WIZARD_DOMAINS = ['Strategy Games', 'Family Games', 'Party Games', 'Thematic Games', 'Abstract Games']
+WIZARD_GAMES = ['Gloomhaven', 'Pandemic', 'Catan', 'Azul', 'Wingspan', 'Scythe', 'Terraforming Mars']
+
+
+def _child_pids(parent_pid: int):
+    """扫描 /proc 找出某个进程的全部子进程"""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # 第二个字段(进程名)可能包含空格，从最后一个 ')' 之后开始解析
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent_pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def _load_recommender(args) -> EnhancedRecommendationSystem:
+    """按命令行参数从快照或CSV加载推荐系统"""
+    recommender = EnhancedRecommendationSystem()
+    if args.snapshot:
+        recommender.load_snapshot(args.snapshot)
+    else:
+        recommender.load_and_preprocess_data(args.data, args.ratings)
+    return recommender
+
+
+def _random_preferences(n: int, seed: int = 0):
+    """从向导的离散选项空间中随机生成偏好"""
+    rng = random.Random(seed)
+    preferences = []
+    for _ in range(n):
+        preferences.append({
+            'selectedGames': rng.sample(WIZARD_GAMES, rng.randint(0, 2)),
+            'selectedMechanics': rng.sample(WIZARD_MECHANICS, rng.randint(1, 3)),
+            'selectedDomains': rng.sample(WIZARD_DOMAINS, rng.randint(0, 2)),
+            'gameSettings': {
+                'players': rng.choice(['1', '2-4', '5-8', '8+']),
+                'time': rng.choice(['30', '90', '180', '240']),
+                'age': rng.choice(['6', '10', '12', '14']),
+                'complexity': rng.choice(['1.5', '2.5', '3.5', '4.5']),
+            }
+        })
+    return preferences
+
+
+def _timeit(func, inputs, repeat: int = 1):
+    """对每个输入调用 func，返回每次调用耗时（毫秒）"""
+    timings = []
+    for _ in range(repeat):
+        for item in inputs:
+            start = time.perf_counter()
+            func(item)
+            timings.append((time.perf_counter() - start) * 1000)
+    return np.array(timings)
+
+
+def _report(name: str, timings: np.ndarray, baseline: np.ndarray = None):
+    line = (f"{name:<36} p50 {np.percentile(timings, 50):8.3f} ms   "
+            f"p95 {np.percentile(timings, 95):8.3f} ms")
+    if baseline is not None:
+        line += f"   x{np.percentile(baseline, 50) / np.percentile(timings, 50):.2f}"
+    print(line)
+
+
+def bench_scoring(args):
+    """对比内容相似度打分：逐次 cosine_similarity + 全排序 vs 预归一化点积 + argpartition"""
+    recommender = _load_recommender(args)
+    N = args.n
+    vectors = [recommender.build_preference_vector(p) for p in _random_preferences(args.samples)]
+    print(f"游戏数: {recommender.feature_matrix.shape[0]}, 特征维度: {recommender.feature_matrix.shape[1]}, "
+          f"样本数: {len(vectors)}")
+
+    def legacy(vector):
+        scores = cosine_similarity(vector.reshape(1, -1), recommender.feature_matrix).flatten()
+        return np.argsort(scores)[::-1][:N * 4]
+
+    def current(vector):
+        scores = recommender._content_similarity(csr_matrix(vector))[0]
+        return recommender._top_indices(scores, N * 4)
+
+    legacy_timings = _timeit(legacy, vectors, args.repeat)
+    current_timings = _timeit(current, vectors, args.repeat)
+    _report('cosine_similarity + argsort', legacy_timings)
+    _report('normalized dot + argpartition', current_timings, legacy_timings)
+
+    preferences = _random_preferences(args.samples)
+    _report('get_enhanced_recommendations',
+            _timeit(lambda p: recommender.get_enhanced_recommendations(p, N=N), preferences, args.repeat))
+
+
+def bench_classic(args):
+    """对比选择经典游戏时的打分：每次重新计算经典游戏相似度行 vs 使用加载时预计算的行"""
+    recommender = _load_recommender(args)
+    rng = random.Random(0)
+    preferences = []
+    for prefs in _random_preferences(args.samples):
+        prefs['selectedGames'] = rng.sample(WIZARD_GAMES, rng.randint(1, 3))
+        preferences.append(prefs)
+    similarities = [recommender._content_similarity(csr_matrix(recommender.build_preference_vector(p)))[0]
+                    for p in preferences]
+    inputs = list(zip(preferences, similarities))
+
+    def legacy(item):
+        prefs, similarity_scores = item
+        for idx in recommender.get_classic_games_by_selection(prefs['selectedGames']):
+            classic_similarity = recommender._content_similarity(recommender.feature_matrix_normalized[idx:idx + 1])[0]
+            similarity_scores = 0.7 * similarity_scores + 0.3 * classic_similarity
+        return similarity_scores
+
+    def current(item):
+        prefs, similarity_scores = item
+        for idx in recommender.get_classic_games_by_selection(prefs['selectedGames']):
+            similarity_scores = 0.7 * similarity_scores + 0.3 * recommender._classic_similarity(idx)
+        return similarity_scores
+
+    mismatches = sum(not np.array_equal(legacy(item), current(item)) for item in inputs)
+    print(f"游戏数: {len(recommender.catalog)}, 预计算经典游戏: {len(recommender.classic_positions)}, "
+          f"预计算内存 {recommender.classic_similarity.nbytes / 2 ** 20:.1f} MB, 样本数: {len(inputs)}")
+    legacy_timings = _timeit(legacy, inputs, args.repeat)
+    _report('per-request classic rows', legacy_timings)
+    _report('precomputed classic rows', _timeit(current, inputs, args.repeat), legacy_timings)
+    print(f"融合结果不一致: {mismatches}/{len(inputs)}")
+
+
+def bench_weighted(args):
+    """对比加权分数：每次重新归一化评分/流行度 vs 使用加载时预计算的先验"""
+    recommender = _load_recommender(args)
+    catalog = recommender.catalog
+    preferences = _random_preferences(args.samples)
+    similarities = [recommender._content_similarity(csr_matrix(recommender.build_preference_vector(p)))[0]
+                    for p in preferences]
+
+    def legacy(similarity_scores, rating_weight=0.3, popularity_weight=0.2):
+        similarity_normalized = (similarity_scores - similarity_scores.min()) / \
+                                (similarity_scores.max() - similarity_scores.min() + 1e-8)
+        ratings = np.nan_to_num(catalog.column('Rating Average'), nan=0.0)
+        rating_normalized = (ratings - ratings.min()) / (ratings.max() - ratings.min() + 1e-8)
+        users_rated = np.nan_to_num(catalog.column('Users Rated').astype(np.float64), nan=0.0)
+        popularity_normalized = (users_rated - users_rated.min()) / \
+                                (users_rated.max() - users_rated.min() + 1e-8)
+        similarity_weight = 1.0 - rating_weight - popularity_weight
+        return (similarity_weight * similarity_normalized + rating_weight * rating_normalized +
+                popularity_weight * popularity_normalized)
+
+    legacy_timings = _timeit(legacy, similarities, args.repeat)
+    current_timings = _timeit(recommender.calculate_weighted_score, similarities, args.repeat)
+    print(f"游戏数: {len(catalog)}, 样本数: {len(similarities)}")
+    _report('per-request normalization', legacy_timings)
+    _report('precomputed static prior', current_timings, legacy_timings)
+    saved = np.percentile(legacy_timings, 50) - np.percentile(current_timings, 50)
+    print(f"每次请求节省 {saved:.3f} ms (p50)")
+
+
+def bench_content_index(args):
+    """内容打分的近似候选检索：不同候选数量下的 recall@N 与延迟，对比对全部游戏精确打分
+
+    recall@N 为近似方式的 N 个推荐中同时出现在精确方式推荐中的比例；
+    候选 recall 为精确方式排序前 N×4 个候选被近似方式召回的比例。
+    直接构造 RankedRecommendations，绕过推荐结果缓存。
+    """
+    recommender = _load_recommender(args)
+    N = args.n
+    preferences = _random_preferences(args.samples)
+    print(f"游戏数: {len(recommender.catalog)}, 特征维度: {recommender.feature_matrix.shape[1]}, "
+          f"样本数: {len(preferences)}")
+
+    def rank(prefs):
+        return RankedRecommendations(recommender, prefs, depth=N)
+
+    exact = [rank(p) for p in preferences]
+    exact_ids = [[item['id'] for item in ranked.top(N)] for ranked in exact]
+    exact_timings = _timeit(lambda p: rank(p).top(N), preferences, args.repeat)
+    _report('exhaustive', exact_timings)
+
+    recommender.content_index_type = args.index
+    start = time.perf_counter()
+    recommender._build_content_index()
+    print(f"索引构建 {time.perf_counter() - start:.2f} s，簇数 {recommender.content_index.n_lists}")
+    for candidates in (int(value) for value in args.candidates.split(',')):
+        recommender.content_candidates = candidates
+        approximate = [rank(p) for p in preferences]
+        recall = np.mean([len(set(ids) & {item['id'] for item in ranked.top(N)}) / max(len(ids), 1)
+                          for ids, ranked in zip(exact_ids, approximate)])
+        candidate_recall = np.mean([len(np.intersect1d(e.candidates, a.candidates)) / max(len(e.candidates), 1)
+                                    for e, a in zip(exact, approximate)])
+        _report(f'{args.index} candidates={candidates}', _timeit(lambda p: rank(p).top(N), preferences, args.repeat),
+                exact_timings)
+        print(f"    recall@{N} {recall:.4f}   候选recall@{N * 4} {candidate_recall:.4f}")
+
+
+def bench_search(args):
+    """对比经典游戏名称匹配：逐次 pandas str.contains 全列扫描 vs 预建名称索引"""
+    recommender = _load_recommender(args)
+    names = pd.Series(recommender.catalog.names())
+    rng = random.Random(0)
+    queries = [rng.choice(WIZARD_GAMES) for _ in range(args.samples // 2)]
+    # 再混入一些从真实名称中截取的片段
+    for name in rng.sample(names.tolist(), args.samples - len(queries)):
+        start = rng.randrange(max(len(name) - 3, 1))
+        queries.append(name[start:start + rng.randint(3, 8)])
+
+    def legacy(query):
+        matches = names[names.str.lower().str.contains(query.lower(), na=False, regex=False)]
+        return matches.str.len().idxmin() if not matches.empty else -1
+
+    print(f"游戏数: {len(names)}, 查询数: {len(queries)}")
+    legacy_timings = _timeit(legacy, queries, args.repeat)
+    _report('str.lower().str.contains', legacy_timings)
+    _report('GameNameIndex.best_match', _timeit(recommender.name_index.best_match, queries, args.repeat),
+            legacy_timings)
+    _report('GameNameIndex.search (limit 10)',
+            _timeit(lambda q: recommender.name_index.search(q, 10), queries, args.repeat), legacy_timings)
+
+
+def bench_cache(args):
+    """推荐结果缓存：未命中（完整打分）vs 命中的延迟，以及模拟流量下的命中率"""
+    recommender = _load_recommender(args)
+    distinct = _random_preferences(args.distinct, seed=1)
+    rng = random.Random(2)
+    # 模拟流量：从有限的偏好组合中重复抽样
+    traffic = [rng.choice(distinct) for _ in range(args.samples)]
+
+    recommender.result_cache.max_size = 0
+    miss_timings = _timeit(lambda p: recommender.get_enhanced_recommendations(p, N=12), traffic)
+    recommender.result_cache.max_size = args.cache_size
+    recommender.result_cache.clear()
+    cached_timings = _timeit(lambda p: recommender.get_enhanced_recommendations(p, N=12), traffic)
+
+    print(f"不同偏好数: {len(distinct)}, 请求数: {len(traffic)}, 缓存容量: {args.cache_size}")
+    _report('no cache', miss_timings)
+    _report('with cache', cached_timings, miss_timings)
+    print(f"缓存统计: {recommender.result_cache.stats()}")
+
+
+class _StubBGGHandler(BaseHTTPRequestHandler):
+    """模拟 BGG XML API：固定延迟，支持逗号分隔的多个ID；
+    请求中包含首次出现且能被 queued_every 整除的ID时返回202；记录每次请求的时间"""
+
+    def do_GET(self):
+        server = self.server
+        game_ids = parse_qs(urlparse(self.path).query).get('id', ['0'])[0].split(',')
+        with server.lock:
+            server.request_times.append(time.monotonic())
+            queued = False
+            for game_id in game_ids:
+                server.hits[game_id] = server.hits.get(game_id, 0) + 1
+                queued = queued or (server.hits[game_id] == 1 and int(game_id) % server.queued_every == 0)
+        time.sleep(server.latency)
+
+        if queued:
+            self.send_response(202)
+            self.end_headers()
+            return
+        items = ''.join(f'<item id="{game_id}"><image>https://cf.geekdo-images.com/stub/{game_id}.jpg</image></item>'
+                        for game_id in game_ids)
+        body = f'<items>{items}</items>'.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_stub_bgg(latency: float, queued_every: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubBGGHandler)
+    server.latency = latency
+    server.queued_every = queued_every
+    server.request_times = []
+    server.hits = {}
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _max_requests_in_window(request_times, window: float) -> int:
+    """任意长度为 window 秒的时间窗口内的最大请求数"""
+    times = sorted(request_times)
+    best, start = 0, 0
+    for end, t in enumerate(times):
+        while t - times[start] > window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+def bench_images(args):
+    """批量获取图片：本地模拟 BGG 服务上的吞吐量和限流合规性"""
+    server = _start_stub_bgg(args.latency, args.queued_every)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    game_ids = list(range(1000, 1000 + args.ids))
+
+    def legacy(ids):
+        # 旧实现：逐个请求，每个之后等待0.5秒，每3个一批、批次间再等待1秒，202时等待2秒
+        service = BGGImageService(base_url=base_url, rate_limiter=TokenBucket(1e9, 1e9))
+        results = {}
+        for i in range(0, len(ids), 3):
+            for game_id in ids[i:i + 3]:
+                for _ in range(3):
+                    status, image_urls = service._fetch_image_urls([game_id])
+                    image_url = image_urls.get(str(game_id))
+                    if image_url:
+                        results[game_id] = image_url
+                        break
+                    time.sleep(2 if status == service.FETCH_QUEUED else 1)
+                time.sleep(0.5)
+            if i + 3 < len(ids):
+                time.sleep(1)
+        return results
+
+    def run(name, fetch):
+        server.request_times.clear()
+        server.hits.clear()
+        start = time.perf_counter()
+        results = fetch(game_ids)
+        elapsed = time.perf_counter() - start
+        peak = _max_requests_in_window(server.request_times, 1.0)
+        print(f"{name:<28} {elapsed:7.2f} s   获取 {len(results)}/{len(game_ids)}   "
+              f"请求 {len(server.request_times)}   任意1秒内最多 {peak} 次")
+        return results
+
+    print(f"模拟延迟 {args.latency}s，每 {args.queued_every} 个ID中一个首次返回202，"
+          f"限流 {args.rate}/s（突发 {args.burst}）")
+    legacy_results = None
+    if not args.skip_legacy:
+        legacy_results = run('sequential + sleeps (old)', legacy)
+
+    # 每种模式使用新的服务实例（空缓存）和新的限流器
+    results = None
+    for batch_size in (1, args.batch_size):
+        service = BGGImageService(base_url=base_url, rate_limiter=TokenBucket(args.rate, args.burst),
+                                  max_workers=args.workers, batch_size=batch_size)
+        results = run(f'pool x{args.workers}, {batch_size} id/request', service.get_multiple_image_urls)
+
+    allowed = args.burst + args.rate * 1.0
+    print(f"限流检查: 任意1秒内允许最多 {allowed:.0f} 次 -> "
+          f"{'通过' if _max_requests_in_window(server.request_times, 1.0) <= allowed else '超限'}")
+    if legacy_results is not None:
+        print(f"结果一致: {legacy_results == results}")
+    server.shutdown()
+
+
+def bench_image_load(args):
+    """慢速 BGG 下的推荐延迟：模拟 W 个同步 worker 同时处理图片请求和推荐请求
+
+    阻塞模式下图片请求在 worker 中等待 BGG（含202重试），非阻塞模式下只查缓存并交给后台预取。
+    推荐请求的延迟包含排队时间，非阻塞模式下应与无图片流量时基本一致。
+    """
+    recommender = _load_recommender(args)
+    recommender.result_cache.max_size = 0
+    server = _start_stub_bgg(args.latency, args.queued_every)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    preferences = _random_preferences(args.recommendations, seed=3)
+
+    def run(name, image_handler, baseline=None):
+        # 每种模式使用新的服务实例（空缓存）
+        service = BGGImageService(base_url=base_url, rate_limiter=TokenBucket(args.rate, args.burst))
+        prefetcher = ImagePrefetcher(service)
+
+        def recommend(prefs, submitted):
+            recommender.get_enhanced_recommendations(prefs, N=12)
+            return (time.perf_counter() - submitted) * 1000
+
+        with ThreadPoolExecutor(max_workers=args.workers) as workers:
+            futures, image_futures = [], []
+            for i, prefs in enumerate(preferences):
+                # 每个推荐请求之前到达若干个未缓存游戏的图片请求
+                if image_handler is not None:
+                    for j in range(args.images_per_request):
+                        game_id = 10000 + i * args.images_per_request + j
+                        image_futures.append(workers.submit(image_handler, service, prefetcher, game_id))
+                futures.append(workers.submit(recommend, prefs, time.perf_counter()))
+                time.sleep(args.interval)
+            timings = np.array([future.result() for future in futures])
+            for future in image_futures:
+                future.result()
+        _report(name, timings, baseline)
+        return timings
+
+    def blocking(service, prefetcher, game_id):
+        return service.get_game_image_url(game_id)
+
+    def non_blocking(service, prefetcher, game_id):
+        found, image_url = service.image_cache.lookup(game_id)
+        if not found:
+            prefetcher.enqueue([game_id])
+        return image_url
+
+    print(f"模拟延迟 {args.latency}s，{args.workers} 个 worker，{args.recommendations} 个推荐请求，"
+          f"每个之前 {args.images_per_request} 个图片请求，间隔 {args.interval}s")
+    baseline = run('no image traffic', None)
+    run('blocking image handler', blocking, baseline)
+    run('non-blocking image handler', non_blocking, baseline)
+
+    # 请求合并：同一游戏的并发请求只向 BGG 发起一次
+    service = BGGImageService(base_url=base_url, rate_limiter=TokenBucket(args.rate, args.burst))
+    with ThreadPoolExecutor(max_workers=args.workers) as workers:
+        urls = list(workers.map(lambda _: service.get_game_image_url(424241), range(args.workers)))
+    print(f"{args.workers} 个并发请求同一游戏: BGG 请求 {server.hits.get('424241', 0)} 次，"
+          f"结果一致: {len(set(urls)) == 1 and urls[0] is not None}")
+    server.shutdown()
+
+
+def _ingest_legacy(filepath: str, min_user_ratings: int, min_game_ratings: int) -> int:
+    # 旧实现：50万行分块读取（默认类型），合并后在用户名字符串上 value_counts/isin/unique
+    chunks = []
+    for chunk in pd.read_csv(filepath, chunksize=500000):
+        chunk = chunk.dropna()
+        chunk = chunk[chunk['Rating'] > 0]
+        if len(chunk) > 0:
+            chunks.append(chunk)
+    user_ratings = pd.concat(chunks, ignore_index=True)
+    del chunks
+    user_counts = user_ratings['Username'].value_counts()
+    game_counts = user_ratings['BGGId'].value_counts()
+    user_mask = user_ratings['Username'].isin(user_counts[user_counts >= min_user_ratings].index)
+    game_mask = user_ratings['BGGId'].isin(game_counts[game_counts >= min_game_ratings].index)
+    user_ratings = user_ratings[user_mask & game_mask]
+    unique_users = user_ratings['Username'].unique().tolist()
+    unique_games = user_ratings['BGGId'].unique().tolist()
+    user_to_idx = {user: idx for idx, user in enumerate(unique_users)}
+    game_to_idx = {game: idx for idx, game in enumerate(unique_games)}
+    user_ratings['Username'].map(pd.Series(user_to_idx)).values
+    user_ratings['BGGId'].map(pd.Series(game_to_idx)).values
+    return len(user_ratings)
+
+
+def _ingest_current(filepath: str, min_user_ratings: int, min_game_ratings: int, workers: int) -> int:
+    recommender = CollaborativeFilteringRecommender()
+    game_ids, user_codes, ratings, usernames = read_ratings_csv(filepath, workers=workers)
+    recommender._index_ratings(game_ids, user_codes, ratings, usernames, min_user_ratings, min_game_ratings)
+    return len(recommender.user_ratings)
+
+
+def _ingest_cached(cache_path: str, min_user_ratings: int, min_game_ratings: int) -> int:
+    recommender = CollaborativeFilteringRecommender()
+    recommender._index_ratings(*load_ratings_cache(cache_path), min_user_ratings, min_game_ratings)
+    return len(recommender.user_ratings)
+
+
+def _build_ratings_cache(ratings_path: str, cache_path: str, workers: int):
+    save_ratings_cache(cache_path, *read_ratings_csv(ratings_path, workers=workers))
+
+
+def _ingest_child(conn, func, args):
+    """在独立进程中运行一次读取，返回 (耗时, 保留行数, 本进程峰值RSS MB, 子进程峰值RSS MB)"""
+    start = time.perf_counter()
+    rows = func(*args)
+    elapsed = time.perf_counter() - start
+    conn.send((elapsed, rows, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024))
+    conn.close()
+
+
+def bench_ingest(args):
+    """评分CSV读取与过滤：吞吐量（行/秒）和峰值内存，每种实现在新进程中运行"""
+    with open(args.ratings, 'rb') as f:
+        total_rows = sum(block.count(b'\n') for block in iter(lambda: f.read(1 << 20), b'')) - 1
+    print(f"{args.ratings}: {os.path.getsize(args.ratings) / 1024 ** 2:.1f} MB, {total_rows:,} 行")
+
+    runs = [('pandas chunks (old)', _ingest_legacy, (args.ratings, args.min_user_ratings, args.min_game_ratings))]
+    for workers in sorted({1, args.workers}):
+        runs.append((f'parallel x{workers}', _ingest_current,
+                     (args.ratings, args.min_user_ratings, args.min_game_ratings, workers)))
+
+    # fork 出的新进程从导入后的状态开始，峰值内存互不影响；解析进程池同样使用 fork
+    context = mp.get_context('fork')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = os.path.join(tmp_dir, 'ratings.npz')
+        process = context.Process(target=_build_ratings_cache, args=(args.ratings, cache_path, args.workers))
+        process.start()
+        process.join()
+        runs.append(('npz cache', _ingest_cached, (cache_path, args.min_user_ratings, args.min_game_ratings)))
+        _run_ingest(context, runs, total_rows)
+
+
+def _run_ingest(context, runs, total_rows: int):
+    for name, func, func_args in runs:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_ingest_child, args=(sender, func, func_args))
+        process.start()
+        elapsed, rows, peak_mb, children_mb = receiver.recv()
+        process.join()
+        print(f"{name:<22} {elapsed:7.2f} s   {total_rows / elapsed:>12,.0f} 行/秒   保留 {rows:,}   "
+              f"峰值RSS {peak_mb:8.1f} MB（解析进程 {children_mb:.1f} MB）")
+
+
+def bench_refresh(args):
+    """增量合并新评分 vs 完整重建：耗时和近邻表一致性
+
+    评分文件的最后 delta_rows 行作为增量，只保留其余评分加载后已有的用户和游戏，
+    这样两种方式的低频过滤结果相同，近邻表可以直接比较。完整重建加载全部评分，
+    增量方式先加载其余评分（不计时），再用 add_ratings 合并增量。
+    """
+    ratings = pd.read_csv(args.ratings)
+    history, delta = ratings.iloc[:-args.delta_rows], ratings.iloc[-args.delta_rows:]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        history_path = os.path.join(tmp_dir, 'history.csv')
+        history.to_csv(history_path, index=False)
+        incremental = CollaborativeFilteringRecommender()
+        incremental.load_user_ratings(history_path)
+
+        delta = delta[delta['Username'].isin(incremental.user_to_idx.keys()) &
+                      delta['BGGId'].isin(incremental.game_to_idx.keys())]
+        # 完整重建使用与 add_ratings 相同的覆盖语义：历史评分缓存 + 合并增量
+        delta_path = os.path.join(tmp_dir, 'delta.csv')
+        cache_path = os.path.join(tmp_dir, 'ratings.npz')
+        delta.to_csv(delta_path, index=False)
+        save_ratings_cache(cache_path, *read_ratings_csv(history_path))
+        append_ratings_cache(cache_path, delta_path)
+
+        start = time.perf_counter()
+        full = CollaborativeFilteringRecommender()
+        full.load_user_ratings(cache_path)
+        full_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    summary = incremental.add_ratings(delta, tolerance=args.tolerance)
+    incremental_seconds = time.perf_counter() - start
+
+    # 按游戏ID比较近邻表
+    overlap, total, max_diff = 0, 0, 0.0
+    for game_id, full_idx in full.game_to_idx.items():
+        full_indices, full_scores = full.item_neighbors.neighbors(full_idx)
+        inc_indices, inc_scores = incremental.item_neighbors.neighbors(incremental.game_to_idx[game_id])
+        full_map = dict(zip((full.idx_to_game[i] for i in full_indices.tolist()), full_scores.tolist()))
+        inc_map = dict(zip((incremental.idx_to_game[i] for i in inc_indices.tolist()), inc_scores.tolist()))
+        common = full_map.keys() & inc_map.keys()
+        overlap += len(common)
+        total += len(full_map)
+        max_diff = max([max_diff] + [abs(full_map[g] - inc_map[g]) for g in common])
+
+    print(f"增量: {summary}")
+    print(f"{'full rebuild':<22} {full_seconds:8.2f} s")
+    print(f"{'add_ratings':<22} {incremental_seconds:8.2f} s   x{full_seconds / incremental_seconds:.1f}")
+    print(f"近邻重合率 {overlap / max(total, 1):.4f}，相同近邻的相似度最大误差 {max_diff:.2e}")
+
+
+def bench_collaborative(args):
+    """对比协同过滤多游戏打分：逐个输入游戏的 Python 循环累加 vs 一次性向量化聚合"""
+    recommender = CollaborativeFilteringRecommender()
+    recommender.load_user_ratings(args.ratings)
+    N = args.n
+    game_ids = np.array(list(recommender.game_to_idx))
+    rng = np.random.default_rng(0)
+
+    def legacy(seeds):
+        similarity_scores = {}
+        for game_id in seeds:
+            if game_id not in recommender.game_to_idx:
+                continue
+            neighbor_indices, neighbor_scores = recommender.item_neighbors.neighbors(recommender.game_to_idx[game_id])
+            for idx, similarity_score in zip(neighbor_indices[:N * 2], neighbor_scores[:N * 2]):
+                if similarity_score > 0.1:
+                    similarity_scores.setdefault(idx, []).append(similarity_score)
+        recommendations = []
+        for idx, scores in similarity_scores.items():
+            avg_similarity = np.mean(scores)
+            recommendations.append({
+                'id': int(recommender.idx_to_game[idx]),
+                'similarity_score': float(avg_similarity),
+                'avg_rating': float(recommender.item_avg_rating[idx]),
+                'rating_count': int(recommender.item_rating_count[idx]),
+                'collaborative_score': float(avg_similarity * 100)
+            })
+        recommendations.sort(key=lambda x: x['similarity_score'], reverse=True)
+        return recommendations[:N]
+
+    def current(seeds):
+        return recommender.get_collaborative_recommendations(seeds, N=N)
+
+    print(f"游戏数: {len(game_ids)}, 近邻K: {recommender.item_neighbors.k}, 样本数: {args.samples}")
+    for count in (int(value) for value in args.seeds.split(',')):
+        queries = [rng.choice(game_ids, size=count).tolist() for _ in range(args.samples)]
+        mismatches = sum(legacy(q) != current(q) for q in queries)
+        legacy_timings = _timeit(legacy, queries, args.repeat)
+        _report(f'{count:>3} seeds  per-seed loops', legacy_timings)
+        _report(f'{count:>3} seeds  vectorized', _timeit(current, queries, args.repeat), legacy_timings)
+        print(f"    结果不一致: {mismatches}/{len(queries)}")
+
+
+def _holdout_ratings(args):
+    """留一法切分：为评分数足够的部分用户各留出一条高分评分作为测试，其余评分用于训练"""
+    game_ids, user_codes, ratings, usernames = read_ratings_csv(args.ratings)
+    rng = np.random.default_rng(0)
+    counts = np.bincount(user_codes, minlength=len(usernames))
+    candidates = np.flatnonzero((ratings >= args.relevant_rating) & (counts[user_codes] >= args.min_user_ratings))
+    # 每个用户只留出一条：打乱后按用户去重
+    candidates = rng.permutation(candidates)
+    _, first = np.unique(user_codes[candidates], return_index=True)
+    held_out = rng.permutation(candidates[first])[:args.users]
+    train = np.ones(len(ratings), dtype=bool)
+    train[held_out] = False
+    return (game_ids[train], user_codes[train], ratings[train], usernames), held_out, \
+        (game_ids, user_codes, ratings, usernames)
+
+
+def bench_latent(args):
+    """协同过滤隐因子模式 vs 物品-物品精确相似度：留一法命中率、构建耗时和查询延迟
+
+    每个测试用户以其训练集中评分最高的若干个游戏作为输入（相当于向导中选择的经典游戏），
+    推荐结果（去掉输入游戏后的前 N 个）中包含留出的游戏即为命中。
+    """
+    train, held_out, (game_ids, user_codes, ratings, _) = _holdout_ratings(args)
+    train_games, train_users, train_ratings = train[0], train[1], train[2]
+    order = np.lexsort((-train_ratings, train_users))
+    user_starts = np.searchsorted(train_users[order], user_codes[held_out])
+    queries = []
+    for row, start in zip(held_out.tolist(), user_starts.tolist()):
+        seeds = train_games[order[start:start + args.seeds]]
+        seeds = seeds[train_users[order[start:start + args.seeds]] == user_codes[row]]
+        queries.append((seeds.tolist(), int(game_ids[row])))
+    print(f"训练评分: {len(train_ratings):,}，测试用户: {len(queries)}，每个用户输入 {args.seeds} 个游戏，N={args.n}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = os.path.join(tmp_dir, 'train.npz')
+        save_ratings_cache(cache_path, *train)
+        print(f"{'mode':<16} {'build':>8} {'memory':>10} {'hit@N':>7} {'p50':>10} {'p95':>10}")
+        for rank in [None] + [int(value) for value in args.ranks.split(',')]:
+            recommender = CollaborativeFilteringRecommender(factor_rank=rank)
+            start = time.perf_counter()
+            recommender.load_user_ratings(cache_path)
+            build_seconds = time.perf_counter() - start
+
+            def recommend(query):
+                seeds = query[0]
+                recs = recommender.get_collaborative_recommendations(seeds, N=args.n + len(seeds))
+                return [rec['id'] for rec in recs if rec['id'] not in seeds][:args.n]
+
+            evaluated = [q for q in queries if q[1] in recommender.game_to_idx]
+            hits = sum(q[1] in recommend(q) for q in evaluated)
+            timings = _timeit(recommend, evaluated, args.repeat)
+            # 相似度计算的输入：精确模式为评分矩阵（随用户数增长），隐因子模式为物品数 × 秩的因子矩阵
+            if rank:
+                memory = recommender.item_factors.nbytes
+            else:
+                matrix = recommender.user_item_matrix
+                memory = matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+            name = f'svd rank={rank}' if rank else 'item-item'
+            print(f"{name:<16} {build_seconds:7.2f}s {memory / 2 ** 20:8.1f}MB {hits / max(len(evaluated), 1):7.4f} "
+                  f"{np.percentile(timings, 50):7.3f} ms {np.percentile(timings, 95):7.3f} ms")
+
+
+def bench_workers(args):
+    """打印 gunicorn 主进程和各 worker 的内存占用
+
+    对比方式：分别以 GUNICORN_PRELOAD=0 和默认配置启动 gunicorn，
+    各发送若干请求后运行本命令，比较 worker 的 uss（独占内存）和 pss。
+    """
+    pids = [args.master_pid] + _child_pids(args.master_pid)
+    print(f"{'pid':>8} {'role':>7} {'rss_mb':>9} {'pss_mb':>9} {'uss_mb':>9} {'shared_mb':>10}")
+    totals = {'rss_mb': 0.0, 'pss_mb': 0.0, 'uss_mb': 0.0}
+    for pid in pids:
+        usage = process_memory(pid)
+        shared = usage.get('shared_clean_mb', 0) + usage.get('shared_dirty_mb', 0)
+        role = 'master' if pid == args.master_pid else 'worker'
+        print(f"{pid:>8} {role:>7} {usage.get('rss_mb', 0):>9.1f} {usage.get('pss_mb', 0):>9.1f} "
+              f"{usage.get('uss_mb', 0):>9.1f} {shared:>10.1f}")
+        for key in totals:
+            totals[key] += usage.get(key, 0)
+    print(f"{'total':>16} {totals['rss_mb']:>9.1f} {totals['pss_mb']:>9.1f} {totals['uss_mb']:>9.1f}")
+
+
+def _add_data_arguments(parser):
+    parser.add_argument('--snapshot', default=None, help='模型快照目录（优先于CSV）')
+    parser.add_argument('--data', default='data/BGG_Data.csv')
+    parser.add_argument('--ratings', default=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='推荐系统性能测量')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    workers = subparsers.add_parser('workers', help='gunicorn 各进程内存占用')
+    workers.add_argument('--master-pid', type=int, required=True)
+    workers.set_defaults(func=bench_workers)
+
+    scoring = subparsers.add_parser('scoring', help='内容相似度打分延迟')
+    _add_data_arguments(scoring)
+    scoring.add_argument('--samples', type=int, default=200)
+    scoring.add_argument('--repeat', type=int, default=3)
+    scoring.add_argument('-n', type=int, default=12)
+    scoring.set_defaults(func=bench_scoring)
+
+    classic = subparsers.add_parser('classic', help='选择经典游戏时的相似度融合耗时')
+    _add_data_arguments(classic)
+    classic.add_argument('--samples', type=int, default=200)
+    classic.add_argument('--repeat', type=int, default=3)
+    classic.set_defaults(func=bench_classic)
+
+    weighted = subparsers.add_parser('weighted', help='加权分数计算耗时')
+    _add_data_arguments(weighted)
+    weighted.add_argument('--samples', type=int, default=200)
+    weighted.add_argument('--repeat', type=int, default=3)
+    weighted.set_defaults(func=bench_weighted)
+
+    search = subparsers.add_parser('search', help='游戏名称匹配延迟')
+    _add_data_arguments(search)
+    search.add_argument('--samples', type=int, default=200)
+    search.add_argument('--repeat', type=int, default=3)
+    search.set_defaults(func=bench_search)
+
+    cache = subparsers.add_parser('cache', help='推荐结果缓存命中率与延迟')
+    _add_data_arguments(cache)
+    cache.add_argument('--samples', type=int, default=2000)
+    cache.add_argument('--distinct', type=int, default=300, help='流量中不同偏好的数量')
+    cache.add_argument('--cache-size', type=int, default=1024)
+    cache.set_defaults(func=bench_cache)
+
+    images = subparsers.add_parser('images', help='批量获取BGG图片的吞吐量与限流（本地模拟服务）')
+    images.add_argument('--ids', type=int, default=20)
+    images.add_argument('--latency', type=float, default=0.2, help='模拟服务每次响应的延迟（秒）')
+    images.add_argument('--queued-every', type=int, default=5, help='每隔多少个ID首次请求返回202')
+    images.add_argument('--rate', type=float, default=2.0, help='令牌桶速率（次/秒）')
+    images.add_argument('--burst', type=float, default=4)
+    images.add_argument('--workers', type=int, default=4)
+    images.add_argument('--batch-size', type=int, default=20, help='每次 thing 请求包含的ID数')
+    images.add_argument('--skip-legacy', action='store_true')
+    images.set_defaults(func=bench_images)
+
+    ingest = subparsers.add_parser('ingest', help='评分CSV读取吞吐量与峰值内存')
+    ingest.add_argument('--ratings', required=True)
+    ingest.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    ingest.add_argument('--min-user-ratings', type=int, default=10)
+    ingest.add_argument('--min-game-ratings', type=int, default=20)
+    ingest.set_defaults(func=bench_ingest)
+
+    refresh = subparsers.add_parser('refresh', help='增量合并新评分与完整重建的耗时对比')
+    refresh.add_argument('--ratings', required=True)
+    refresh.add_argument('--delta-rows', type=int, default=50000, help='评分文件末尾作为增量的行数')
+    refresh.add_argument('--tolerance', type=float, default=1e-3, help='近邻相似度允许误差，0 为精确')
+    refresh.set_defaults(func=bench_refresh)
+
+    content_index = subparsers.add_parser('content-index', help='内容打分近似候选检索的 recall 与延迟')
+    _add_data_arguments(content_index)
+    content_index.add_argument('--index', default='ivf', choices=sorted(CONTENT_INDEXES))
+    content_index.add_argument('--candidates', default='100,200,400,800', help='每次检索的候选数量（逗号分隔）')
+    content_index.add_argument('--samples', type=int, default=200)
+    content_index.add_argument('--repeat', type=int, default=3)
+    content_index.add_argument('-n', type=int, default=12)
+    content_index.set_defaults(func=bench_content_index)
+
+    collaborative = subparsers.add_parser('collaborative', help='协同过滤多游戏打分延迟')
+    collaborative.add_argument('--ratings', required=True)
+    collaborative.add_argument('--seeds', default='1,4,12,24', help='每次请求的输入游戏数（逗号分隔）')
+    collaborative.add_argument('--samples', type=int, default=200)
+    collaborative.add_argument('--repeat', type=int, default=3)
+    collaborative.add_argument('-n', type=int, default=12)
+    collaborative.set_defaults(func=bench_collaborative)
+
+    latent = subparsers.add_parser('latent', help='协同过滤隐因子模式与物品-物品相似度的命中率和延迟')
+    latent.add_argument('--ratings', required=True)
+    latent.add_argument('--ranks', default='32,64,128', help='隐因子的秩（逗号分隔）')
+    latent.add_argument('--users', type=int, default=1000, help='留一法测试用户数')
+    latent.add_argument('--seeds', type=int, default=3, help='每个测试用户作为输入的高分游戏数')
+    latent.add_argument('--min-user-ratings', type=int, default=20, help='测试用户至少需要的评分数')
+    latent.add_argument('--relevant-rating', type=float, default=7.0, help='留出评分的最低分')
+    latent.add_argument('--repeat', type=int, default=1)
+    latent.add_argument('-n', type=int, default=10)
+    latent.set_defaults(func=bench_latent)
+
+    image_load = subparsers.add_parser('image-load', help='慢速图片请求下的推荐延迟（本地模拟服务）')
+    _add_data_arguments(image_load)
+    image_load.add_argument('--latency', type=float, default=1.0, help='模拟服务每次响应的延迟（秒）')
+    image_load.add_argument('--queued-every', type=int, default=2, help='每隔多少个ID首次请求返回202')
+    image_load.add_argument('--rate', type=float, default=2.0, help='令牌桶速率（次/秒）')
+    image_load.add_argument('--burst', type=float, default=4)
+    image_load.add_argument('--workers', type=int, default=4, help='模拟的同步 worker 数')
+    image_load.add_argument('--recommendations', type=int, default=40)
+    image_load.add_argument('--images-per-request', type=int, default=2, help='每个推荐请求之前的图片请求数')
+    image_load.add_argument('--interval', type=float, default=0.05, help='推荐请求之间的间隔（秒）')
+    image_load.set_defaults(func=bench_image_load)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
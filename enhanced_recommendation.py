@@ -1,107 +1,889 @@
 # enhanced_recommendation.py
 import pandas as pd
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.preprocessing import MultiLabelBinarizer, MinMaxScaler
-from scipy.sparse import hstack, csr_matrix
+from sklearn.preprocessing import MultiLabelBinarizer, MinMaxScaler, normalize
+from scipy.sparse import hstack, csr_matrix, diags
 import requests
 import logging
 import re
 import time
+import threading
+import queue
+import os
+import sys
+import io
+import json
+import shutil
+import hashlib
+import sqlite3
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from datetime import datetime
 from typing import List, Dict, Any, Tuple, Optional
 from scipy.sparse import csr_matrix
 from sklearn.decomposition import TruncatedSVD
 from sklearn.feature_extraction.text import TfidfVectorizer
 import warnings
 warnings.filterwarnings('ignore')
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import multiprocessing as mp
 
 logger = logging.getLogger(__name__)
 
+# 模型快照格式版本，快照内容结构变化时递增
+SNAPSHOT_VERSION = 4
+DEFAULT_SNAPSHOT_DIR = 'data/snapshot'
+
+# BGG XML API 的全进程请求速率上限（次/秒）和突发容量
+BGG_REQUESTS_PER_SECOND = 2.0
+BGG_REQUEST_BURST = 4
+# BGG thing 接口单次请求最多支持的游戏ID数量
+BGG_THING_BATCH_SIZE = 20
+
+# 并行解析评分CSV时每个分段的字节数
+RATINGS_PART_BYTES = 16 << 20
+# 评分列式缓存（.npz）格式版本
+RATINGS_CACHE_VERSION = 1
+# 评分统计按 1/RATING_SCALE 分（6位小数，BGG评分的精度）的整数累加
+RATING_SCALE = 10 ** 6
+
+# 请求路径上单次最多需要的推荐数：主推荐12个 + “更多匹配”分页最多50个（app.py 据此限制 limit 和批量 N）
+MAX_RECOMMENDATIONS = 62
+# 融合时以 N*2 调用协同过滤，每个输入游戏再取 N*2 个近邻，即最多 4 × MAX_RECOMMENDATIONS 个；
+# 近邻数不小于这个值，保证所有请求取到的候选与完整相似度矩阵一致
+CF_NEIGHBOR_K = 4 * MAX_RECOMMENDATIONS
+
+# 内容打分启用近似检索时，默认的候选数量，以及始终加入候选的高先验分数游戏数量
+CONTENT_CANDIDATES = 800
+PRIOR_CANDIDATES = 64
+
+# BGG游戏数据CSV的查找路径（按优先级），应用启动和命令行共用
+DATA_PATHS = [
+    'data/BGG_Data.csv',
+    'BGG_Data.csv',
+    '../data/BGG_Data.csv',
+    './data/BGG_Data.csv'
+]
+
+# 向导中展示的经典游戏（各机制类型的代表作），加载时预计算它们与全部游戏的内容相似度
+CLASSIC_GAME_IDS = [
+    174430,  # Gloomhaven - 角色扮演/战役
+    167791,  # Terraforming Mars - 引擎构建
+    161936,  # Pandemic Legacy: Season 1 - 合作/传承
+    169786,  # Scythe - 区域控制
+    120677,  # Terra Mystica - 策略建设
+    31260,  # Agricola - 工人放置
+    68448,  # Carcassonne - 板块拼放
+    178900,  # Codenames - 聚会/词汇
+    6249,  # 7 Wonders - 卡牌轮抽
+    521,  # Ticket to Ride - 家庭/路线建设
+    13,  # Settlers of Catan - 贸易/谈判
+    36218,  # Dominion - 卡组构建
+    224517,  # Azul - 抽象/图案
+    266192,  # Wingspan - 引擎构建/自然主题
+    170216,  # Splendor - 引擎构建/宝石
+    220308,  # Brass: Birmingham - 经济策略
+    295947,  # Dune: Imperium - 工人放置/卡组构建
+    316554,  # Everdell - 工人放置/手牌管理
+    295770,  # Root - 不对称游戏
+    30549,  # Pandemic - 合作游戏
+    148228,  # Love Letter - 推理/快速
+    39856,  # Dixit - 创意/聚会
+    230802,  # Kingdomino - 家庭/板块
+    182028,  # Through the Ages - 文明建设
+]
+
+
+def find_data_file(paths: List[str] = DATA_PATHS) -> Optional[str]:
+    """按顺序返回第一个存在的数据文件路径，都不存在时返回None"""
+    for path in paths:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def file_checksum(filepath: str, block_size: int = 1 << 20) -> str:
+    """计算源数据文件的SHA-256校验和"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _encode_strings(values) -> Tuple[np.ndarray, np.ndarray]:
+    """将字符串列表编码为 UTF-8 字节数组 + 偏移量数组"""
+    encoded = [str(v).encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.array([len(b) for b in encoded], dtype=np.int64), out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _decode_strings(data: np.ndarray, offsets: np.ndarray) -> List[str]:
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def _save_string_table(snapshot_dir: str, name: str, values) -> None:
+    """将字符串列表保存为 UTF-8 字节数组 + 偏移量数组"""
+    data, offsets = _encode_strings(values)
+    np.save(os.path.join(snapshot_dir, f'{name}_data.npy'), data)
+    np.save(os.path.join(snapshot_dir, f'{name}_offsets.npy'), offsets)
+
+
+def _load_string_table(snapshot_dir: str, name: str) -> List[str]:
+    """读取由 _save_string_table 保存的字符串列表"""
+    return _decode_strings(np.load(os.path.join(snapshot_dir, f'{name}_data.npy')),
+                           np.load(os.path.join(snapshot_dir, f'{name}_offsets.npy')))
+
+
+def _save_csr(snapshot_dir: str, name: str, matrix) -> Dict[str, Any]:
+    """保存CSR矩阵的三个组成数组，返回写入清单的形状信息"""
+    matrix = csr_matrix(matrix)
+    np.save(os.path.join(snapshot_dir, f'{name}_data.npy'), matrix.data)
+    np.save(os.path.join(snapshot_dir, f'{name}_indices.npy'), matrix.indices)
+    np.save(os.path.join(snapshot_dir, f'{name}_indptr.npy'), matrix.indptr)
+    return {'shape': list(matrix.shape)}
+
+
+def _load_csr(snapshot_dir: str, name: str, info: Dict[str, Any], mmap_mode: Optional[str] = 'r') -> csr_matrix:
+    """从快照读取CSR矩阵，数组以内存映射方式打开"""
+    data = np.load(os.path.join(snapshot_dir, f'{name}_data.npy'), mmap_mode=mmap_mode)
+    indices = np.load(os.path.join(snapshot_dir, f'{name}_indices.npy'), mmap_mode=mmap_mode)
+    indptr = np.load(os.path.join(snapshot_dir, f'{name}_indptr.npy'), mmap_mode=mmap_mode)
+    return csr_matrix((data, indices, indptr), shape=tuple(info['shape']), copy=False)
+
+
+def _csv_byte_ranges(filepath: str, part_bytes: int) -> Tuple[bytes, List[Tuple[int, int]]]:
+    """将CSV按字节切分为以换行结尾的分段，返回 (表头行, [(起始, 结束), ...])
+
+    评分文件每行一条记录，字段中不含换行，因此按换行切分即可得到完整的行。
+    """
+    size = os.path.getsize(filepath)
+    ranges = []
+    with open(filepath, 'rb') as f:
+        header = f.readline()
+        start = f.tell()
+        while start < size:
+            f.seek(min(start + part_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return header, ranges
+
+
+def _parse_ratings_range(filepath: str, header: bytes, start: int, end: int) -> List[np.ndarray]:
+    """解析评分CSV的一个分段（在子进程中运行）
+
+    返回 [游戏ID int32, 分段内用户编码 int32, 评分 float64, 分段内用户名数组]，
+    已去掉缺失值和非正评分。
+    """
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    chunk = pd.read_csv(io.BytesIO(header + data), usecols=['BGGId', 'Rating', 'Username'],
+                        dtype={'BGGId': np.float64, 'Rating': np.float64, 'Username': object})
+    chunk = chunk.dropna()
+    chunk = chunk[chunk['Rating'] > 0]
+
+    codes, usernames = pd.factorize(chunk['Username'])
+    return [chunk['BGGId'].to_numpy(np.int32), codes.astype(np.int32),
+            chunk['Rating'].to_numpy(np.float64), np.asarray(usernames, dtype=object)]
+
+
+def read_ratings_csv(filepath: str, workers: Optional[int] = None,
+                     part_bytes: int = RATINGS_PART_BYTES) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """读取用户评分CSV，返回 (游戏ID int32, 用户编码 int32, 评分 float64, 用户名数组)
+
+    文件按字节分段后由多个进程并行解析，每个分段在解析时就把用户名编码为整数，
+    主进程只合并各分段的用户名字典，不再持有每行一个的用户名字符串。
+    用户编码按用户名首次出现的顺序分配。评分保持 float64，使游戏平均分与原始数据一致，
+    评分矩阵中再转换为 float32。
+    """
+    header, ranges = _csv_byte_ranges(filepath, part_bytes)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(ranges)))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(_parse_ratings_range, [filepath] * len(ranges), [header] * len(ranges),
+                                      [r[0] for r in ranges], [r[1] for r in ranges]))
+    else:
+        parts = [_parse_ratings_range(filepath, header, start, end) for start, end in ranges]
+
+    if not parts:
+        return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32),
+                np.empty(0, dtype=np.float64), np.empty(0, dtype=object))
+
+    # 合并各分段的用户名字典：分段内编码 -> 全局编码
+    global_codes, usernames = pd.factorize(np.concatenate([part[3] for part in parts]))
+    global_codes = global_codes.astype(np.int32)
+    offset = 0
+    for part in parts:
+        part[1] = global_codes[offset:offset + len(part[3])][part[1]]
+        offset += len(part[3])
+        part[3] = None
+
+    # 逐列合并，合并后立即释放分段中的数组，峰值内存只多出一列
+    columns = []
+    for column in range(3):
+        columns.append(np.concatenate([part[column] for part in parts]))
+        for part in parts:
+            part[column] = None
+    return columns[0], columns[1], columns[2], np.asarray(usernames, dtype=object)
+
+
+def save_ratings_cache(path: str, game_ids: np.ndarray, user_codes: np.ndarray, ratings: np.ndarray,
+                       usernames: np.ndarray, sources: Optional[Dict[str, Any]] = None) -> None:
+    """将解析后的评分数据写入列式缓存（未压缩的 .npz，先写临时文件再替换）
+
+    缓存保存过滤前的全部有效评分，min_user_ratings / min_game_ratings 在加载时再应用。
+    sources 记录缓存来源（源CSV校验和、已合并的增量文件校验和）。
+    """
+    names_data, names_offsets = _encode_strings(usernames)
+    meta = {'version': RATINGS_CACHE_VERSION, **(sources or {})}
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f'.{os.path.basename(path)}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, game_ids=game_ids, user_codes=user_codes, ratings=ratings,
+                 usernames_data=names_data, usernames_offsets=names_offsets,
+                 meta=np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8))
+    os.replace(tmp_path, path)
+
+
+def ratings_cache_sources(path: str) -> Dict[str, Any]:
+    """只读取缓存的元信息，不加载评分数组"""
+    with np.load(path) as cache:
+        return json.loads(cache['meta'].tobytes().decode('utf-8'))
+
+
+def load_ratings_cache(path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """读取评分列式缓存，返回值与 read_ratings_csv 相同"""
+    with np.load(path) as cache:
+        meta = json.loads(cache['meta'].tobytes().decode('utf-8'))
+        if meta.get('version') != RATINGS_CACHE_VERSION:
+            raise ValueError(f"评分缓存版本不匹配: {meta.get('version')}")
+        usernames = np.asarray(_decode_strings(cache['usernames_data'], cache['usernames_offsets']), dtype=object)
+        return cache['game_ids'], cache['user_codes'], cache['ratings'], usernames
+
+
+def append_ratings_cache(path: str, delta_filepath: str, workers: Optional[int] = None) -> int:
+    """将增量评分CSV合并到已有缓存，返回增量中的有效评分数
+
+    只解析增量文件；历史数据直接从缓存读取。新用户名追加到用户名字典末尾，
+    已有用户的编码不变。同一用户对同一游戏的评分以增量中的最后一条为准。
+    """
+    sources = ratings_cache_sources(path)
+    game_ids, user_codes, ratings, usernames = load_ratings_cache(path)
+    delta_games, delta_codes, delta_ratings, delta_usernames = read_ratings_csv(delta_filepath, workers=workers)
+
+    # 增量中的用户名映射到已有字典，新用户追加在末尾
+    user_index = pd.Index(usernames)
+    mapped = user_index.get_indexer(delta_usernames)
+    new_users = mapped < 0
+    mapped[new_users] = len(usernames) + np.arange(new_users.sum())
+    delta_codes = mapped.astype(np.int32)[delta_codes]
+    usernames = np.concatenate([usernames, delta_usernames[new_users]])
+
+    # 覆盖已有评分：去掉历史中与增量重复的 (用户, 游戏)，增量内部保留最后一条
+    history_keys = (user_codes.astype(np.int64) << 32) | game_ids.astype(np.int64)
+    delta_keys = (delta_codes.astype(np.int64) << 32) | delta_games.astype(np.int64)
+    latest = ~pd.Series(delta_keys).duplicated(keep='last').to_numpy()
+    current = ~np.isin(history_keys, delta_keys[latest])
+
+    sources['deltas'] = sources.get('deltas', []) + [file_checksum(delta_filepath)]
+    save_ratings_cache(
+        path,
+        np.concatenate([game_ids[current], delta_games[latest]]),
+        np.concatenate([user_codes[current], delta_codes[latest]]),
+        np.concatenate([ratings[current], delta_ratings[latest]]),
+        usernames, sources
+    )
+    logger.info(f"评分缓存已合并 {latest.sum():,} 条增量评分，其中覆盖 {(~current).sum():,} 条，"
+                f"新用户 {new_users.sum():,}")
+    return int(latest.sum())
+
+
+def _rating_totals(indices: np.ndarray, ratings: np.ndarray, minlength: int) -> np.ndarray:
+    """按下标累加评分，返回以 1/RATING_SCALE 分为单位的 int64 总和
+
+    评分先换算为整数再累加：2^53 以内的整数在 float64 中的加法是精确的，
+    总和与累加顺序无关（完整加载和增量更新得到相同结果）。
+    """
+    units = np.rint(np.asarray(ratings, dtype=np.float64) * RATING_SCALE)
+    return np.rint(np.bincount(indices, weights=units, minlength=minlength)).astype(np.int64)
+
+
+def process_memory(pid: Any = 'self') -> Dict[str, float]:
+    """读取进程内存占用（MB）
+
+    在Linux上解析 /proc/<pid>/smaps_rollup：rss 为常驻内存，pss 按共享进程数分摊共享页，
+    uss 为进程独占的页。多个 gunicorn worker 共享内存映射或 fork 前加载的数组时，
+    uss 才反映单个 worker 的真实开销。
+    """
+    fields = {'Rss': 'rss_mb', 'Pss': 'pss_mb', 'Shared_Clean': 'shared_clean_mb',
+              'Shared_Dirty': 'shared_dirty_mb', 'Private_Clean': 'private_clean_mb',
+              'Private_Dirty': 'private_dirty_mb'}
+    usage = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in fields:
+                    usage[fields[key]] = round(int(value.split()[0]) / 1024, 1)
+        usage['uss_mb'] = round(usage.get('private_clean_mb', 0) + usage.get('private_dirty_mb', 0), 1)
+    except OSError:
+        # 非Linux环境只能拿到当前进程的峰值常驻内存
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage['max_rss_mb'] = round(maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1)
+    return usage
+
+
+def descending_order(*keys: np.ndarray) -> np.ndarray:
+    """降序排序下标（第一列为主键），缺失值排在最后，并列时的顺序与 pandas sort_values 一致"""
+    if len(keys) == 1:
+        # 单列排序时 pandas 先反转非缺失值再快速排序，结果再反转
+        values = np.asarray(keys[0])
+        missing = pd.isna(values)
+        rows = np.flatnonzero(~missing)[::-1]
+        order = rows[values[rows].argsort(kind='quicksort')][::-1]
+        return np.concatenate([order, np.flatnonzero(missing)])
+
+    # 多列排序时 pandas 使用稳定的字典序排序
+    sort_keys = [np.arange(len(keys[0]))]
+    for values in reversed(keys):
+        values = np.asarray(values, dtype=np.float64)
+        sort_keys.extend([-np.nan_to_num(values), np.isnan(values)])
+    return np.lexsort(sort_keys)
+
+
+class GameCatalog:
+    """服务期使用的列式游戏目录
+
+    替代请求路径上的 pandas DataFrame：
+    - 数值列保存为带类型的 NumPy 数组（缺失值为 NaN）
+    - 游戏名称保存为 UTF-8 字节串表 + 偏移量
+    - 多值字段（机制、领域、机制大类）保存为 CSR 偏移量 + 词表编码
+    - 按 BGG ID 查行号为 O(1)（以ID为下标的行号数组）
+    """
+
+    LIST_COLUMNS = ['Mechanics', 'Domains', 'Mechanism_Categories']
+
+    def __init__(self, ids: np.ndarray, numeric: Dict[str, np.ndarray],
+                 name_data: np.ndarray, name_offsets: np.ndarray,
+                 lists: Dict[str, Tuple[np.ndarray, np.ndarray, List[str]]]):
+        self.ids = ids
+        self.numeric = numeric
+        self.name_data = name_data
+        self.name_offsets = name_offsets
+        self.lists = lists
+
+        if len(ids) and ids.min() < 0:
+            raise ValueError("游戏ID不能为负数")
+        # 同一ID出现多次时保留第一次出现的行
+        self.row_lookup = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, dtype=np.int32)
+        self.row_lookup[ids[::-1]] = np.arange(len(ids), dtype=np.int32)[::-1]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> 'GameCatalog':
+        """从预处理后的 DataFrame（以 ID 为索引）构建目录"""
+        numeric = {}
+        for col in df.columns:
+            if col in cls.LIST_COLUMNS or not pd.api.types.is_numeric_dtype(df[col]):
+                continue
+            values = df[col].to_numpy()
+            # 整数列在取值范围允许时压缩为 int32，浮点列保持 float64 以免改变输出数值
+            if np.issubdtype(values.dtype, np.integer) and len(values) and \
+                    np.iinfo(np.int32).min <= values.min() and values.max() <= np.iinfo(np.int32).max:
+                values = values.astype(np.int32)
+            numeric[col] = np.ascontiguousarray(values)
+
+        name_data, name_offsets = _encode_strings(df['Name'])
+
+        lists = {}
+        for col in cls.LIST_COLUMNS:
+            values = df[col].tolist() if col in df.columns else [[] for _ in range(len(df))]
+            vocab = sorted({value for items in values for value in items})
+            lookup = {value: j for j, value in enumerate(vocab)}
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum([len(items) for items in values], out=offsets[1:])
+            codes = np.array([lookup[value] for items in values for value in items], dtype=np.int32)
+            lists[col] = (offsets, codes, vocab)
+
+        return cls(df.index.to_numpy(dtype=np.int64), numeric, name_data, name_offsets, lists)
+
+    def row_of(self, game_id: int) -> int:
+        """按BGG ID查行号，不存在时返回 -1"""
+        if 0 <= game_id < len(self.row_lookup):
+            return int(self.row_lookup[game_id])
+        return -1
+
+    def rows_of(self, game_ids) -> np.ndarray:
+        """批量按BGG ID查行号，不存在的为 -1"""
+        game_ids = np.asarray(game_ids, dtype=np.int64)
+        rows = np.full(len(game_ids), -1, dtype=np.int32)
+        in_range = (game_ids >= 0) & (game_ids < len(self.row_lookup))
+        rows[in_range] = self.row_lookup[game_ids[in_range]]
+        return rows
+
+    def column(self, name: str) -> np.ndarray:
+        """数值列；目录中没有的列返回全 NaN"""
+        if name in self.numeric:
+            return self.numeric[name]
+        return np.full(len(self.ids), np.nan)
+
+    def name(self, row: int) -> str:
+        start, end = self.name_offsets[row], self.name_offsets[row + 1]
+        return self.name_data[start:end].tobytes().decode('utf-8')
+
+    def names(self, rows=None) -> List[str]:
+        rows = range(len(self.ids)) if rows is None else rows
+        return [self.name(row) for row in rows]
+
+    def list_values(self, col: str, row: int) -> List[str]:
+        """多值字段在某一行的取值列表"""
+        offsets, codes, vocab = self.lists[col]
+        return [vocab[code] for code in codes[offsets[row]:offsets[row + 1]]]
+
+    def save(self, snapshot_dir: str) -> Dict[str, Any]:
+        """写入快照目录，返回写入清单的元信息"""
+        np.save(os.path.join(snapshot_dir, 'catalog_ids.npy'), self.ids)
+        np.save(os.path.join(snapshot_dir, 'catalog_name_data.npy'), self.name_data)
+        np.save(os.path.join(snapshot_dir, 'catalog_name_offsets.npy'), self.name_offsets)
+        numeric_columns = list(self.numeric)
+        for i, col in enumerate(numeric_columns):
+            np.save(os.path.join(snapshot_dir, f'catalog_num_{i}.npy'), self.numeric[col])
+        for i, col in enumerate(self.LIST_COLUMNS):
+            offsets, codes, vocab = self.lists[col]
+            np.save(os.path.join(snapshot_dir, f'catalog_list_{i}_offsets.npy'), offsets)
+            np.save(os.path.join(snapshot_dir, f'catalog_list_{i}_codes.npy'), codes)
+            _save_string_table(snapshot_dir, f'catalog_list_{i}_vocab', vocab)
+        return {'numeric_columns': numeric_columns, 'list_columns': list(self.LIST_COLUMNS)}
+
+    @classmethod
+    def load(cls, snapshot_dir: str, info: Dict[str, Any], mmap_mode: Optional[str] = 'r') -> 'GameCatalog':
+        """从快照目录读取目录，数组以内存映射方式打开"""
+        def load(name):
+            return np.load(os.path.join(snapshot_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        numeric = {col: load(f'catalog_num_{i}') for i, col in enumerate(info['numeric_columns'])}
+        lists = {
+            col: (load(f'catalog_list_{i}_offsets'), load(f'catalog_list_{i}_codes'),
+                  _load_string_table(snapshot_dir, f'catalog_list_{i}_vocab'))
+            for i, col in enumerate(info['list_columns'])
+        }
+        return cls(load('catalog_ids'), numeric, load('catalog_name_data'), load('catalog_name_offsets'), lists)
+
+
+class GameNameIndex:
+    """游戏名称搜索索引（不区分大小写的子串/前缀查找）
+
+    - 子串：小写名称按 (原名称长度, 行号) 排序后以分隔符拼接为一个字符串，
+      str.find 的第一个命中即为名称最短的匹配，与逐行扫描取最短名称的结果一致
+    - 前缀：小写名称按字典序排序后二分查找
+    """
+
+    SEPARATOR = '\x00'
+
+    def __init__(self, names: List[str]):
+        lowered = [name.lower() for name in names]
+        lengths = np.array([len(name) for name in names], dtype=np.int64)
+        self.rows = np.lexsort((np.arange(len(names)), lengths)).astype(np.int32)
+
+        ordered = [lowered[row] for row in self.rows.tolist()]
+        self.text = self.SEPARATOR.join(ordered)
+        self.starts = np.zeros(len(ordered), dtype=np.int64)
+        np.cumsum(np.array([len(name) + 1 for name in ordered[:-1]], dtype=np.int64), out=self.starts[1:])
+
+        # 前缀区间内按 (长度, 行号) 的名次排序，名次即在 self.rows 中的位置
+        ranks = np.empty(len(names), dtype=np.int32)
+        ranks[self.rows] = np.arange(len(names), dtype=np.int32)
+        prefix_order = sorted(range(len(names)), key=lowered.__getitem__)
+        self.prefix_keys = [lowered[row] for row in prefix_order]
+        self.prefix_ranks = ranks[prefix_order]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _entry_at(self, position: int) -> int:
+        """拼接字符串中的位置所属的名称序号"""
+        return int(np.searchsorted(self.starts, position, side='right')) - 1
+
+    def best_match(self, query: str) -> int:
+        """名称包含 query 的最短游戏行号（长度相同时取靠前的行），没有匹配时返回 -1"""
+        query = query.lower()
+        if not len(self.rows) or self.SEPARATOR in query:
+            return -1
+        position = self.text.find(query)
+        if position < 0:
+            return -1
+        return int(self.rows[self._entry_at(position)])
+
+    def prefix_matches(self, query: str, limit: int = 10) -> np.ndarray:
+        """名称以 query 开头的游戏行号，按名称长度排序"""
+        query = query.lower()
+        start = bisect_left(self.prefix_keys, query)
+        end = bisect_left(self.prefix_keys, query + '\U0010ffff', lo=start)
+        ranks = np.sort(self.prefix_ranks[start:end])[:limit]
+        return self.rows[ranks]
+
+    def substring_matches(self, query: str, limit: int = 10, exclude_prefix: bool = False) -> np.ndarray:
+        """名称包含 query 的游戏行号，按名称长度排序"""
+        query = query.lower()
+        if self.SEPARATOR in query:
+            return self.rows[:0]
+        entries = []
+        position = self.text.find(query)
+        while position >= 0 and len(entries) < limit:
+            entry = self._entry_at(position)
+            # 每个名称只取第一个命中；命中位置在名称开头即为前缀匹配
+            if not (exclude_prefix and position == self.starts[entry]):
+                entries.append(entry)
+            if entry + 1 >= len(self.starts):
+                break
+            position = self.text.find(query, int(self.starts[entry + 1]))
+        return self.rows[np.array(entries, dtype=np.int64)]
+
+    def search(self, query: str, limit: int = 10) -> np.ndarray:
+        """自动补全：前缀匹配优先，不足时补充其余子串匹配"""
+        matches = self.prefix_matches(query, limit)
+        if len(matches) < limit:
+            matches = np.concatenate([
+                matches, self.substring_matches(query, limit - len(matches), exclude_prefix=True)
+            ])
+        return matches
+
+
+class ItemNeighborIndex:
+    """物品Top-K近邻索引
+
+    以CSR形式保存每个物品最相似的K个物品：第 i 个物品的近邻为
+    indices[indptr[i]:indptr[i + 1]]，对应相似度为 scores[...]，按相似度降序排列。
+    内存占用为 O(n_items * K)，不再随物品数平方增长。
+    """
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, scores: np.ndarray,
+                 k: int, min_similarity: float):
+        self.indptr = indptr
+        self.indices = indices
+        self.scores = scores
+        self.k = k
+        self.min_similarity = min_similarity
+
+    @property
+    def n_items(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.indices.nbytes + self.scores.nbytes
+
+    def neighbors(self, item_idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        """返回某个物品的近邻索引和相似度（按相似度降序）"""
+        start, end = self.indptr[item_idx], self.indptr[item_idx + 1]
+        return self.indices[start:end], self.scores[start:end]
+
+    @staticmethod
+    def _top_k(sims: np.ndarray, row_items: np.ndarray, k_eff: int, min_similarity: float):
+        """从一块相似度中选出每行的Top-K近邻（排除物品自身），返回 (每行近邻数, 近邻索引, 相似度)"""
+        rows = np.arange(len(row_items))
+        sims[rows, row_items] = -np.inf
+
+        top = np.argpartition(-sims, k_eff - 1, axis=1)[:, :k_eff]
+        top_scores = np.take_along_axis(sims, top, axis=1)
+
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        keep = top_scores > min_similarity
+        return keep.sum(axis=1), top[keep].astype(np.int32), top_scores[keep]
+
+    @staticmethod
+    def _similarity_block(item_vectors, vectors_t, rows) -> np.ndarray:
+        sims = item_vectors[rows] @ vectors_t
+        sims = sims.toarray() if hasattr(sims, 'toarray') else np.asarray(sims)
+        return sims.astype(np.float32, copy=False)
+
+    @classmethod
+    def build(cls, item_vectors, k: int = 100, min_similarity: float = 0.1,
+              block_size: int = 512) -> 'ItemNeighborIndex':
+        """分块构建近邻索引
+
+        item_vectors 的每一行是一个已做L2归一化的物品向量（稀疏或稠密均可），
+        每次只计算 block_size 行与全部物品的相似度，完整的相似度矩阵不会被创建。
+        """
+        n_items = item_vectors.shape[0]
+        k_eff = max(min(k, n_items - 1), 0)
+        vectors_t = item_vectors.T.tocsr() if hasattr(item_vectors, 'tocsr') else item_vectors.T
+
+        counts = np.zeros(n_items, dtype=np.int64)
+        indices_blocks = []
+        scores_blocks = []
+
+        for start in range(0, n_items, block_size):
+            end = min(start + block_size, n_items)
+            if k_eff == 0:
+                continue
+            sims = cls._similarity_block(item_vectors, vectors_t, slice(start, end))
+            counts[start:end], block_indices, block_scores = cls._top_k(
+                sims, np.arange(start, end), k_eff, min_similarity
+            )
+            indices_blocks.append(block_indices)
+            scores_blocks.append(block_scores)
+
+            if start % (block_size * 10) == 0:
+                logger.info(f"近邻索引已处理 {end}/{n_items} 个物品")
+
+        indptr = np.zeros(n_items + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        indices = np.concatenate(indices_blocks) if indices_blocks else np.zeros(0, dtype=np.int32)
+        scores = np.concatenate(scores_blocks) if scores_blocks else np.zeros(0, dtype=np.float32)
+
+        return cls(indptr, indices, scores, k, min_similarity)
+
+    def update(self, item_vectors, changed: np.ndarray, block_size: int = 512,
+               tolerance: float = 1e-3) -> Tuple['ItemNeighborIndex', int]:
+        """部分物品向量变化后增量更新近邻索引
+
+        item_vectors 为更新后全部物品的归一化向量（新增物品排在原有物品之后），
+        changed 为向量发生变化的物品（包括新增物品）。
+        - changed 中的物品与全部物品重新计算相似度；
+        - 其余物品只有与 changed 物品之间的相似度会变化：原近邻表不含 changed 物品，
+          或原近邻表未满（超过阈值的物品都已在表中）时，合并新的相似度即得到精确结果；
+        - 原近邻表已满且包含 changed 物品时，表外物品的相似度不超过原表的最低分。
+          合并后的第K名不低于该分数减 tolerance 时直接使用合并结果（相似度误差不超过 tolerance），
+          否则整行重新计算。tolerance=0 时结果与完整重建一致。
+        返回 (新索引, 整行重新计算的物品数)。
+        """
+        n_items = item_vectors.shape[0]
+        n_old = self.n_items
+        k_eff = max(min(self.k, n_items - 1), 0)
+        old_k_eff = max(min(self.k, n_old - 1), 0)
+        vectors_t = item_vectors.T.tocsr() if hasattr(item_vectors, 'tocsr') else item_vectors.T
+
+        changed = np.unique(np.asarray(changed, dtype=np.int64))
+        is_changed = np.zeros(n_items, dtype=bool)
+        is_changed[changed] = True
+        if k_eff == 0:
+            return ItemNeighborIndex(np.zeros(n_items + 1, dtype=np.int64), np.zeros(0, dtype=np.int32),
+                                     np.zeros(0, dtype=np.float32), self.k, self.min_similarity), 0
+
+        rows = {}
+
+        def recompute(items):
+            for start in range(0, len(items), block_size):
+                block = items[start:start + block_size]
+                sims = self._similarity_block(item_vectors, vectors_t, block)
+                yield block, sims
+                counts, block_indices, block_scores = self._top_k(sims, block, k_eff, self.min_similarity)
+                offsets = np.concatenate([[0], np.cumsum(counts)])
+                for i, item in enumerate(block):
+                    rows[int(item)] = (block_indices[offsets[i]:offsets[i + 1]],
+                                       block_scores[offsets[i]:offsets[i + 1]])
+
+        # changed 物品整行重新计算；同时对称地为其余物品保留与 changed 物品的Top-K相似度
+        cand_indices = np.full((n_items, k_eff), -1, dtype=np.int32)
+        cand_scores = np.full((n_items, k_eff), -np.inf, dtype=np.float32)
+        for block, sims in recompute(changed):
+            merged_scores = np.hstack([cand_scores, sims.T])
+            merged_indices = np.hstack([cand_indices, np.broadcast_to(block.astype(np.int32), (n_items, len(block)))])
+            top = np.argpartition(-merged_scores, k_eff - 1, axis=1)[:, :k_eff]
+            cand_scores = np.take_along_axis(merged_scores, top, axis=1)
+            cand_indices = np.take_along_axis(merged_indices, top, axis=1)
+
+        # 其余物品：能合并的直接合并，原近邻表已满且包含 changed 物品的整行重新计算
+        full_rescan = []
+        for item in np.flatnonzero(~is_changed):
+            if item < n_old:
+                old_indices, old_scores = self.neighbors(item)
+            else:
+                old_indices, old_scores = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+            stale = is_changed[old_indices]
+            new = cand_scores[item] > self.min_similarity
+            if not stale.any() and not new.any():
+                continue
+            truncated = len(old_indices) >= old_k_eff
+            if truncated and k_eff > old_k_eff:
+                full_rescan.append(item)
+                continue
+            indices = np.concatenate([old_indices[~stale], cand_indices[item][new]])
+            scores = np.concatenate([old_scores[~stale], cand_scores[item][new]])
+            order = np.argsort(-scores, kind='stable')[:k_eff]
+            if truncated and stale.any() and (len(order) < k_eff or scores[order[-1]] < old_scores[-1] - tolerance):
+                full_rescan.append(item)
+                continue
+            rows[int(item)] = (indices[order].astype(np.int32), scores[order].astype(np.float32))
+
+        for _ in recompute(np.asarray(full_rescan, dtype=np.int64)):
+            pass
+
+        # 组装新的CSR近邻表，未变化的行直接复用原数组
+        counts = np.zeros(n_items, dtype=np.int64)
+        indices_blocks, scores_blocks = [], []
+        for item in range(n_items):
+            if item in rows:
+                item_indices, item_scores = rows[item]
+            elif item < n_old:
+                item_indices, item_scores = self.neighbors(item)
+            else:
+                continue
+            counts[item] = len(item_indices)
+            indices_blocks.append(item_indices)
+            scores_blocks.append(item_scores)
+
+        indptr = np.zeros(n_items + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        indices = np.concatenate(indices_blocks).astype(np.int32) if indices_blocks else np.zeros(0, dtype=np.int32)
+        scores = np.concatenate(scores_blocks).astype(np.float32) if scores_blocks else np.zeros(0, dtype=np.float32)
+        return ItemNeighborIndex(indptr, indices, scores, self.k, self.min_similarity), len(full_rescan)
+
+
+class ClusterCandidateIndex:
+    """内容特征的倒排聚类（IVF）候选检索
+
+    用球面 k-means 将L2归一化后的游戏特征向量分为若干簇，按簇保存成员行号（CSR形式）。
+    查询时按簇中心与查询向量的点积从高到低依次取簇，直到候选数量足够；
+    候选由调用方用原始特征精确打分。只依赖 NumPy/SciPy，不需要外部服务。
+    """
+
+    def __init__(self, centroids: np.ndarray, list_indptr: np.ndarray, list_rows: np.ndarray):
+        self.centroids = centroids
+        self.list_indptr = list_indptr
+        self.list_rows = list_rows
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, item_vectors, n_lists: Optional[int] = None, n_iter: int = 10,
+              seed: int = 0) -> 'ClusterCandidateIndex':
+        """在已做L2归一化的物品向量上训练簇中心（默认 4×sqrt(物品数) 个簇）"""
+        vectors = item_vectors.toarray() if hasattr(item_vectors, 'toarray') else np.asarray(item_vectors)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        n_items = len(vectors)
+        n_lists = max(min(n_lists or int(4 * np.sqrt(n_items)), n_items), 1)
+        rng = np.random.default_rng(seed)
+
+        centroids = vectors[rng.choice(n_items, n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            members = csr_matrix((np.ones(n_items, dtype=np.float32), (assignment, np.arange(n_items))),
+                                 shape=(n_lists, n_items))
+            sums = np.asarray(members @ vectors)
+            norms = np.linalg.norm(sums, axis=1)
+            # 空簇重新随机选一个物品作为中心
+            empty = np.flatnonzero(norms == 0)
+            sums[empty] = vectors[rng.choice(n_items, len(empty), replace=False)]
+            norms[empty] = np.maximum(np.linalg.norm(sums[empty], axis=1), 1e-12)
+            centroids = sums / norms[:, None]
+
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        list_indptr = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_indptr[1:])
+        list_rows = np.argsort(assignment, kind='stable').astype(np.int32)
+        return cls(np.ascontiguousarray(centroids, dtype=np.float32), list_indptr, list_rows)
+
+    def search(self, query: np.ndarray, n_candidates: int) -> np.ndarray:
+        """按簇中心相似度从高到低取簇，返回至少 n_candidates 个候选行号（总数不足时返回全部）"""
+        order = np.argsort(-(self.centroids @ query.astype(np.float32)), kind='stable')
+        sizes = np.diff(self.list_indptr)[order]
+        n_probe = int(np.searchsorted(np.cumsum(sizes), n_candidates)) + 1
+        return np.concatenate([self.list_rows[self.list_indptr[i]:self.list_indptr[i + 1]]
+                               for i in order[:n_probe]])
+
+
+# 可选的内容候选检索实现：名称 -> 提供 build(item_vectors) 和 search(query, n_candidates) 的类
+CONTENT_INDEXES = {
+    'ivf': ClusterCandidateIndex,
+}
+
+
+class GameStatsView(Mapping):
+    """按游戏ID访问协同过滤统计信息的只读视图：{游戏ID: {'avg_rating': ..., 'rating_count': ...}}
+
+    统计信息本身按物品索引保存在对齐的数组中，视图只在访问时组装字典。
+    """
+
+    def __init__(self, recommender: 'CollaborativeFilteringRecommender'):
+        self._recommender = recommender
+
+    def __getitem__(self, game_id) -> Dict[str, Any]:
+        idx = self._recommender.game_to_idx[game_id]
+        return {'avg_rating': float(self._recommender.item_avg_rating[idx]),
+                'rating_count': int(self._recommender.item_rating_count[idx])}
+
+    def __iter__(self):
+        return iter(self._recommender.game_to_idx)
+
+    def __len__(self) -> int:
+        return len(self._recommender.game_to_idx)
+
 
 class CollaborativeFilteringRecommender:
-    """协同过滤推荐系统"""
-    
-    def __init__(self):
+    """协同过滤推荐系统
+
+    factor_rank 为 None 时按评分矩阵的列（用户维度）直接计算物品余弦相似度；
+    指定秩时先用随机化截断SVD得到物品隐因子（物品数 × 秩），近邻索引在隐空间中计算。
+    """
+
+    def __init__(self, neighbor_k: int = CF_NEIGHBOR_K, min_similarity: float = 0.1,
+                 factor_rank: Optional[int] = None):
         self.user_item_matrix = None
-        self.item_similarity_matrix = None
+        self.item_neighbors = None
+        self.item_norms = None
+        self.item_factors = None
+        self.neighbor_k = neighbor_k
+        self.min_similarity = min_similarity
+        self.factor_rank = factor_rank
         self.user_ratings = None
         self.game_to_idx = {}
         self.idx_to_game = {}
         self.user_to_idx = {}
         self.idx_to_user = {}
         self.popular_games = []
-        self.avg_ratings = {}
+        # 按物品索引对齐的统计数组，avg_ratings 为按游戏ID访问的视图
+        self.item_avg_rating = np.zeros(0, dtype=np.float64)
+        self.item_rating_count = np.zeros(0, dtype=np.int64)
+        # 每个游戏的评分总和（单位为 1/RATING_SCALE 分的整数，由原始 float64 评分累加；
+        # 评分矩阵的 float32 数据只用于相似度）
+        self.item_rating_total = np.zeros(0, dtype=np.int64)
+        self.avg_ratings = GameStatsView(self)
+        self.min_user_ratings = 10
+        self.min_game_ratings = 20
         self.is_loaded = False
         
-    def load_user_ratings(self, filepath: str, min_user_ratings: int = 10, min_game_ratings: int = 20):
-        """加载用户评分数据并进行预处理 - 优化版本"""
+    def load_user_ratings(self, filepath: str, min_user_ratings: int = 10, min_game_ratings: int = 20,
+                          workers: Optional[int] = None, cache_path: Optional[str] = None):
+        """加载用户评分数据并进行预处理 - 并行解析版本
+
+        filepath 可以是评分CSV，也可以是 save_ratings_cache 生成的 .npz 缓存。
+        指定 cache_path 时，缓存来自同一份CSV则直接读取缓存，否则解析CSV并写入缓存。
+        """
         try:
             logger.info("开始加载用户评分数据...")
-            
-            # 优化的分块读取
-            chunk_size = 500000  # 增加块大小以减少I/O操作
-            chunks = []
-            total_rows = 0
-            
-            logger.info("分块读取数据...")
-            for i, chunk in enumerate(pd.read_csv(filepath, chunksize=chunk_size)):
-                # 数据清洗（在读取时就进行）
-                chunk = chunk.dropna()
-                chunk = chunk[chunk['Rating'] > 0]
-                
-                if len(chunk) > 0:
-                    chunks.append(chunk)
-                    total_rows += len(chunk)
-                
-                if i % 10 == 0:
-                    logger.info(f"已处理 {i * chunk_size:,} 行数据")
-            
-            # 合并所有块
-            logger.info("合并数据块...")
-            self.user_ratings = pd.concat(chunks, ignore_index=True)
-            logger.info(f"成功加载 {len(self.user_ratings):,} 条用户评分记录")
-            
-            # 内存优化：删除中间变量
-            del chunks
-            
-            # 使用向量化操作过滤低频用户和游戏
-            logger.info("过滤低频用户和游戏...")
-            
-            # 计算用户和游戏的评分次数
-            user_counts = self.user_ratings['Username'].value_counts()
-            game_counts = self.user_ratings['BGGId'].value_counts()
-            
-            # 创建过滤mask
-            user_mask = self.user_ratings['Username'].isin(
-                user_counts[user_counts >= min_user_ratings].index
-            )
-            game_mask = self.user_ratings['BGGId'].isin(
-                game_counts[game_counts >= min_game_ratings].index
-            )
-            
-            # 应用过滤
-            self.user_ratings = self.user_ratings[user_mask & game_mask]
-            
-            logger.info(f"过滤后保留 {len(self.user_ratings):,} 条评分记录")
-            logger.info(f"活跃用户数量: {user_mask.sum():,}")
-            logger.info(f"流行游戏数量: {game_mask.sum():,}")
-            
-            # 重新计算唯一值
-            unique_users = self.user_ratings['Username'].unique().tolist()
-            unique_games = self.user_ratings['BGGId'].unique().tolist()
-            
-            # 创建索引映射（使用numpy数组索引提高性能）
-            self.game_to_idx = {game: idx for idx, game in enumerate(unique_games)}
-            self.idx_to_game = {idx: game for game, idx in self.game_to_idx.items()}
-            self.user_to_idx = {user: idx for idx, user in enumerate(unique_users)}
-            self.idx_to_user = {idx: user for user, idx in self.user_to_idx.items()}
-            
-            logger.info(f"创建索引映射完成，用户: {len(unique_users)}, 游戏: {len(unique_games)}")
-            
+
+            start = time.perf_counter()
+            game_ids, user_codes, ratings, usernames = self._read_ratings(filepath, workers, cache_path)
+            logger.info(f"成功加载 {len(ratings):,} 条用户评分记录，"
+                        f"用户: {len(usernames):,}，耗时 {time.perf_counter() - start:.2f}s")
+
+            self._index_ratings(game_ids, user_codes, ratings, usernames, min_user_ratings, min_game_ratings)
+
             # 创建用户-物品矩阵
             self._create_user_item_matrix()
+            # 评分明细已全部进入评分矩阵，统计信息也由矩阵计算，释放明细表
+            self.user_ratings = None
             
             # 计算物品相似度矩阵
             self._compute_item_similarity()
@@ -116,38 +898,92 @@ class CollaborativeFilteringRecommender:
             logger.error(f"加载用户评分数据失败: {e}")
             self.is_loaded = False
             raise
-    
+
+    def _read_ratings(self, filepath: str, workers: Optional[int], cache_path: Optional[str]):
+        """读取评分数据，优先使用列式缓存"""
+        if filepath.endswith('.npz'):
+            return load_ratings_cache(filepath)
+
+        source = None
+        if cache_path:
+            source = file_checksum(filepath)
+            try:
+                if os.path.exists(cache_path) and ratings_cache_sources(cache_path).get('source') == source:
+                    logger.info(f"使用评分缓存: {cache_path}")
+                    return load_ratings_cache(cache_path)
+            except Exception as e:
+                logger.warning(f"读取评分缓存失败，重新解析CSV: {e}")
+
+        ratings_data = read_ratings_csv(filepath, workers=workers)
+        if cache_path:
+            try:
+                save_ratings_cache(cache_path, *ratings_data, sources={'source': source})
+                logger.info(f"评分缓存已写入: {cache_path}")
+            except Exception as e:
+                logger.warning(f"写入评分缓存失败: {e}")
+        return ratings_data
+
+    def _index_ratings(self, game_ids: np.ndarray, user_codes: np.ndarray, ratings: np.ndarray,
+                       usernames: np.ndarray, min_user_ratings: int, min_game_ratings: int):
+        """在整数编码上过滤低频用户和游戏，并按首次出现顺序重新编号"""
+        logger.info("过滤低频用户和游戏...")
+        self.min_user_ratings = min_user_ratings
+        self.min_game_ratings = min_game_ratings
+
+        # 用户编码和BGG游戏ID都是较小的非负整数，直接用 bincount 计数
+        active_users = np.bincount(user_codes, minlength=len(usernames)) >= min_user_ratings
+        popular_games = np.bincount(game_ids) >= min_game_ratings
+        keep = active_users[user_codes]
+        keep &= popular_games[game_ids]
+
+        game_ids, user_codes, ratings = game_ids[keep], user_codes[keep], ratings[keep]
+        del keep
+
+        # 过滤后按首次出现顺序重新编号（编号表按原编码索引，避免生成 int64 的中间数组）
+        kept_users = pd.unique(user_codes)
+        user_remap = np.zeros(len(active_users), dtype=np.int32)
+        user_remap[kept_users] = np.arange(len(kept_users), dtype=np.int32)
+        unique_games = pd.unique(game_ids)
+        game_remap = np.zeros(len(popular_games), dtype=np.int32)
+        game_remap[unique_games] = np.arange(len(unique_games), dtype=np.int32)
+        unique_users = usernames[kept_users].tolist()
+        unique_games = unique_games.tolist()
+
+        self.user_ratings = pd.DataFrame({
+            'UserIdx': user_remap[user_codes],
+            'GameIdx': game_remap[game_ids],
+            'BGGId': game_ids,
+            'Rating': ratings,
+        }, copy=False)
+        # 统计信息在转换为 float32 之前按原始评分累加
+        game_indices = self.user_ratings['GameIdx'].to_numpy()
+        self.item_rating_count = np.bincount(game_indices, minlength=len(unique_games)).astype(np.int64)
+        self.item_rating_total = _rating_totals(game_indices, self.user_ratings['Rating'].to_numpy(np.float64),
+                                                len(unique_games))
+        logger.info(f"过滤后保留 {len(self.user_ratings):,} 条评分记录")
+        logger.info(f"活跃用户数量: {len(unique_users):,}")
+        logger.info(f"流行游戏数量: {len(unique_games):,}")
+
+        self.game_to_idx = {game: idx for idx, game in enumerate(unique_games)}
+        self.idx_to_game = {idx: game for game, idx in self.game_to_idx.items()}
+        self.user_to_idx = {user: idx for idx, user in enumerate(unique_users)}
+        self.idx_to_user = {idx: user for user, idx in self.user_to_idx.items()}
+
+        logger.info(f"创建索引映射完成，用户: {len(unique_users)}, 游戏: {len(unique_games)}")
+
     def _create_user_item_matrix(self):
         """创建用户-物品评分矩阵 - 优化版本"""
         try:
             logger.info("开始创建用户-物品评分矩阵...")
-            
-            # 使用向量化操作映射用户和游戏ID
-            user_series = pd.Series(self.user_to_idx)
-            game_series = pd.Series(self.game_to_idx)
-            
-            # 向量化映射用户和游戏索引
-            user_indices = self.user_ratings['Username'].map(user_series).values
-            game_indices = self.user_ratings['BGGId'].map(game_series).values
-            ratings = self.user_ratings['Rating'].values
-            
-            # 验证映射结果
-            valid_mask = pd.notna(user_indices) & pd.notna(game_indices)
-            if not valid_mask.all():
-                logger.warning(f"发现 {(~valid_mask).sum()} 个无效映射，将被忽略")
-                user_indices = user_indices[valid_mask]
-                game_indices = game_indices[valid_mask]
-                ratings = ratings[valid_mask]
-            
-            # 创建稀疏矩阵
+
+            # 评分记录中已保存整数编码的用户和游戏索引
+            user_indices = self.user_ratings['UserIdx'].to_numpy()
+            game_indices = self.user_ratings['GameIdx'].to_numpy()
+            ratings = self.user_ratings['Rating'].to_numpy(np.float32)
+
             n_users = len(self.user_to_idx)
             n_games = len(self.game_to_idx)
-            
-            # 使用更高效的数据类型
-            user_indices = user_indices.astype(np.int32)
-            game_indices = game_indices.astype(np.int32)
-            ratings = ratings.astype(np.float32)
-            
+
             # 直接创建稀疏矩阵
             self.user_item_matrix = csr_matrix(
                 (ratings, (user_indices, game_indices)),
@@ -166,127 +1002,312 @@ class CollaborativeFilteringRecommender:
             logger.error(f"创建用户-物品矩阵失败: {e}")
             raise
     
-    def _compute_item_similarity(self, use_chunking=True, chunk_size=1000):
-        """计算物品间的相似度矩阵 - 优化版本"""
+    def _normalized_item_vectors(self):
+        """按列（物品）做L2归一化，转置后行表示游戏，列表示用户"""
+        inv_norms = np.divide(1.0, self.item_norms, out=np.zeros_like(self.item_norms),
+                              where=self.item_norms > 0)
+        return (self.user_item_matrix @ diags(inv_norms)).T.tocsr()
+
+    def _compute_item_factors(self):
+        """随机化截断SVD：评分矩阵 ≈ U·Σ·Vᵀ，物品隐因子为 V·Σ（物品数 × 秩）"""
+        start = time.perf_counter()
+        rank = max(min(self.factor_rank, min(self.user_item_matrix.shape) - 1), 1)
+        svd = TruncatedSVD(n_components=rank, algorithm='randomized', random_state=0)
+        svd.fit(self.user_item_matrix)
+        self.item_factors = np.ascontiguousarray(svd.components_.T * svd.singular_values_, dtype=np.float32)
+        logger.info(f"物品隐因子计算完成，秩: {rank}，解释方差比例: {svd.explained_variance_ratio_.sum():.4f}，"
+                    f"耗时 {time.perf_counter() - start:.2f}s")
+
+    def _item_vectors(self):
+        """近邻计算使用的L2归一化物品向量：隐因子模式下为隐因子，否则为评分矩阵的列"""
+        if self.factor_rank:
+            return normalize(self.item_factors, norm='l2')
+        return self._normalized_item_vectors()
+
+    def _compute_item_similarity(self, block_size: int = 512):
+        """计算物品近邻索引 - 分块Top-K版本"""
         try:
-            logger.info("开始计算物品相似度矩阵...")
-            
-            # 转置矩阵，使得行表示游戏，列表示用户
-            item_user_matrix = self.user_item_matrix.T
-            n_items = item_user_matrix.shape[0]
-            
-            # 对于大型矩阵，使用分块计算以节省内存
-            if use_chunking and n_items > chunk_size:
-                logger.info(f"使用分块计算，块大小: {chunk_size}")
-                
-                # 初始化相似度矩阵
-                self.item_similarity_matrix = np.zeros((n_items, n_items), dtype=np.float32)
-                
-                # 分块计算相似度
-                for i in range(0, n_items, chunk_size):
-                    end_i = min(i + chunk_size, n_items)
-                    chunk_i = item_user_matrix[i:end_i]
-                    
-                    # 计算当前块与所有项目的相似度
-                    similarities = cosine_similarity(chunk_i, item_user_matrix)
-                    self.item_similarity_matrix[i:end_i] = similarities
-                    
-                    if i % (chunk_size * 10) == 0:
-                        logger.info(f"已处理 {i}/{n_items} 个游戏")
-                
-                logger.info("分块计算完成")
-            else:
-                # 小型矩阵直接计算
-                self.item_similarity_matrix = cosine_similarity(item_user_matrix)
-                self.item_similarity_matrix = self.item_similarity_matrix.astype(np.float32)
-            
-            # 将对角线设为0（游戏与自己的相似度不考虑）
-            np.fill_diagonal(self.item_similarity_matrix, 0)
-            
-            logger.info(f"物品相似度矩阵计算完成，维度: {self.item_similarity_matrix.shape}")
-            
+            logger.info(f"开始计算物品近邻索引 (K={self.neighbor_k}, 最小相似度={self.min_similarity}, "
+                        f"隐因子秩={self.factor_rank})...")
+
+            self.item_norms = np.sqrt(
+                np.asarray(self.user_item_matrix.multiply(self.user_item_matrix).sum(axis=0)).ravel()
+            ).astype(np.float32)
+            if self.factor_rank:
+                self._compute_item_factors()
+
+            self.item_neighbors = ItemNeighborIndex.build(
+                self._item_vectors(),
+                k=self.neighbor_k,
+                min_similarity=self.min_similarity,
+                block_size=block_size
+            )
+
+            n_items = self.item_neighbors.n_items
+            dense_mb = n_items * n_items * 4 / 1024 ** 2
+            logger.info(f"物品近邻索引计算完成，物品数: {n_items}, 近邻数: {len(self.item_neighbors.indices):,}")
+            logger.info(f"近邻索引内存: {self.item_neighbors.nbytes / 1024 ** 2:.1f} MB "
+                        f"(稠密相似度矩阵需 {dense_mb:.1f} MB)")
+
         except Exception as e:
             logger.error(f"计算物品相似度失败: {e}")
             raise
     
     def _compute_game_statistics(self):
-        """计算游戏统计信息"""
+        """由每个游戏的评分总和与评分数计算平均评分和流行度排序"""
         try:
-            # 计算每个游戏的平均评分
-            game_stats = self.user_ratings.groupby('BGGId').agg({
-                'Rating': ['mean', 'count']
-            }).round(2)
-            
-            game_stats.columns = ['avg_rating', 'rating_count']
-            
-            for game_id, stats in game_stats.iterrows():
-                self.avg_ratings[game_id] = {
-                    'avg_rating': stats['avg_rating'],
-                    'rating_count': stats['rating_count']
-                }
-            
-            # 获取最受欢迎的游戏
-            self.popular_games = game_stats.sort_values('rating_count', ascending=False).head(100).index.tolist()
-            
-            logger.info(f"计算了 {len(self.avg_ratings)} 个游戏的统计信息")
-            
+            counts = self.item_rating_count
+            n_items = len(counts)
+
+            # 总和是精确的整数（见 _rating_totals），与累加顺序无关，结果与按游戏分组求平均一致
+            averages = np.divide(self.item_rating_total / RATING_SCALE, counts,
+                                 out=np.zeros(n_items, dtype=np.float64), where=counts > 0)
+            self.item_avg_rating = np.round(averages, 2)
+
+            # 最受欢迎的游戏：按游戏ID排序后再按评分数降序，并列时的顺序与按ID分组后排序一致
+            game_ids = np.array([self.idx_to_game[idx] for idx in range(n_items)], dtype=np.int64)
+            by_id = np.argsort(game_ids, kind='stable')
+            popular = by_id[descending_order(counts[by_id].astype(np.float64))[:100]]
+            self.popular_games = game_ids[popular].tolist()
+
+            logger.info(f"计算了 {n_items} 个游戏的统计信息")
+
         except Exception as e:
             logger.error(f"计算游戏统计信息失败: {e}")
             raise
-    
+
+    def add_ratings(self, df_delta: pd.DataFrame, block_size: int = 512, tolerance: float = 1e-3) -> Dict[str, int]:
+        """增量合并新评分（BGGId, Rating, Username 三列），不重新计算全部物品相似度
+
+        - 同一用户对同一游戏的评分以增量中的最后一条为准，覆盖已有评分；
+        - 新用户、新游戏按加载时的 min_user_ratings / min_game_ratings 在增量内计数，达到阈值才加入；
+          加载时被过滤掉的历史评分没有保留，只靠这些历史评分才达到阈值的用户和游戏要等下次完整重建才会加入；
+        - 只重新计算评分发生变化的游戏的范数和近邻，其余游戏只合并与这些游戏之间的相似度，
+          近邻表与完整重建的误差不超过 tolerance（见 ItemNeighborIndex.update，tolerance=0 时只有浮点误差，
+          同分近邻的先后顺序可能不同）；
+        - 隐因子模式下任何评分变化都会影响全部物品的隐因子，因此重新分解并重建近邻索引。
+        """
+        if not self.is_loaded:
+            raise ValueError("协同过滤系统未加载，无法增量更新")
+
+        try:
+            start = time.perf_counter()
+            delta = df_delta[['BGGId', 'Rating', 'Username']].dropna()
+            delta = delta[delta['Rating'] > 0]
+            delta = delta.astype({'BGGId': np.int64, 'Rating': np.float64, 'Username': str})
+            delta = delta[~delta.duplicated(['Username', 'BGGId'], keep='last')]
+
+            # 新用户和新游戏按增量内的评分数过滤（与加载时一样，计数在过滤之前进行）
+            known_users = delta['Username'].isin(self.user_to_idx.keys())
+            known_games = delta['BGGId'].isin(self.game_to_idx.keys())
+            user_counts = delta['Username'].map(delta['Username'].value_counts())
+            game_counts = delta['BGGId'].map(delta['BGGId'].value_counts())
+            delta = delta[(known_users | (user_counts >= self.min_user_ratings)) &
+                          (known_games | (game_counts >= self.min_game_ratings))]
+
+            new_users = [user for user in pd.unique(delta['Username']) if user not in self.user_to_idx]
+            new_games = [game for game in pd.unique(delta['BGGId']).tolist() if game not in self.game_to_idx]
+            for user in new_users:
+                self.user_to_idx[user] = len(self.user_to_idx)
+                self.idx_to_user[self.user_to_idx[user]] = user
+            for game in new_games:
+                self.game_to_idx[game] = len(self.game_to_idx)
+                self.idx_to_game[self.game_to_idx[game]] = game
+
+            user_indices = delta['Username'].map(self.user_to_idx).to_numpy(np.int32)
+            game_indices = delta['BGGId'].map(self.game_to_idx).to_numpy(np.int32)
+            ratings = delta['Rating'].to_numpy(np.float64)
+            n_users, n_items = len(self.user_to_idx), len(self.game_to_idx)
+
+            # 更新评分矩阵：扩展维度后去掉被覆盖的评分，再加上增量评分
+            old = self.user_item_matrix
+            indptr = np.concatenate([old.indptr, np.full(n_users - old.shape[0], old.indptr[-1], dtype=old.indptr.dtype)])
+            matrix = csr_matrix((old.data, old.indices, indptr), shape=(n_users, n_items))
+            delta_matrix = csr_matrix((ratings.astype(np.float32), (user_indices, game_indices)),
+                                      shape=(n_users, n_items), dtype=np.float32)
+            overridden = matrix.multiply(delta_matrix.astype(bool)).tocsr()
+            overridden.eliminate_zeros()
+
+            # 统计信息：减去被覆盖的评分，再加上增量评分。被覆盖的历史评分只在矩阵中以 float32 保存，
+            # float32 的误差远小于 1/RATING_SCALE，换算为整数单位后与加载时累加的值相同
+            counts = np.zeros(n_items, dtype=np.int64)
+            counts[:len(self.item_rating_count)] = self.item_rating_count
+            totals = np.zeros(n_items, dtype=np.int64)
+            totals[:len(self.item_rating_total)] = self.item_rating_total
+            counts -= np.bincount(overridden.indices, minlength=n_items)
+            totals -= _rating_totals(overridden.indices, overridden.data.astype(np.float64), n_items)
+            counts += np.bincount(game_indices, minlength=n_items)
+            totals += _rating_totals(game_indices, ratings, n_items)
+            self.item_rating_count, self.item_rating_total = counts, totals
+
+            matrix = (matrix - overridden + delta_matrix).tocsr()
+            matrix.eliminate_zeros()
+            self.user_item_matrix = matrix.astype(np.float32)
+
+            # 只重新计算变化列的范数
+            changed = np.unique(game_indices)
+            item_norms = np.zeros(n_items, dtype=np.float32)
+            item_norms[:len(self.item_norms)] = self.item_norms
+            changed_columns = self.user_item_matrix[:, changed]
+            item_norms[changed] = np.sqrt(
+                np.asarray(changed_columns.multiply(changed_columns).sum(axis=0)).ravel()
+            )
+            self.item_norms = item_norms
+
+            if self.factor_rank:
+                self._compute_item_factors()
+                self.item_neighbors = ItemNeighborIndex.build(self._item_vectors(), k=self.neighbor_k,
+                                                              min_similarity=self.min_similarity,
+                                                              block_size=block_size)
+                rescanned = n_items
+            else:
+                self.item_neighbors, rescanned = self.item_neighbors.update(
+                    self._normalized_item_vectors(), changed, block_size=block_size, tolerance=tolerance
+                )
+
+            # 平均评分和流行度排序由更新后的总和与评分数整体重新计算
+            self._compute_game_statistics()
+
+            summary = {'ratings': len(delta), 'new_users': len(new_users), 'new_games': len(new_games),
+                       'changed_games': len(changed), 'rescanned_games': rescanned}
+            logger.info(f"增量合并评分完成，耗时 {time.perf_counter() - start:.2f}s: {summary}")
+            return summary
+
+        except Exception as e:
+            logger.error(f"增量合并评分失败: {e}")
+            raise
+
     def get_collaborative_recommendations(self, game_ids: List[int], N: int = 10) -> List[Dict[str, Any]]:
-        """基于协同过滤获取推荐"""
+        """基于协同过滤获取推荐
+
+        每个输入游戏取前 N*2 个近邻，近邻索引只保存 neighbor_k 个，N*2 超过 neighbor_k 时按 neighbor_k 截断
+        （默认的 CF_NEIGHBOR_K 覆盖了应用中所有请求的 N）。
+        """
         if not self.is_loaded:
             logger.warning("协同过滤系统未加载，返回空推荐")
             return []
         
         try:
-            recommendations = []
-            similarity_scores = {}
-            
-            # 对每个输入游戏，找到相似的游戏
-            for game_id in game_ids:
-                if game_id not in self.game_to_idx:
-                    continue
-                
-                game_idx = self.game_to_idx[game_id]
-                similarities = self.item_similarity_matrix[game_idx]
-                
-                # 获取最相似的游戏
-                similar_indices = np.argsort(similarities)[::-1][:N*2]  # 取更多候选
-                
-                for idx in similar_indices:
-                    similar_game_id = self.idx_to_game[idx]
-                    similarity_score = similarities[idx]
-                    
-                    if similarity_score > 0.1:  # 设置最小相似度阈值
-                        if similar_game_id not in similarity_scores:
-                            similarity_scores[similar_game_id] = []
-                        similarity_scores[similar_game_id].append(similarity_score)
+            seeds = np.array([self.game_to_idx[game_id] for game_id in game_ids
+                              if game_id in self.game_to_idx], dtype=np.int64)
+            if len(seeds) == 0:
+                logger.info("协同过滤生成了 0 个推荐")
+                return []
+
+            # 一次性收集所有输入游戏的前 N*2 个近邻（近邻已按相似度降序存储）
+            indptr = self.item_neighbors.indptr
+            starts = indptr[seeds].astype(np.int64)
+            lengths = np.minimum(indptr[seeds + 1] - starts, N * 2)
+            offsets = np.cumsum(lengths) - lengths
+            positions = np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths)
+            candidates = self.item_neighbors.indices[positions]
+            scores = self.item_neighbors.scores[positions]
+
+            # 设置最小相似度阈值
+            keep = scores > 0.1
+            candidates, scores = candidates[keep], scores[keep]
+
+            # 按候选游戏聚合，对贡献了该候选的输入游戏取平均相似度；
+            # 候选按首次出现的先后排列，保证相似度并列时的顺序与逐个累加时一致
+            unique, first, inverse, counts = np.unique(candidates, return_index=True,
+                                                       return_inverse=True, return_counts=True)
+            grouped = scores[np.argsort(inverse, kind='stable')]
+            group_starts = np.cumsum(counts) - counts
+            # 贡献次数相同的候选排成一个矩阵按行求和（循环次数不超过输入游戏数），
+            # 与逐个候选 np.mean 的 float32 累加顺序一致，结果逐位相同
+            sums = np.empty(len(unique), dtype=scores.dtype)
+            for count in np.unique(counts):
+                rows = np.flatnonzero(counts == count)
+                sums[rows] = grouped[group_starts[rows, None] + np.arange(count)].sum(axis=1)
+            appearance = np.argsort(first, kind='stable')
+            items = unique[appearance]
+            avg_similarity = sums[appearance] / counts[appearance].astype(np.float32)
+
+            # 按相似度排序，只为前 N 个候选构造结果
+            top = np.argsort(-avg_similarity, kind='stable')[:N]
+            recommendations = [{
+                'id': int(self.idx_to_game[idx]),
+                'similarity_score': float(similarity),
+                'avg_rating': float(self.item_avg_rating[idx]),
+                'rating_count': int(self.item_rating_count[idx]),
+                'collaborative_score': float(similarity * 100)
+            } for idx, similarity in zip(items[top], avg_similarity[top])]
             
-            # 计算平均相似度分数
-            for game_id, scores in similarity_scores.items():
-                avg_similarity = np.mean(scores)
-                game_stats = self.avg_ratings.get(game_id, {'avg_rating': 0, 'rating_count': 0})
-                
-                recommendations.append({
-                    'id': int(game_id),
-                    'similarity_score': float(avg_similarity),
-                    'avg_rating': float(game_stats['avg_rating']),
-                    'rating_count': int(game_stats['rating_count']),
-                    'collaborative_score': float(avg_similarity * 100)
-                })
-            
-            # 按相似度排序
-            recommendations.sort(key=lambda x: x['similarity_score'], reverse=True)
-            
-            logger.info(f"协同过滤生成了 {len(recommendations[:N])} 个推荐")
-            return recommendations[:N]
+            logger.info(f"协同过滤生成了 {len(recommendations)} 个推荐")
+            return recommendations
             
         except Exception as e:
             logger.error(f"协同过滤推荐失败: {e}")
             return []
     
+    def save_snapshot(self, snapshot_dir: str) -> Dict[str, Any]:
+        """将协同过滤模型写入快照目录，返回写入清单的元信息"""
+        n_items = len(self.idx_to_game)
+        game_ids = np.array([self.idx_to_game[i] for i in range(n_items)], dtype=np.int64)
+
+        info = {
+            'user_item_matrix': _save_csr(snapshot_dir, 'cf_user_item', self.user_item_matrix),
+            'neighbor_k': self.item_neighbors.k,
+            'min_similarity': self.item_neighbors.min_similarity,
+            'min_user_ratings': self.min_user_ratings,
+            'min_game_ratings': self.min_game_ratings,
+            'factor_rank': self.factor_rank,
+        }
+        np.save(os.path.join(snapshot_dir, 'cf_game_ids.npy'), game_ids)
+        if self.item_factors is not None:
+            np.save(os.path.join(snapshot_dir, 'cf_item_factors.npy'), self.item_factors)
+        _save_string_table(snapshot_dir, 'cf_usernames',
+                           [self.idx_to_user[i] for i in range(len(self.idx_to_user))])
+        np.save(os.path.join(snapshot_dir, 'cf_neighbor_indptr.npy'), self.item_neighbors.indptr)
+        np.save(os.path.join(snapshot_dir, 'cf_neighbor_indices.npy'), self.item_neighbors.indices)
+        np.save(os.path.join(snapshot_dir, 'cf_neighbor_scores.npy'), self.item_neighbors.scores)
+        np.save(os.path.join(snapshot_dir, 'cf_item_norms.npy'), self.item_norms)
+        np.save(os.path.join(snapshot_dir, 'cf_avg_rating.npy'), np.asarray(self.item_avg_rating, dtype=np.float64))
+        np.save(os.path.join(snapshot_dir, 'cf_rating_count.npy'), np.asarray(self.item_rating_count, dtype=np.int64))
+        np.save(os.path.join(snapshot_dir, 'cf_rating_total.npy'), np.asarray(self.item_rating_total, dtype=np.int64))
+        np.save(os.path.join(snapshot_dir, 'cf_popular_games.npy'), np.array(self.popular_games, dtype=np.int64))
+        return info
+
+    def load_snapshot(self, snapshot_dir: str, info: Dict[str, Any], mmap_mode: Optional[str] = 'r'):
+        """从快照目录恢复协同过滤模型，跳过评分CSV解析和相似度计算"""
+        try:
+            def load(name):
+                return np.load(os.path.join(snapshot_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+
+            self.user_item_matrix = _load_csr(snapshot_dir, 'cf_user_item', info['user_item_matrix'], mmap_mode)
+            self.item_neighbors = ItemNeighborIndex(
+                load('cf_neighbor_indptr'), load('cf_neighbor_indices'), load('cf_neighbor_scores'),
+                info['neighbor_k'], info['min_similarity']
+            )
+            self.neighbor_k = info['neighbor_k']
+            self.min_similarity = info['min_similarity']
+            self.min_user_ratings = info.get('min_user_ratings', self.min_user_ratings)
+            self.min_game_ratings = info.get('min_game_ratings', self.min_game_ratings)
+            self.item_norms = load('cf_item_norms')
+            self.factor_rank = info.get('factor_rank')
+            self.item_factors = load('cf_item_factors') if self.factor_rank else None
+
+            game_ids = np.load(os.path.join(snapshot_dir, 'cf_game_ids.npy')).tolist()
+            self.game_to_idx = {game: idx for idx, game in enumerate(game_ids)}
+            self.idx_to_game = {idx: game for game, idx in self.game_to_idx.items()}
+            usernames = _load_string_table(snapshot_dir, 'cf_usernames')
+            self.user_to_idx = {user: idx for idx, user in enumerate(usernames)}
+            self.idx_to_user = {idx: user for user, idx in self.user_to_idx.items()}
+
+            self.item_avg_rating = load('cf_avg_rating')
+            self.item_rating_count = load('cf_rating_count')
+            self.item_rating_total = load('cf_rating_total')
+            self.popular_games = np.load(os.path.join(snapshot_dir, 'cf_popular_games.npy')).tolist()
+            self.user_ratings = None
+
+            self.is_loaded = True
+            logger.info(f"从快照加载协同过滤模型完成，用户: {len(usernames)}, 游戏: {len(game_ids)}")
+
+        except Exception as e:
+            logger.error(f"加载协同过滤快照失败: {e}")
+            self.is_loaded = False
+            raise
+
     def get_popular_games(self, N: int = 10) -> List[int]:
         """获取最受欢迎的游戏"""
         if not self.is_loaded:
@@ -294,17 +1315,184 @@ class CollaborativeFilteringRecommender:
         return self.popular_games[:N]
 
 
+class RecommendationCache:
+    """推荐结果缓存：按规范化偏好哈希索引的线程安全 LRU + TTL 缓存
+
+    向导的答案空间是离散的（人数/时长/年龄/复杂度各4档 + 8个机制大类），
+    大量用户会提交完全相同的偏好，命中时直接复用已打分的 RankedRecommendations，不进入打分流程。
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(preferences: Dict[str, Any]) -> str:
+        """偏好字典按键排序序列化后取哈希；列表保持原顺序（经典游戏的顺序会影响结果）"""
+        payload = json.dumps(preferences, sort_keys=True, ensure_ascii=False,
+                             separators=(',', ':'), default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional['RankedRecommendations']:
+        """命中时返回缓存的排序结果，未命中或已过期返回 None"""
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if self.ttl and time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: 'RankedRecommendations'):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+class RankedRecommendations:
+    """一次打分得到的排序候选，可切片出主推荐、更多匹配和分页结果
+
+    偏好向量、内容相似度、经典游戏融合、加权分数和候选排序只计算一次，
+    之后只保留前 depth×4 个候选及其分数。top(N) 与单独调用
+    get_enhanced_recommendations(preferences, N) 的结果完全一致：
+    候选按 (分数, 下标) 全序排列，前 N×4 个候选恰好是更深候选列表的前缀；
+    协同过滤和分层筛选仍按各自的 N 计算，并按 N 缓存。
+
+    同一对象会被结果缓存在多个请求线程间共享：加深重新打分和按 N 的结果缓存都在锁内进行，
+    重新打分失败只影响本次调用，不会改动已缓存的候选。
+    """
+
+    DEFAULT_DEPTH = 64
+
+    def __init__(self, recommender: 'EnhancedRecommendationSystem', preferences: Dict[str, Any],
+                 similarity_scores: Optional[np.ndarray] = None, depth: int = DEFAULT_DEPTH):
+        self.recommender = recommender
+        self.preferences = preferences
+        self._lock = threading.Lock()
+        self._results = {}
+        # (depth, (已选游戏ID, 候选下标, 内容相似度, 加权分数))，整体替换
+        self._state = (depth, self._score(depth, similarity_scores))
+        self.ok = self._state[1] is not None
+
+    @property
+    def depth(self) -> int:
+        return self._state[0]
+
+    def _score(self, depth: int, similarity_scores: Optional[np.ndarray] = None) -> Optional[Tuple]:
+        """按给定深度打分，失败时返回None"""
+        try:
+            if similarity_scores is None and self.recommender.content_index is not None:
+                # 近似检索：只对检索到的候选精确打分
+                return self.recommender._score_candidates_approximate(self.preferences, depth)
+            if similarity_scores is None:
+                # 构建用户偏好向量，计算相似度（与批量接口共用同一计算路径，保证结果一致）
+                user_vector = self.recommender.build_preference_vector(self.preferences)
+                similarity_scores = self.recommender._content_similarity(csr_matrix(user_vector))[0]
+            return self.recommender._score_candidates(self.preferences, similarity_scores, depth)
+        except Exception as e:
+            logger.error(f"获取推荐时出错: {e}")
+            return None
+
+    def top(self, N: int) -> List[Dict[str, Any]]:
+        """前 N 个推荐（返回副本）"""
+        if not self.ok or N <= 0:
+            return []
+
+        with self._lock:
+            depth, scored = self._state
+            if N > depth:
+                # 候选深度不足时按更大的深度重新打分，成功后再替换候选和结果缓存
+                scored = self._score(N)
+                if scored is None:
+                    return []
+                self._state = (N, scored)
+                self._results = {}
+
+            results = self._results.get(N)
+            if results is None:
+                selected_game_ids, candidates, candidate_similarity, candidate_weighted = scored
+                try:
+                    results = self.recommender._select_recommendations(
+                        selected_game_ids, candidates[:N * 4], candidate_similarity[:N * 4],
+                        candidate_weighted[:N * 4], N
+                    )
+                except Exception as e:
+                    logger.error(f"获取推荐时出错: {e}")
+                    return []
+                self._results[N] = results
+        return [dict(item) for item in results]
+
+    def page(self, offset: int, limit: int) -> List[Dict[str, Any]]:
+        """top(offset + limit) 中跳过前 offset 个之后的结果"""
+        return self.top(offset + limit)[offset:]
+
+
 class EnhancedRecommendationSystem:
     """增强版桌游推荐系统"""
 
-    def __init__(self):
+    def __init__(self, cache_size: int = 1024, cache_ttl: float = 3600.0,
+                 content_index: Optional[str] = None, content_candidates: int = CONTENT_CANDIDATES,
+                 cf_factor_rank: Optional[int] = None):
         self.df = None
+        self.catalog = None
+        self.name_index = None
         self.feature_matrix = None
+        self.feature_matrix_normalized = None
+        self.feature_matrix_normalized_t = None
         self.mlb_mechanics = None
         self.mlb_domains = None
         self.scaler = None
+        self.numerical_cols = ['Min Players', 'Max Players', 'Play Time', 'Min Age', 'Complexity']
+        self.source_files = {}
         self.mechanism_mapping = self._create_mechanism_mapping()
-        self.collaborative_recommender = CollaborativeFilteringRecommender()
+        self.collaborative_recommender = CollaborativeFilteringRecommender(factor_rank=cf_factor_rank)
+        self.result_cache = RecommendationCache(max_size=cache_size, ttl=cache_ttl)
+        # 内容打分的近似候选检索（CONTENT_INDEXES 中的名称），为 None 时对全部游戏精确打分
+        self.content_index_type = content_index
+        self.content_candidates = content_candidates
+        self.content_index = None
+        self.prior_candidates = None
+        # 经典游戏的内容相似度行：行号 -> classic_similarity 中的位置
+        self.classic_positions = {}
+        self.classic_similarity = None
 
     # 在 enhanced_recommendation.py 的 _create_mechanism_mapping 方法中更新为：
 
@@ -354,9 +1542,17 @@ class EnhancedRecommendationSystem:
         }
 
 
-    def load_and_preprocess_data(self, filepath: str, user_ratings_filepath: Optional[str] = None):
-        """加载和预处理数据"""
+    def load_and_preprocess_data(self, filepath: str, user_ratings_filepath: Optional[str] = None,
+                                 ratings_cache_path: Optional[str] = None):
+        """加载和预处理数据
+
+        ratings_cache_path 为评分CSV对应的列式缓存，与CSV校验和一致时直接读取，否则重新解析CSV并更新缓存。
+        """
         try:
+            self.source_files = {'games': filepath}
+            if user_ratings_filepath:
+                self.source_files['ratings'] = user_ratings_filepath
+
             # 尝试不同编码
             for encoding in ['latin1', 'windows-1252', 'utf-8']:
                 try:
@@ -376,7 +1572,8 @@ class EnhancedRecommendationSystem:
             # 加载协同过滤数据
             if user_ratings_filepath:
                 try:
-                    self.collaborative_recommender.load_user_ratings(user_ratings_filepath)
+                    self.collaborative_recommender.load_user_ratings(user_ratings_filepath,
+                                                                     cache_path=ratings_cache_path)
                     logger.info("协同过滤数据加载成功")
                 except Exception as e:
                     logger.warning(f"协同过滤数据加载失败: {e}")
@@ -401,7 +1598,7 @@ class EnhancedRecommendationSystem:
             domains_encoded = self.mlb_domains.fit_transform(self.df['Domains'])
 
             # 标准化数值特征
-            numerical_cols = ['Min Players', 'Max Players', 'Play Time', 'Min Age', 'Complexity']
+            numerical_cols = self.numerical_cols
 
             # 填充缺失值
             for col in numerical_cols:
@@ -415,12 +1612,215 @@ class EnhancedRecommendationSystem:
             # 组合特征矩阵
             self.feature_matrix = hstack([mechanics_encoded, domains_encoded, numerical_sparse])
 
-            logger.info(f"数据预处理完成，共 {len(self.df)} 个游戏，特征维度 {self.feature_matrix.shape[1]}")
+            # 服务期只保留列式游戏目录，释放 DataFrame
+            self.catalog = GameCatalog.from_dataframe(self.df)
+            self.df = None
+            self._prepare_scoring_structures()
+
+            logger.info(f"数据预处理完成，共 {len(self.catalog)} 个游戏，特征维度 {self.feature_matrix.shape[1]}")
 
         except Exception as e:
             logger.error(f"数据加载失败: {e}")
             raise
 
+    def save_snapshot(self, snapshot_dir: str = DEFAULT_SNAPSHOT_DIR):
+        """将预处理后的模型写入快照目录
+
+        快照由若干 .npy 文件和一个 manifest.json 组成，数组均可内存映射读取。
+        先写入临时目录再整体替换，避免进程读到写了一半的快照。
+        """
+        try:
+            tmp_dir = snapshot_dir.rstrip(os.sep) + '.tmp'
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+
+            cf = self.collaborative_recommender
+            manifest = {
+                'version': SNAPSHOT_VERSION,
+                'created_at': datetime.now().isoformat(),
+                'sources': {
+                    role: file_checksum(path) for role, path in self.source_files.items()
+                },
+                'catalog': self.catalog.save(tmp_dir),
+                'feature_matrix': _save_csr(tmp_dir, 'feature', self.feature_matrix),
+                'scaler': self._save_scaler(tmp_dir),
+                'collaborative': cf.save_snapshot(tmp_dir) if cf.is_loaded else None,
+            }
+            _save_string_table(tmp_dir, 'mechanics_classes', self.mlb_mechanics.classes_)
+            _save_string_table(tmp_dir, 'domains_classes', self.mlb_domains.classes_)
+
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+            os.replace(tmp_dir, snapshot_dir)
+            logger.info(f"模型快照已写入 {snapshot_dir}")
+
+        except Exception as e:
+            logger.error(f"写入模型快照失败: {e}")
+            raise
+
+    def _save_scaler(self, snapshot_dir: str) -> Dict[str, Any]:
+        """保存 MinMaxScaler 的拟合参数"""
+        params = np.vstack([self.scaler.data_min_, self.scaler.data_max_, self.scaler.data_range_,
+                            self.scaler.scale_, self.scaler.min_])
+        np.save(os.path.join(snapshot_dir, 'scaler_params.npy'), params)
+        return {
+            'columns': list(self.numerical_cols),
+            'feature_range': list(self.scaler.feature_range),
+            'n_samples_seen': int(self.scaler.n_samples_seen_),
+        }
+
+    def _load_scaler(self, snapshot_dir: str, info: Dict[str, Any]) -> MinMaxScaler:
+        """根据快照参数恢复已拟合的 MinMaxScaler"""
+        params = np.load(os.path.join(snapshot_dir, 'scaler_params.npy'))
+        scaler = MinMaxScaler(feature_range=tuple(info['feature_range']))
+        scaler.data_min_, scaler.data_max_, scaler.data_range_, scaler.scale_, scaler.min_ = params
+        scaler.n_samples_seen_ = info['n_samples_seen']
+        scaler.n_features_in_ = len(info['columns'])
+        scaler.feature_names_in_ = np.array(info['columns'], dtype=object)
+        return scaler
+
+    @staticmethod
+    def snapshot_is_valid(snapshot_dir: str, filepath: str,
+                          user_ratings_filepath: Optional[str] = None,
+                          cf_factor_rank: Optional[int] = None) -> bool:
+        """检查快照是否存在、版本一致、协同过滤隐因子秩相同，且与当前源数据文件的校验和匹配"""
+        manifest_path = os.path.join(snapshot_dir, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return False
+
+        try:
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取快照清单失败: {e}")
+            return False
+
+        if manifest.get('version') != SNAPSHOT_VERSION:
+            logger.info(f"快照版本 {manifest.get('version')} 与当前版本 {SNAPSHOT_VERSION} 不一致")
+            return False
+
+        sources = {'games': filepath}
+        if user_ratings_filepath:
+            sources['ratings'] = user_ratings_filepath
+        if set(sources) != set(manifest.get('sources', {})):
+            logger.info("快照的数据源与当前配置不一致")
+            return False
+
+        collaborative = manifest.get('collaborative')
+        if collaborative and collaborative.get('factor_rank') != cf_factor_rank:
+            logger.info(f"快照的隐因子秩 {collaborative.get('factor_rank')} 与当前配置 {cf_factor_rank} 不一致")
+            return False
+        if collaborative and collaborative.get('neighbor_k') != CF_NEIGHBOR_K:
+            logger.info(f"快照的近邻数 {collaborative.get('neighbor_k')} 与当前配置 {CF_NEIGHBOR_K} 不一致")
+            return False
+
+        for role, path in sources.items():
+            if file_checksum(path) != manifest['sources'][role]:
+                logger.info(f"源数据文件 {path} 已变化，快照失效")
+                return False
+
+        return True
+
+    def load_snapshot(self, snapshot_dir: str = DEFAULT_SNAPSHOT_DIR, mmap_mode: Optional[str] = 'r'):
+        """从快照目录加载模型，跳过所有CSV解析和特征编码"""
+        try:
+            with open(os.path.join(snapshot_dir, 'manifest.json'), encoding='utf-8') as f:
+                manifest = json.load(f)
+
+            if manifest['version'] != SNAPSHOT_VERSION:
+                raise ValueError(f"不支持的快照版本: {manifest['version']}")
+
+            self.catalog = GameCatalog.load(snapshot_dir, manifest['catalog'], mmap_mode)
+            self.df = None
+
+            self.mlb_mechanics = MultiLabelBinarizer(sparse_output=True)
+            self.mlb_mechanics.classes_ = np.array(
+                _load_string_table(snapshot_dir, 'mechanics_classes'), dtype=object)
+            self.mlb_domains = MultiLabelBinarizer(sparse_output=True)
+            self.mlb_domains.classes_ = np.array(
+                _load_string_table(snapshot_dir, 'domains_classes'), dtype=object)
+
+            self.numerical_cols = manifest['scaler']['columns']
+            self.scaler = self._load_scaler(snapshot_dir, manifest['scaler'])
+            self.feature_matrix = _load_csr(snapshot_dir, 'feature', manifest['feature_matrix'], mmap_mode)
+
+            self._prepare_scoring_structures()
+
+            if manifest['collaborative']:
+                self.collaborative_recommender.load_snapshot(snapshot_dir, manifest['collaborative'], mmap_mode)
+
+            logger.info(f"从快照加载完成，共 {len(self.catalog)} 个游戏，特征维度 {self.feature_matrix.shape[1]}")
+
+        except Exception as e:
+            logger.error(f"加载模型快照失败: {e}")
+            raise
+
+    def _prepare_scoring_structures(self):
+        """数据加载后预计算请求路径上复用的只读结构"""
+        # 模型重新加载后旧的推荐结果全部失效
+        self.result_cache.clear()
+
+        # 特征矩阵按行L2归一化一次，余弦相似度即退化为普通的稀疏点积
+        self.feature_matrix_normalized = normalize(csr_matrix(self.feature_matrix), norm='l2')
+        self.feature_matrix_normalized_t = self.feature_matrix_normalized.T.tocsr()
+
+        # 评分和评分人数在两次数据加载之间不变，归一化结果只计算一次
+        ratings = self.catalog.column('Rating Average')
+        users_rated = self.catalog.column('Users Rated').astype(np.float64)
+        self.rating_normalized = self._min_max_normalize(np.nan_to_num(ratings, nan=0.0))
+        self.popularity_normalized = self._min_max_normalize(np.nan_to_num(users_rated, nan=0.0))
+        self._static_prior_cache = {}
+
+        # 候选筛选掩码：数据完整，且评分人数>=500（第一轮）/>=100（第二轮），缺失值不满足任一门槛
+        complete = ~np.isnan(ratings)
+        self.popular_mask = complete & (users_rated >= 500)
+        self.eligible_mask = complete & (users_rated >= 100)
+
+        # 名称搜索索引：经典游戏选择和自动补全共用
+        self.name_index = GameNameIndex(self.catalog.names())
+
+        # 经典游戏与全部游戏的相似度行，选择经典游戏的请求直接复用
+        classic_rows = [row for row in dict.fromkeys(self.catalog.rows_of(CLASSIC_GAME_IDS).tolist()) if row >= 0]
+        self.classic_positions = {row: position for position, row in enumerate(classic_rows)}
+        self.classic_similarity = (self._content_similarity(self.feature_matrix_normalized[classic_rows])
+                                   if classic_rows else np.zeros((0, len(self.catalog))))
+
+        self._build_content_index()
+
+    def _build_content_index(self):
+        """按 content_index_type 构建内容候选检索索引"""
+        self.content_index = None
+        self.prior_candidates = None
+        if not self.content_index_type:
+            return
+        start = time.perf_counter()
+        index_class = CONTENT_INDEXES[self.content_index_type]
+        self.content_index = index_class.build(self.feature_matrix_normalized)
+        # 先验分数（评分+流行度）很高的游戏即使相似度一般也可能进入前列，始终作为候选
+        self.prior_candidates = self._top_indices(self._static_prior(0.3, 0.2), PRIOR_CANDIDATES)
+        logger.info(f"内容候选检索索引({self.content_index_type})构建完成，"
+                    f"耗时 {time.perf_counter() - start:.2f} 秒，每次检索 {self.content_candidates} 个候选")
+
+    @staticmethod
+    def _min_max_normalize(values: np.ndarray) -> np.ndarray:
+        """最小-最大归一化为连续存储的 float32 数组"""
+        normalized = (values - values.min()) / (values.max() - values.min() + 1e-8)
+        return np.ascontiguousarray(normalized, dtype=np.float32)
+
+    def _static_prior(self, rating_weight: float, popularity_weight: float) -> np.ndarray:
+        """评分与流行度的加权先验分数，按权重组合缓存"""
+        key = (rating_weight, popularity_weight)
+        prior = self._static_prior_cache.get(key)
+        if prior is None:
+            prior = (np.float32(rating_weight) * self.rating_normalized +
+                     np.float32(popularity_weight) * self.popularity_normalized)
+            # 权重可按请求配置，只缓存少量组合
+            if len(self._static_prior_cache) < 8:
+                self._static_prior_cache[key] = prior
+        return prior
+
     def _categorize_mechanisms(self, mechanics: List[str]) -> List[str]:
         """将具体机制归类到大类别"""
         categories = []
@@ -479,13 +1879,10 @@ class EnhancedRecommendationSystem:
 
         game_indices = []
         for game_name in selected_games:
-            matches = self.df[self.df['Name'].str.lower().str.contains(
-                game_name.lower(), na=False, regex=False
-            )]
-            if not matches.empty:
-                # 选择最匹配的（名称最短的）
-                best_match = matches.loc[matches['Name'].str.len().idxmin()]
-                game_indices.append(self.df.index.get_loc(best_match.name))
+            # 选择最匹配的（名称最短的）
+            row = self.name_index.best_match(game_name)
+            if row >= 0:
+                game_indices.append(row)
 
         return game_indices
 
@@ -544,27 +1941,23 @@ class EnhancedRecommendationSystem:
 
     def calculate_weighted_score(self, similarity_scores: np.ndarray,
                                  rating_weight: float = 0.3,
-                                 popularity_weight: float = 0.2) -> np.ndarray:
-        """计算加权推荐分数"""
+                                 popularity_weight: float = 0.2,
+                                 rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """计算加权推荐分数
+
+        rows 不为空时 similarity_scores 只对应这些游戏行（近似检索的候选），
+        其余游戏的相似度未知，归一化时以0（特征非负时余弦相似度的下界）作为最小值。
+        """
         try:
             # 标准化相似度分数
-            similarity_normalized = (similarity_scores - similarity_scores.min()) / \
-                                    (similarity_scores.max() - similarity_scores.min() + 1e-8)
+            lowest = similarity_scores.min() if rows is None else min(similarity_scores.min(), 0.0)
+            similarity_normalized = (similarity_scores - lowest) / \
+                                    (similarity_scores.max() - lowest + 1e-8)
 
-            # 标准化评分
-            ratings = self.df['Rating Average'].fillna(0).values
-            rating_normalized = (ratings - ratings.min()) / (ratings.max() - ratings.min() + 1e-8)
-
-            # 标准化评分人数（作为流行度指标）
-            users_rated = self.df['Users Rated'].fillna(0).values
-            popularity_normalized = (users_rated - users_rated.min()) / \
-                                    (users_rated.max() - users_rated.min() + 1e-8)
-
-            # 计算加权分数
+            # 评分与流行度部分在加载时已预计算，每次请求只需加上相似度项
             similarity_weight = 1.0 - rating_weight - popularity_weight
-            weighted_scores = (similarity_weight * similarity_normalized +
-                               rating_weight * rating_normalized +
-                               popularity_weight * popularity_normalized)
+            prior = self._static_prior(rating_weight, popularity_weight)
+            weighted_scores = similarity_weight * similarity_normalized + (prior if rows is None else prior[rows])
 
             return weighted_scores
 
@@ -576,182 +1969,296 @@ class EnhancedRecommendationSystem:
                                      N: int = 12) -> List[Dict[str, Any]]:
         """获取增强推荐结果"""
         try:
-            # 构建用户偏好向量
-            user_vector = self.build_preference_vector(preferences)
-
-            # 计算相似度
-            similarity_scores = cosine_similarity(
-                user_vector.reshape(1, -1),
-                self.feature_matrix
-            ).flatten()
-
-            # 获取选中的经典游戏
-            selected_games = preferences.get('selectedGames', [])
-            selected_game_ids = []
-            if selected_games:
-                classic_indices = self.get_classic_games_by_selection(selected_games)
-                # 如果用户选择了经典游戏，增加这些游戏相似游戏的权重
-                for idx in classic_indices:
-                    game_id = self.df.iloc[idx].name
-                    selected_game_ids.append(game_id)
-                    classic_similarity = cosine_similarity(
-                        self.feature_matrix[idx:idx + 1],
-                        self.feature_matrix
-                    ).flatten()
-                    similarity_scores = 0.7 * similarity_scores + 0.3 * classic_similarity
-
-            # 计算加权分数
-            weighted_scores = self.calculate_weighted_score(similarity_scores)
-            
-            # 获取协同过滤推荐（如果可用）
-            collaborative_recommendations = {}
-            if self.collaborative_recommender.is_loaded and selected_game_ids:
+            return self.rank_recommendations(preferences).top(N)
+
+        except Exception as e:
+            logger.error(f"获取推荐时出错: {e}")
+            return []
+
+    def rank_recommendations(self, preferences: Dict[str, Any],
+                             depth: int = RankedRecommendations.DEFAULT_DEPTH) -> RankedRecommendations:
+        """对一组偏好打分一次，返回可按不同 N 切片的排序结果；相同偏好直接复用缓存"""
+        cache_key = self.result_cache.make_key(preferences)
+        ranked = self.result_cache.get(cache_key)
+        if ranked is None:
+            ranked = RankedRecommendations(self, preferences, depth=depth)
+            # 打分失败（如偏好无效）的结果不缓存
+            if ranked.ok:
+                self.result_cache.put(cache_key, ranked)
+        return ranked
+
+    def get_enhanced_recommendations_batch(self, preferences_list: List[Dict[str, Any]],
+                                           N: int = 12, block_size: int = 256) -> List[List[Dict[str, Any]]]:
+        """批量获取增强推荐结果
+
+        将所有偏好向量堆叠为一个稀疏矩阵，用一次稀疏矩阵乘法计算与全部游戏的相似度，
+        每个用户的结果与逐个调用 get_enhanced_recommendations 完全一致。
+        block_size 限制每次相似度计算的行数，避免稠密结果矩阵过大。
+        """
+        results: List[List[Dict[str, Any]]] = [[] for _ in preferences_list]
+        if not preferences_list:
+            return results
+
+        # 构建偏好向量，单个偏好出错时该用户返回空列表，与单次调用行为一致
+        vectors = []
+        valid_rows = []
+        for i, preferences in enumerate(preferences_list):
+            try:
+                vectors.append(self.build_preference_vector(preferences))
+                valid_rows.append(i)
+            except Exception as e:
+                logger.error(f"批量推荐中第 {i} 个偏好无效: {e}")
+
+        if not vectors:
+            return results
+
+        if self.content_index is not None:
+            # 启用近似检索时逐个打分，与单次调用走同一条路径
+            for row in valid_rows:
                 try:
-                    cf_recs = self.collaborative_recommender.get_collaborative_recommendations(
-                        selected_game_ids, N=N*2
-                    )
-                    collaborative_recommendations = {rec['id']: rec for rec in cf_recs}
-                    logger.info(f"获取到 {len(collaborative_recommendations)} 个协同过滤推荐")
+                    results[row] = RankedRecommendations(self, preferences_list[row], depth=N).top(N)
                 except Exception as e:
-                    logger.warning(f"协同过滤推荐失败: {e}")
-                    collaborative_recommendations = {}
+                    logger.error(f"获取推荐时出错: {e}")
+            logger.info(f"批量生成了 {len(preferences_list)} 个用户的推荐结果")
+            return results
 
-            # 获取推荐结果 - 分层筛选策略
-            top_indices = np.argsort(weighted_scores)[::-1][:N * 4]  # 获取更多候选
+        user_matrix = csr_matrix(np.vstack(vectors))
 
-            recommendations = []
-            
-            # 第一轮：优先选择评分人数>=500的游戏
-            for idx in top_indices:
-                if len(recommendations) >= N:
-                    break
+        for start in range(0, len(valid_rows), block_size):
+            block_rows = valid_rows[start:start + block_size]
+            try:
+                similarity_block = self._content_similarity(user_matrix[start:start + block_size])
+            except Exception as e:
+                logger.error(f"批量计算相似度时出错: {e}")
+                continue
 
-                game = self.df.iloc[idx]
+            for row, similarity_scores in zip(block_rows, similarity_block):
+                try:
+                    ranked = RankedRecommendations(self, preferences_list[row], similarity_scores, depth=N)
+                    results[row] = ranked.top(N)
+                except Exception as e:
+                    logger.error(f"获取推荐时出错: {e}")
 
-                # 跳过数据不完整的游戏
-                if pd.isna(game['Name']) or pd.isna(game.get('Rating Average', 0)):
+        logger.info(f"批量生成了 {len(preferences_list)} 个用户的推荐结果")
+        return results
+
+    def _content_similarity(self, user_matrix: csr_matrix) -> np.ndarray:
+        """计算一组偏好向量（每行一个）与全部游戏的余弦相似度，返回稠密矩阵"""
+        return (normalize(user_matrix, norm='l2') @ self.feature_matrix_normalized_t).toarray()
+
+    @staticmethod
+    def _top_indices(scores: np.ndarray, k: int) -> np.ndarray:
+        """部分选择得分最高的 k 个索引，按得分降序返回（同分时索引大的在前）"""
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.intp)
+        if k < len(scores):
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        else:
+            candidates = np.arange(len(scores))
+        return candidates[np.lexsort((-candidates, -scores[candidates]))]
+
+    @staticmethod
+    def _int_values(values: np.ndarray) -> List[Any]:
+        """数值列转为 Python int 列表，缺失值为 0"""
+        present = pd.notna(values)
+        return [int(v) if ok else 0 for v, ok in zip(values.tolist(), present.tolist())]
+
+    def _materialize_candidates(self, top_indices: np.ndarray, candidate_similarity: np.ndarray,
+                                candidate_weighted: np.ndarray, collaborative_recommendations: Dict[int, Dict],
+                                N: int) -> List[Dict[str, Any]]:
+        """按分层筛选规则从候选索引中选出推荐，并按列批量构建结果字典
+
+        candidate_similarity / candidate_weighted 与 top_indices 一一对应。
+        """
+        catalog = self.catalog
+        ids = catalog.ids
+
+        # 第一轮：优先选择评分人数>=500的游戏（positions 为候选列表中的位置）
+        positions = np.flatnonzero(self.popular_mask[top_indices])[:N]
+
+        # 第二轮：如果还没有足够的推荐，降低到评分人数>=100的游戏（按游戏ID去重）
+        if len(positions) < N:
+            seen_ids = set(ids[top_indices[positions]].tolist())
+            chosen = set(positions.tolist())
+            extra = []
+            for position, (idx, game_id) in enumerate(zip(top_indices.tolist(), ids[top_indices].tolist())):
+                if len(positions) + len(extra) >= N:
+                    break
+                if position in chosen or game_id in seen_ids or not self.eligible_mask[idx]:
                     continue
-                    
-                # 优先选择评分人数>=500的游戏
-                if game.get('Users Rated', 0) >= 500:
-                    game_id = int(game.name)
-                    
-                    # 计算融合分数
-                    content_score = float(weighted_scores[idx])
-                    collaborative_score = 0.0
-                    
-                    if game_id in collaborative_recommendations:
-                        collaborative_score = collaborative_recommendations[game_id]['similarity_score']
-                    
-                    # 融合分数：60% 内容过滤 + 40% 协同过滤
-                    final_score = 0.6 * content_score + 0.4 * collaborative_score
-                    
-                    rec = {
-                        'id': game_id,  # BGG ID
-                        'name': str(game['Name']),
-                        'rating': float(game.get('Rating Average', 0)),
-                        'year': int(game.get('Year Published', 0)) if pd.notna(game.get('Year Published')) else 0,
-                        'similarity_score': float(similarity_scores[idx]),
-                        'weighted_score': float(weighted_scores[idx]),
-                        'collaborative_score': float(collaborative_score),
-                        'final_score': float(final_score),
-                        'min_players': int(game.get('Min Players', 0)) if pd.notna(game.get('Min Players')) else 0,
-                        'max_players': int(game.get('Max Players', 0)) if pd.notna(game.get('Max Players')) else 0,
-                        'play_time': int(game.get('Play Time', 0)) if pd.notna(game.get('Play Time')) else 0,
-                        'min_age': int(game.get('Min Age', 0)) if pd.notna(game.get('Min Age')) else 0,
-                        'complexity': float(game.get('Complexity', 0)) if pd.notna(
-                            game.get('Complexity')) else 0,
-                        'mechanics': game.get('Mechanics', []),
-                        'domains': game.get('Domains', []),
-                        'users_rated': int(game.get('Users Rated', 0)) if pd.notna(game.get('Users Rated')) else 0
-                    }
-                    recommendations.append(rec)
-            
-            # 第二轮：如果还没有足够的推荐，降低到评分人数>=100的游戏
-            if len(recommendations) < N:
-                for idx in top_indices:
-                    if len(recommendations) >= N:
-                        break
-
-                    game = self.df.iloc[idx]
-
-                    # 跳过数据不完整的游戏
-                    if pd.isna(game['Name']) or pd.isna(game.get('Rating Average', 0)):
-                        continue
-                        
-                    # 跳过已经添加的游戏
-                    if any(rec['id'] == int(game.name) for rec in recommendations):
-                        continue
-                        
-                    # 选择评分人数>=100的游戏
-                    if game.get('Users Rated', 0) >= 100:
-                        game_id = int(game.name)
-                        
-                        # 计算融合分数
-                        content_score = float(weighted_scores[idx])
-                        collaborative_score = 0.0
-                        
-                        if game_id in collaborative_recommendations:
-                            collaborative_score = collaborative_recommendations[game_id]['similarity_score']
-                        
-                        # 融合分数：60% 内容过滤 + 40% 协同过滤
-                        final_score = 0.6 * content_score + 0.4 * collaborative_score
-                        
-                        rec = {
-                            'id': game_id,  # BGG ID
-                            'name': str(game['Name']),
-                            'rating': float(game.get('Rating Average', 0)),
-                            'year': int(game.get('Year Published', 0)) if pd.notna(game.get('Year Published')) else 0,
-                            'similarity_score': float(similarity_scores[idx]),
-                            'weighted_score': float(weighted_scores[idx]),
-                            'collaborative_score': float(collaborative_score),
-                            'final_score': float(final_score),
-                            'min_players': int(game.get('Min Players', 0)) if pd.notna(game.get('Min Players')) else 0,
-                            'max_players': int(game.get('Max Players', 0)) if pd.notna(game.get('Max Players')) else 0,
-                            'play_time': int(game.get('Play Time', 0)) if pd.notna(game.get('Play Time')) else 0,
-                            'min_age': int(game.get('Min Age', 0)) if pd.notna(game.get('Min Age')) else 0,
-                            'complexity': float(game.get('Complexity', 0)) if pd.notna(
-                                game.get('Complexity')) else 0,
-                            'mechanics': game.get('Mechanics', []),
-                            'domains': game.get('Domains', []),
-                            'users_rated': int(game.get('Users Rated', 0)) if pd.notna(game.get('Users Rated')) else 0
-                        }
-                        recommendations.append(rec)
-
-            # 按融合分数重新排序
-            recommendations.sort(key=lambda x: x.get('final_score', x.get('weighted_score', 0)), reverse=True)
-
-            logger.info(f"生成了 {len(recommendations)} 个推荐结果")
-            return recommendations
+                seen_ids.add(game_id)
+                extra.append(position)
+            positions = np.concatenate([positions, np.array(extra, dtype=positions.dtype)])
+
+        if len(positions) == 0:
+            return []
+
+        # 融合分数：60% 内容过滤 + 40% 协同过滤
+        selected = top_indices[positions]
+        game_ids = [int(game_id) for game_id in ids[selected].tolist()]
+        content_scores = candidate_weighted[positions].astype(np.float64)
+        collaborative_scores = np.array([
+            collaborative_recommendations[game_id]['similarity_score']
+            if game_id in collaborative_recommendations else 0.0
+            for game_id in game_ids
+        ], dtype=np.float64)
+        final_scores = 0.6 * content_scores + 0.4 * collaborative_scores
+
+        selected_rows = selected.tolist()
+        complexity = catalog.column('Complexity')[selected]
+        rows = zip(
+            game_ids,
+            catalog.names(selected_rows),
+            catalog.column('Rating Average')[selected].astype(np.float64).tolist(),
+            self._int_values(catalog.column('Year Published')[selected]),
+            candidate_similarity[positions].astype(np.float64).tolist(),
+            content_scores.tolist(),
+            collaborative_scores.tolist(),
+            final_scores.tolist(),
+            self._int_values(catalog.column('Min Players')[selected]),
+            self._int_values(catalog.column('Max Players')[selected]),
+            self._int_values(catalog.column('Play Time')[selected]),
+            self._int_values(catalog.column('Min Age')[selected]),
+            [float(v) if ok else 0 for v, ok in zip(complexity.tolist(), pd.notna(complexity).tolist())],
+            [catalog.list_values('Mechanics', row) for row in selected_rows],
+            [catalog.list_values('Domains', row) for row in selected_rows],
+            self._int_values(catalog.column('Users Rated')[selected]),
+        )
+        keys = ('id', 'name', 'rating', 'year', 'similarity_score', 'weighted_score', 'collaborative_score',
+                'final_score', 'min_players', 'max_players', 'play_time', 'min_age', 'complexity',
+                'mechanics', 'domains', 'users_rated')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def _score_candidates(self, preferences: Dict[str, Any], similarity_scores: np.ndarray,
+                          depth: int) -> Tuple[List[int], np.ndarray, np.ndarray, np.ndarray]:
+        """在内容相似度基础上融合经典游戏并计算加权分数
+
+        返回选中的经典游戏ID、前 depth×4 个候选下标及候选对应的相似度和加权分数。
+        """
+        # 获取选中的经典游戏
+        selected_games = preferences.get('selectedGames', [])
+        selected_game_ids = []
+        if selected_games:
+            classic_indices = self.get_classic_games_by_selection(selected_games)
+            # 如果用户选择了经典游戏，增加这些游戏相似游戏的权重
+            for idx in classic_indices:
+                game_id = int(self.catalog.ids[idx])
+                selected_game_ids.append(game_id)
+                classic_similarity = self._classic_similarity(idx)
+                similarity_scores = 0.7 * similarity_scores + 0.3 * classic_similarity
+
+        # 计算加权分数
+        weighted_scores = self.calculate_weighted_score(similarity_scores)
+
+        # 获取推荐候选 - 每个推荐取4个候选，供分层筛选使用
+        top_indices = self._top_indices(weighted_scores, depth * 4)
+        return selected_game_ids, top_indices, similarity_scores[top_indices], weighted_scores[top_indices]
+
+    def _classic_similarity(self, row: int) -> np.ndarray:
+        """某个游戏与全部游戏的内容相似度：经典游戏使用预计算结果，其他游戏按需计算"""
+        position = self.classic_positions.get(row)
+        if position is not None:
+            return self.classic_similarity[position]
+        return self._content_similarity(self.feature_matrix_normalized[row:row + 1])[0]
+
+    def _score_candidates_approximate(self, preferences: Dict[str, Any],
+                                      depth: int) -> Tuple[List[int], np.ndarray, np.ndarray, np.ndarray]:
+        """_score_candidates 的近似版本：先检索候选，再只对候选精确打分
+
+        经典游戏融合是对相似度的线性组合，等价于先把偏好向量与经典游戏的特征向量
+        按同样的权重合成一个查询向量，因此只需检索和打分一次。
+        """
+        query = normalize(self.build_preference_vector(preferences).reshape(1, -1), norm='l2')[0]
+
+        selected_game_ids = []
+        selected_games = preferences.get('selectedGames', [])
+        if selected_games:
+            for idx in self.get_classic_games_by_selection(selected_games):
+                selected_game_ids.append(int(self.catalog.ids[idx]))
+                classic_vector = self.feature_matrix_normalized[idx].toarray()[0]
+                query = 0.7 * query + 0.3 * classic_vector
+
+        candidates = np.union1d(self.content_index.search(query, self.content_candidates), self.prior_candidates)
+        similarity_scores = self.feature_matrix_normalized[candidates] @ query
+        weighted_scores = self.calculate_weighted_score(similarity_scores, rows=candidates)
+
+        order = self._top_indices(weighted_scores, depth * 4)
+        return selected_game_ids, candidates[order], similarity_scores[order], weighted_scores[order]
+
+    def _select_recommendations(self, selected_game_ids: List[int], top_indices: np.ndarray,
+                                candidate_similarity: np.ndarray, candidate_weighted: np.ndarray,
+                                N: int) -> List[Dict[str, Any]]:
+        """融合协同过滤分数，从候选中分层筛选出 N 个推荐"""
+        # 获取协同过滤推荐（如果可用）
+        collaborative_recommendations = {}
+        if self.collaborative_recommender.is_loaded and selected_game_ids:
+            try:
+                cf_recs = self.collaborative_recommender.get_collaborative_recommendations(
+                    selected_game_ids, N=N*2
+                )
+                collaborative_recommendations = {rec['id']: rec for rec in cf_recs}
+                logger.info(f"获取到 {len(collaborative_recommendations)} 个协同过滤推荐")
+            except Exception as e:
+                logger.warning(f"协同过滤推荐失败: {e}")
+                collaborative_recommendations = {}
+
+        # 分两轮筛选（评分人数>=500优先，不足时放宽到>=100），用布尔掩码一次完成
+        recommendations = self._materialize_candidates(
+            top_indices, candidate_similarity, candidate_weighted, collaborative_recommendations, N
+        )
+
+        # 按融合分数重新排序
+        recommendations.sort(key=lambda x: x.get('final_score', x.get('weighted_score', 0)), reverse=True)
+
+        logger.info(f"生成了 {len(recommendations)} 个推荐结果")
+        return recommendations
+
+    def _summary_rows(self, rows: np.ndarray) -> List[Dict[str, Any]]:
+        """高分精选/新品推荐使用的精简游戏信息"""
+        catalog = self.catalog
+        years = self._int_values(catalog.column('Year Published')[rows])
+        users_rated = self._int_values(catalog.column('Users Rated')[rows])
+        ratings = catalog.column('Rating Average')[rows].astype(np.float64).tolist()
+        return [
+            {
+                'id': int(catalog.ids[row]),
+                'name': catalog.name(row),
+                'rating': rating,
+                'year': year,
+                'users_rated': users
+            }
+            for row, rating, year, users in zip(rows.tolist(), ratings, years, users_rated)
+        ]
 
+    def add_ratings(self, df_delta: pd.DataFrame, tolerance: float = 1e-3) -> Dict[str, int]:
+        """增量合并新评分到协同过滤模型，并清空推荐结果缓存"""
+        summary = self.collaborative_recommender.add_ratings(df_delta, tolerance=tolerance)
+        self.result_cache.clear()
+        return summary
+
+    def search_games(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """按名称搜索游戏（向导自动补全）"""
+        query = query.strip()
+        if not query:
+            return []
+        try:
+            return self._summary_rows(self.name_index.search(query, limit))
         except Exception as e:
-            logger.error(f"获取推荐时出错: {e}")
+            logger.error(f"搜索游戏时出错: {e}")
             return []
 
     def get_top_rated_games(self, N: int = 4) -> List[Dict[str, Any]]:
         """获取高评分游戏"""
         try:
             # 过滤条件：评分>=7.5，评分人数>=1000
-            high_rated = self.df[
-                (self.df['Rating Average'] >= 7.5) &
-                (self.df['Users Rated'] >= 1000)
-                ].copy()
+            ratings = self.catalog.column('Rating Average')
+            users_rated = self.catalog.column('Users Rated')
+            high_rated = np.flatnonzero((ratings >= 7.5) & (users_rated >= 1000))
 
             # 按评分排序
-            high_rated = high_rated.sort_values('Rating Average', ascending=False)
-
-            recommendations = []
-            for _, game in high_rated.head(N).iterrows():
-                rec = {
-                    'id': int(game.name),
-                    'name': str(game['Name']),
-                    'rating': float(game['Rating Average']),
-                    'year': int(game.get('Year Published', 0)) if pd.notna(game.get('Year Published')) else 0,
-                    'users_rated': int(game.get('Users Rated', 0)) if pd.notna(game.get('Users Rated')) else 0
-                }
-                recommendations.append(rec)
-
-            return recommendations
+            high_rated = high_rated[descending_order(ratings[high_rated])]
+            return self._summary_rows(high_rated[:N])
 
         except Exception as e:
             logger.error(f"获取高评分游戏时出错: {e}")
@@ -761,111 +2268,376 @@ class EnhancedRecommendationSystem:
         """获取最新游戏"""
         try:
             # 按年份排序，取最新的
-            newest = self.df[self.df['Year Published'] >= 2015].copy()
-            newest = newest.sort_values('Year Published', ascending=False)
-
-            recommendations = []
-            for _, game in newest.head(N).iterrows():
-                rec = {
-                    'id': int(game.name),
-                    'name': str(game['Name']),
-                    'rating': float(game.get('Rating Average', 0)),
-                    'year': int(game.get('Year Published', 0)) if pd.notna(game.get('Year Published')) else 0,
-                    'users_rated': int(game.get('Users Rated', 0)) if pd.notna(game.get('Users Rated')) else 0
-                }
-                recommendations.append(rec)
-
-            return recommendations
+            years = self.catalog.column('Year Published')
+            newest = np.flatnonzero(years >= 2015)
+            newest = newest[descending_order(years[newest])]
+            return self._summary_rows(newest[:N])
 
         except Exception as e:
             logger.error(f"获取最新游戏时出错: {e}")
             return []
 
 
+def build_snapshot(filepath: str, user_ratings_filepath: Optional[str] = None,
+                   snapshot_dir: str = DEFAULT_SNAPSHOT_DIR, cf_factor_rank: Optional[int] = None):
+    """从CSV源数据训练推荐系统并写入快照"""
+    recommender = EnhancedRecommendationSystem(cf_factor_rank=cf_factor_rank)
+    recommender.load_and_preprocess_data(filepath, user_ratings_filepath)
+    recommender.save_snapshot(snapshot_dir)
+    return recommender
+
+
+class ImageURLCache:
+    """持久化的游戏图片URL缓存（SQLite）
+
+    - 多个 worker 进程共享同一个数据库文件，重启后无需再次请求 BGG
+    - 条目数超过 max_size 时按最近访问时间淘汰（LRU）
+    - 获取失败的空结果只保留 negative_ttl 秒，之后会重新请求，避免临时故障被永久缓存
+    """
+
+    def __init__(self, path: str = ':memory:', max_size: int = 50000, negative_ttl: float = 600.0):
+        self.path = path
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        """每个进程使用自己的连接（gunicorn 预加载后 fork 出的 worker 不能复用主进程的连接）"""
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            if self.path != ':memory:':
+                conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS image_cache ('
+                         'game_id TEXT PRIMARY KEY, image_url TEXT, '
+                         'stored_at REAL NOT NULL, last_access REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_image_cache_last_access ON image_cache (last_access)')
+            conn.commit()
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    def get_many(self, game_ids: List[Any]) -> Dict[Any, Optional[str]]:
+        """返回有效缓存条目 {游戏ID: 图片URL 或 None(失败结果)}，未缓存或已过期的不包含在内"""
+        keys = {str(game_id): game_id for game_id in game_ids}
+        if not keys:
+            return {}
+        now = time.time()
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            rows = []
+            key_list = list(keys)
+            # SQLite 单条语句的参数个数有限，分批查询
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i:i + 500]
+                rows.extend(conn.execute(
+                    f"SELECT game_id, image_url, stored_at FROM image_cache "
+                    f"WHERE game_id IN ({','.join('?' * len(chunk))})", chunk).fetchall())
+
+            expired = []
+            for key, image_url, stored_at in rows:
+                if image_url is None and now - stored_at > self.negative_ttl:
+                    expired.append(key)
+                    continue
+                found[keys[key]] = image_url
+            if expired:
+                conn.executemany('DELETE FROM image_cache WHERE game_id = ?', [(key,) for key in expired])
+            if found:
+                conn.executemany('UPDATE image_cache SET last_access = ? WHERE game_id = ?',
+                                 [(now, str(game_id)) for game_id in found])
+            conn.commit()
+
+            self.expirations += len(expired)
+            self.hits += sum(1 for image_url in found.values() if image_url)
+            self.negative_hits += sum(1 for image_url in found.values() if not image_url)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def lookup(self, game_id: Any) -> Tuple[bool, Optional[str]]:
+        """单个查询，返回 (是否命中, 图片URL)"""
+        found = self.get_many([game_id])
+        return (game_id in found), found.get(game_id)
+
+    def set_many(self, entries: Dict[Any, Optional[str]]):
+        """写入一批结果（None 表示获取失败），超出容量时淘汰最久未访问的条目"""
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                'INSERT OR REPLACE INTO image_cache (game_id, image_url, stored_at, last_access) VALUES (?, ?, ?, ?)',
+                [(str(game_id), image_url, now, now) for game_id, image_url in entries.items()]
+            )
+            size = conn.execute('SELECT COUNT(*) FROM image_cache').fetchone()[0]
+            if size > self.max_size:
+                evicted = conn.execute(
+                    'DELETE FROM image_cache WHERE game_id IN '
+                    '(SELECT game_id FROM image_cache ORDER BY last_access LIMIT ?)',
+                    (size - self.max_size,)
+                ).rowcount
+                self.evictions += evicted
+            conn.commit()
+
+    def set(self, game_id: Any, image_url: Optional[str]):
+        self.set_many({game_id: image_url})
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            conn = self._connection()
+            size, positive = conn.execute(
+                'SELECT COUNT(*), COUNT(image_url) FROM image_cache').fetchone()
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'path': self.path,
+                'size': size,
+                'positive_entries': positive,
+                'max_size': self.max_size,
+                'negative_ttl': self.negative_ttl,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                'hit_rate': round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0
+            }
+
+
+class TokenBucket:
+    """线程安全的令牌桶限流器
+
+    acquire 先预订令牌（令牌数可以为负），再在锁外等待到令牌可用，
+    因此并发调用按到达顺序排队，任意时长 T 内放行的请求数不超过 capacity + rate × T。
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+_bgg_rate_limiter = None
+_bgg_rate_limiter_lock = threading.Lock()
+
+
+def get_bgg_rate_limiter() -> TokenBucket:
+    """进程内共享的 BGG API 限流器"""
+    global _bgg_rate_limiter
+    with _bgg_rate_limiter_lock:
+        if _bgg_rate_limiter is None:
+            _bgg_rate_limiter = TokenBucket(BGG_REQUESTS_PER_SECOND, BGG_REQUEST_BURST)
+        return _bgg_rate_limiter
+
+
 class BGGImageService:
     """BGG图片服务 - 优化版"""
 
-    def __init__(self):
-        self.base_url = "https://boardgamegeek.com/xmlapi2"
+    # 请求结果：成功、BGG 排队中(202)、失败
+    FETCH_OK = 'ok'
+    FETCH_QUEUED = 'queued'
+    FETCH_FAILED = 'failed'
+
+    # 重试前的等待时间（秒）：202 表示 BGG 仍在生成数据，需要等待更久
+    QUEUED_RETRY_DELAY = 2.0
+    FAILED_RETRY_DELAY = 1.0
+
+    def __init__(self, base_url: str = "https://boardgamegeek.com/xmlapi2",
+                 rate_limiter: Optional[TokenBucket] = None, max_workers: int = 4,
+                 batch_size: int = BGG_THING_BATCH_SIZE, cache_path: str = ':memory:',
+                 cache_max_size: int = 50000, negative_ttl: float = 600.0):
+        self.base_url = base_url
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'BoardGameRecommendationSystem/1.0'
         })
-        self.image_cache = {}  # 添加简单缓存
+        # 连接池大小与并发数一致，避免线程间争抢连接
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.rate_limiter = rate_limiter or get_bgg_rate_limiter()
+        self.max_workers = max_workers
+        self.batch_size = max(1, min(batch_size, BGG_THING_BATCH_SIZE))
+        # 持久化缓存，cache_path 为 ':memory:' 时只在进程内有效
+        self.image_cache = ImageURLCache(cache_path, max_size=cache_max_size, negative_ttl=negative_ttl)
+        # 正在获取中的游戏 -> Future，同一游戏的并发请求共享一次获取
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+
+    def _fetch_pool(self) -> ThreadPoolExecutor:
+        """每个进程一个长期存在的请求线程池（调用方持有 _inflight_lock；fork 后重建）"""
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='bgg-image')
+            self._pool_pid = os.getpid()
+            self._inflight = {}
+        return self._pool
+
+    def _fetch_image_urls(self, game_ids: List[int]) -> Tuple[str, Dict[str, str]]:
+        """用一次 thing 请求获取多个游戏的图片，返回 (请求结果, {游戏ID字符串: 图片URL})"""
+        ids = ','.join(str(game_id) for game_id in game_ids)
+        url = f"{self.base_url}/thing?id={ids}&type=boardgame"
+        try:
+            self.rate_limiter.acquire()
+            response = self.session.get(url, timeout=10)
+        except requests.RequestException as e:
+            logger.warning(f"请求游戏 {ids} 图片时出错: {e}")
+            return self.FETCH_FAILED, {}
+
+        # BGG API有时返回202，表示请求已排队，需要稍后重试
+        if response.status_code == 202:
+            logger.info(f"BGG API返回202，等待处理游戏 {ids}")
+            return self.FETCH_QUEUED, {}
+
+        if response.status_code == 200:
+            return self.FETCH_OK, self._parse_image_urls(response.content)
+
+        return self.FETCH_FAILED, {}
+
+    @staticmethod
+    def _parse_image_urls(content: bytes) -> Dict[str, str]:
+        """解析XML响应中所有 <item> 的图片URL"""
+        import xml.etree.ElementTree as ET
+        try:
+            root = ET.fromstring(content)
+        except ET.ParseError:
+            return {}
+
+        image_urls = {}
+        for item in root.iter('item'):
+            image = item.find('image')
+            if image is None or not image.text:
+                continue
+            image_url = image.text.strip()
+
+            # 验证URL格式
+            if image_url.startswith('http') and (
+                    'geekdo-images.com' in image_url or 'boardgamegeek.com' in image_url):
+                image_urls[item.get('id', '')] = image_url
+        return image_urls
 
     def get_game_image_url(self, game_id: int, retries: int = 3) -> Optional[str]:
         """获取游戏图片URL - 优化版"""
 
-        # 检查缓存
-        if game_id in self.image_cache:
-            return self.image_cache[game_id]
-
         try:
-            url = f"{self.base_url}/thing?id={game_id}&type=boardgame"
-
-            for attempt in range(retries):
-                try:
-                    response = self.session.get(url, timeout=10)
-
-                    if response.status_code == 200:
-                        # 解析XML响应获取图片URL
-                        import xml.etree.ElementTree as ET
-                        root = ET.fromstring(response.content)
-
-                        item = root.find('.//item')
-                        if item is not None:
-                            image = item.find('image')
-                            if image is not None and image.text:
-                                image_url = image.text.strip()
-
-                                # 验证URL格式
-                                if image_url.startswith('http') and (
-                                        'geekdo-images.com' in image_url or 'boardgamegeek.com' in image_url):
-                                    # 缓存结果
-                                    self.image_cache[game_id] = image_url
-                                    logger.info(f"成功获取游戏 {game_id} 的图片URL: {image_url}")
-                                    return image_url
-
-                    # BGG API有时返回202，需要等待
-                    if response.status_code == 202:
-                        logger.info(f"BGG API返回202，等待处理游戏 {game_id}")
-                        time.sleep(2)
-                        continue
-
-                except requests.RequestException as e:
-                    logger.warning(f"请求游戏 {game_id} 图片时出错 (尝试 {attempt + 1}): {e}")
-
-                # 如果失败，等待后重试
-                if attempt < retries - 1:
-                    time.sleep(1)
-
-            logger.warning(f"无法获取游戏 {game_id} 的图片URL")
-            # 缓存空结果避免重复请求
-            self.image_cache[game_id] = None
-            return None
+            return self.get_multiple_image_urls([game_id], retries=retries).get(game_id)
 
         except Exception as e:
             logger.error(f"获取BGG图片时出错: {e}")
             return None
 
-    def get_multiple_image_urls(self, game_ids: List[int], max_concurrent: int = 3) -> Dict[int, str]:
-        """批量获取游戏图片URL - 优化版"""
-        results = {}
-
-        # 分批处理，避免过于频繁的请求
-        for i in range(0, len(game_ids), max_concurrent):
-            batch = game_ids[i:i + max_concurrent]
-
-            for game_id in batch:
-                image_url = self.get_game_image_url(game_id)
-                if image_url:
-                    results[game_id] = image_url
-                time.sleep(0.5)  # 避免请求过于频繁
-
-            # 批次间等待
-            if i + max_concurrent < len(game_ids):
-                time.sleep(1)
+    def fetch_async(self, game_ids: List[Any], retries: int = 3) -> Dict[Any, Future]:
+        """异步获取一组游戏的图片，立即返回 {游戏ID: Future}，Future 的结果为图片URL或 None
+
+        已在获取中的游戏直接复用同一个 Future（请求合并），其余游戏交给一个后台协调线程，
+        调用方线程不会发起网络请求，也不会 sleep。
+        """
+        futures, new_ids = {}, []
+        with self._inflight_lock:
+            pool = self._fetch_pool()
+            for game_id in dict.fromkeys(game_ids):
+                future = self._inflight.get(str(game_id))
+                if future is None:
+                    future = Future()
+                    self._inflight[str(game_id)] = future
+                    new_ids.append(game_id)
+                futures[game_id] = future
+
+        if new_ids:
+            threading.Thread(target=self._resolve, args=(pool, new_ids, retries),
+                             name='bgg-image-resolve', daemon=True).start()
+        return futures
+
+    def _finish(self, results: Dict[Any, Optional[str]]):
+        """完成一批游戏的 Future，并移出正在获取的列表"""
+        with self._inflight_lock:
+            futures = [(self._inflight.pop(str(game_id), None), image_url) for game_id, image_url in results.items()]
+        for future, image_url in futures:
+            if future is not None and not future.done():
+                future.set_result(image_url)
+
+    def _resolve(self, pool: ThreadPoolExecutor, pending: List[Any], retries: int):
+        """后台协调线程：分组并发请求，202/失败的游戏统一放到下一轮重试
+
+        每组 batch_size 个游戏合并为一次 thing 请求（一页12个推荐只需1次请求），
+        请求速率由全进程共享的令牌桶控制，每个游戏最多请求 retries 次。
+        """
+        attempts = {game_id: 0 for game_id in pending}
+        try:
+            while pending:
+                batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+                futures = {pool.submit(self._fetch_image_urls, batch): batch for batch in batches}
+                retry, delay, fetched = [], 0.0, {}
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    try:
+                        status, image_urls = future.result()
+                    except Exception as e:
+                        logger.error(f"获取BGG图片时出错: {e}")
+                        status, image_urls = self.FETCH_FAILED, {}
+
+                    for game_id in batch:
+                        attempts[game_id] += 1
+                        image_url = image_urls.get(str(game_id))
+                        if image_url:
+                            fetched[game_id] = image_url
+                            logger.info(f"成功获取游戏 {game_id} 的图片URL: {image_url}")
+                        elif attempts[game_id] < retries:
+                            retry.append(game_id)
+                            delay = max(delay, self.QUEUED_RETRY_DELAY if status == self.FETCH_QUEUED
+                                        else self.FAILED_RETRY_DELAY)
+                        else:
+                            logger.warning(f"无法获取游戏 {game_id} 的图片URL")
+                            # 缓存空结果避免重复请求（在 negative_ttl 后过期）
+                            fetched[game_id] = None
+
+                # 先写入缓存再完成 Future，之后的请求可以直接命中缓存
+                self.image_cache.set_many(fetched)
+                self._finish(fetched)
+
+                if retry:
+                    time.sleep(delay)
+                # 保持原有请求顺序重新分组
+                retry_set = set(retry)
+                pending = [game_id for game_id in pending if game_id in retry_set]
 
+        except Exception as e:
+            logger.error(f"获取BGG图片时出错: {e}")
+            self._finish({game_id: None for game_id in pending})
+
+    def get_multiple_image_urls(self, game_ids: List[int], retries: int = 3) -> Dict[int, str]:
+        """批量获取游戏图片URL（阻塞等待结果，供预取线程和离线任务使用）"""
+        unique_ids = list(dict.fromkeys(game_ids))
+        # 检查缓存（包括未过期的失败结果）
+        known = self.image_cache.get_many(unique_ids)
+        pending = [game_id for game_id in unique_ids if game_id not in known]
+        for game_id, future in self.fetch_async(pending, retries).items():
+            known[game_id] = future.result()
+
+        # 按请求顺序返回有图片的游戏
+        results = {}
+        for game_id in game_ids:
+            image_url = known.get(game_id)
+            if image_url:
+                results[game_id] = image_url
         return results
 
     def preload_popular_games(self):
@@ -881,22 +2653,174 @@ class BGGImageService:
 
         logger.info("开始预加载热门游戏图片...")
         self.get_multiple_image_urls(popular_game_ids)
-        logger.info(f"预加载完成，缓存了 {len([v for v in self.image_cache.values() if v])} 个图片URL")
+        logger.info(f"预加载完成，缓存了 {self.image_cache.stats()['positive_entries']} 个图片URL")
+
+
+class ImagePrefetcher:
+    """后台图片预取队列
+
+    推荐结果和经典游戏列表中未缓存的游戏ID放入队列，由后台线程合并为批量请求解析并写入缓存，
+    请求处理线程只读缓存，不等待 BGG。后台线程在每个进程第一次入队时启动
+    （gunicorn 预加载后 fork 出的 worker 中不会继承主进程的线程）。
+    """
+
+    def __init__(self, image_service: 'BGGImageService', batch_size: int = BGG_THING_BATCH_SIZE,
+                 max_queue: int = 10000):
+        self.image_service = image_service
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pending = {}  # 游戏ID -> 入队时间
+        self._thread = None
+        self._pid = None
+        self.enqueued = 0
+        self.dropped = 0
+        self.completed = 0
+        self.resolved = 0
+        self.batches = 0
+        self._latencies = deque(maxlen=1000)  # 入队到解析完成（毫秒）
+        self._fetch_times = deque(maxlen=1000)  # 每批请求耗时（毫秒）
+
+    def _ensure_worker(self):
+        """在当前进程中启动后台线程（调用方持有锁）"""
+        if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.max_queue)
+                self._pending = {}
+                self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='image-prefetch', daemon=True)
+            self._thread.start()
+
+    def enqueue(self, game_ids: List[Any]) -> List[Any]:
+        """将未缓存且不在队列中的游戏ID加入预取队列，返回新入队的ID
+
+        检查和加入 _pending 都在与后台线程共用的锁内完成（fork 后的新进程也先重置再检查）。
+        """
+        added = []
+        with self._lock:
+            self._ensure_worker()
+            candidates = [game_id for game_id in dict.fromkeys(game_ids) if game_id not in self._pending]
+            if not candidates:
+                return []
+            known = self.image_service.image_cache.get_many(candidates)
+            now = time.monotonic()
+            for game_id in candidates:
+                if game_id in known:
+                    continue
+                try:
+                    self._queue.put_nowait(game_id)
+                except queue.Full:
+                    self.dropped += 1
+                    continue
+                self._pending[game_id] = now
+                added.append(game_id)
+            self.enqueued += len(added)
+        return added
+
+    def is_pending(self, game_id: Any) -> bool:
+        with self._lock:
+            return game_id in self._pending
+
+    def _run(self):
+        work = self._queue
+        while True:
+            # 阻塞等待第一个ID，再把队列中已有的ID凑成一批
+            batch = [work.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(work.get_nowait())
+                except queue.Empty:
+                    break
+
+            start = time.monotonic()
+            try:
+                images = self.image_service.get_multiple_image_urls(batch)
+            except Exception as e:
+                logger.error(f"后台预取图片时出错: {e}")
+                images = {}
+            finished = time.monotonic()
+
+            with self._lock:
+                self.batches += 1
+                self._fetch_times.append((finished - start) * 1000)
+                for game_id in batch:
+                    enqueued_at = self._pending.pop(game_id, None)
+                    if enqueued_at is not None:
+                        self._latencies.append((finished - enqueued_at) * 1000)
+                    self.completed += 1
+                    if game_id in images:
+                        self.resolved += 1
+
+    @staticmethod
+    def _percentiles(values) -> Dict[str, float]:
+        if not values:
+            return {'p50': 0.0, 'p95': 0.0}
+        values = np.fromiter(values, dtype=np.float64)
+        return {'p50': round(float(np.percentile(values, 50)), 2),
+                'p95': round(float(np.percentile(values, 95)), 2)}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+                'pending': len(self._pending),
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'completed': self.completed,
+                'resolved': self.resolved,
+                'batches': self.batches,
+                'latency_ms': self._percentiles(self._latencies),
+                'fetch_ms': self._percentiles(self._fetch_times),
+                'worker_alive': bool(self._thread and self._thread.is_alive() and self._pid == os.getpid())
+            }
 
 
 # 示例使用
 # 在enhanced_recommendation.py的 if __name__ == "__main__": 部分修改为：
 
 if __name__ == "__main__":
+    import argparse
+
     # 设置日志
     logging.basicConfig(level=logging.INFO)
 
+    # 命令行入口: python enhanced_recommendation.py build-snapshot --data ... --ratings ...
+    if len(sys.argv) > 1 and sys.argv[1] == 'build-snapshot':
+        parser = argparse.ArgumentParser(prog='enhanced_recommendation.py build-snapshot',
+                                         description='构建推荐模型快照')
+        data_path = find_data_file()
+        parser.add_argument('--data', default=data_path, required=data_path is None,
+                            help=f"BGG游戏数据CSV（默认依次查找 {', '.join(DATA_PATHS)}）")
+        parser.add_argument('--ratings', default=None, help='用户评分数据CSV（可选）')
+        parser.add_argument('--output', default=DEFAULT_SNAPSHOT_DIR, help='快照输出目录')
+        parser.add_argument('--factor-rank', type=int, default=None, help='协同过滤隐因子的秩（默认不降维）')
+        args = parser.parse_args(sys.argv[2:])
+        build_snapshot(args.data, args.ratings, args.output, args.factor_rank)
+        sys.exit(0)
+
+    # 命令行入口: python enhanced_recommendation.py ratings-cache --ratings ... --output ... [--append 增量CSV]
+    if len(sys.argv) > 1 and sys.argv[1] == 'ratings-cache':
+        parser = argparse.ArgumentParser(prog='enhanced_recommendation.py ratings-cache',
+                                         description='构建或追加评分列式缓存')
+        parser.add_argument('--ratings', default='data/user_ratings.csv', help='完整的用户评分CSV')
+        parser.add_argument('--output', default='data/user_ratings.npz', help='缓存文件')
+        parser.add_argument('--append', default=None, help='合并到已有缓存的增量评分CSV')
+        parser.add_argument('--workers', type=int, default=None, help='解析进程数')
+        args = parser.parse_args(sys.argv[2:])
+        if args.append:
+            append_ratings_cache(args.output, args.append, workers=args.workers)
+        else:
+            save_ratings_cache(args.output, *read_ratings_csv(args.ratings, workers=args.workers),
+                               sources={'source': file_checksum(args.ratings)})
+        sys.exit(0)
+
     # 创建推荐系统实例
     recommender = EnhancedRecommendationSystem()
 
     try:
         # 加载数据
-        recommender.load_and_preprocess_data('data/BGG_Data_Set.csv')
+        recommender.load_and_preprocess_data(find_data_file() or DATA_PATHS[0])
 
         # 创建图片服务并预加载热门游戏
         image_service = BGGImageService()
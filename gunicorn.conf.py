@@ -0,0 +1,39 @@
+# gunicorn.conf.py - 生产环境 Gunicorn 配置
+# 启动: gunicorn -c gunicorn.conf.py app:app
+import gc
+import os
+
+from enhanced_recommendation import process_memory
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+timeout = 120
+
+# 在主进程中加载推荐模型后再 fork：特征矩阵、评分矩阵、近邻索引等只读数组
+# 由所有 worker 通过写时复制共享（使用模型快照时这些数组本身就是只读内存映射）。
+# 设置 GUNICORN_PRELOAD=0 可恢复每个 worker 各自加载，用于对比内存占用。
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+
+def when_ready(server):
+    """worker 启动前调用：冻结已加载对象，避免子进程的垃圾回收改写这些页面"""
+    if preload_app:
+        gc.freeze()
+    server.log.info(f"主进程内存: {process_memory()}")
+
+
+def post_fork(server, worker):
+    """fork 之后丢弃从主进程继承的数据库连接池，每个 worker 打开自己的 SQLite 连接
+
+    预加载时主进程导入 app.py 会执行 init_db()，连接池中留下一个已签入的连接；
+    SQLite 连接不能跨 fork 使用。close=False 只丢弃池中的引用，不在子进程中关闭主进程的连接。
+    """
+    if preload_app:
+        from app import app, db
+        with app.app_context():
+            db.engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    """记录每个 worker 初始化后的内存占用"""
+    worker.log.info(f"worker {worker.pid} 内存: {process_memory()}")
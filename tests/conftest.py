@@ -0,0 +1,76 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from enhanced_recommendation import BGGImageService, TokenBucket  # noqa: E402
+
+
+def image_url(game_id) -> str:
+    return f'https://cf.geekdo-images.com/stub/{game_id}.jpg'
+
+
+class _StubBGGHandler(BaseHTTPRequestHandler):
+    """模拟 BGG XML API 的 thing 接口：记录每次请求的时间和ID，响应由 server.respond 决定"""
+
+    def do_GET(self):
+        server = self.server
+        game_ids = parse_qs(urlparse(self.path).query).get('id', [''])[0].split(',')
+        with server.lock:
+            server.requests.append((time.monotonic(), game_ids))
+            for game_id in game_ids:
+                server.hits[game_id] = server.hits.get(game_id, 0) + 1
+            status, image_ids = server.respond(game_ids, dict(server.hits))
+
+        if status != 200:
+            self.send_response(status)
+            self.end_headers()
+            return
+        items = ''.join(f'<item id="{game_id}"><image>{image_url(game_id)}</image></item>'
+                        for game_id in image_ids)
+        body = f'<items>{items}</items>'.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def bgg_server():
+    """本地临时端口上的 BGG 模拟服务，默认对所有ID返回200和图片
+
+    测试可替换 server.respond(请求的ID列表, {ID: 累计请求次数}) -> (状态码, 返回图片的ID列表)
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubBGGHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.hits = {}
+    server.respond = lambda game_ids, hits: (200, game_ids)
+    server.base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_service(bgg_server):
+    """创建指向模拟服务的 BGGImageService，默认不限流、重试不等待"""
+    def make(rate: float = 1000.0, burst: float = 1000.0, **kwargs):
+        service = BGGImageService(base_url=bgg_server.base_url, rate_limiter=TokenBucket(rate, burst), **kwargs)
+        service.QUEUED_RETRY_DELAY = 0.05
+        service.FAILED_RETRY_DELAY = 0.05
+        return service
+    return make
@@ -0,0 +1,112 @@
+import threading
+import time
+
+from enhanced_recommendation import ImagePrefetcher
+
+from conftest import image_url
+
+
+def _max_requests_in_window(request_times, window: float) -> int:
+    """任意长度为 window 秒的时间窗口内的最大请求数"""
+    times = sorted(request_times)
+    best, start = 0, 0
+    for end, t in enumerate(times):
+        while t - times[start] >= window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+def test_rate_limit_never_exceeds_burst_plus_rate(bgg_server, make_service):
+    rate, burst = 10.0, 4
+    service = make_service(rate=rate, burst=burst, batch_size=1)
+    game_ids = list(range(1, 31))
+
+    results = service.get_multiple_image_urls(game_ids)
+
+    assert results == {game_id: image_url(game_id) for game_id in game_ids}
+    times = [t for t, _ in bgg_server.requests]
+    assert len(times) == len(game_ids)
+    assert _max_requests_in_window(times, 1.0) <= burst + rate
+
+
+def test_results_follow_request_order(bgg_server, make_service):
+    # 部分游戏第一次返回202，重试后才有结果；部分游戏没有图片
+    def respond(game_ids, hits):
+        if any(hits[game_id] == 1 and int(game_id) % 3 == 0 for game_id in game_ids):
+            return 202, []
+        return 200, [game_id for game_id in game_ids if int(game_id) % 5 != 0]
+
+    bgg_server.respond = respond
+    service = make_service(batch_size=2)
+    game_ids = [14, 3, 27, 5, 8, 3, 21, 1, 10, 6]
+
+    results = service.get_multiple_image_urls(game_ids)
+
+    expected = [game_id for game_id in dict.fromkeys(game_ids) if game_id % 5 != 0]
+    assert list(results) == expected
+    assert all(results[game_id] == image_url(game_id) for game_id in expected)
+
+
+def test_each_game_is_requested_at_most_retries_times(bgg_server, make_service):
+    # 1 始终排队，2 始终失败，3 始终没有图片，4 第二次才成功
+    def respond(game_ids, hits):
+        if '1' in game_ids:
+            return 202, []
+        if '2' in game_ids:
+            return 500, []
+        return 200, [game_id for game_id in game_ids if game_id == '4' and hits[game_id] >= 2]
+
+    bgg_server.respond = respond
+    service = make_service(batch_size=1)
+
+    results = service.get_multiple_image_urls([1, 2, 3, 4], retries=3)
+
+    assert results == {4: image_url(4)}
+    assert bgg_server.hits == {'1': 3, '2': 3, '3': 3, '4': 2}
+
+
+def test_negative_results_are_cached_until_ttl(bgg_server, make_service):
+    bgg_server.respond = lambda game_ids, hits: (500, [])
+    service = make_service(negative_ttl=0.5)
+
+    assert service.get_game_image_url(7, retries=2) is None
+    assert bgg_server.hits == {'7': 2}
+    assert service.image_cache.lookup(7) == (True, None)
+
+    # 失败结果在 negative_ttl 内直接命中缓存，不再请求 BGG
+    assert service.get_game_image_url(7, retries=2) is None
+    assert bgg_server.hits == {'7': 2}
+    assert service.image_cache.stats()['negative_hits'] >= 1
+
+    # 过期后重新请求，成功结果覆盖失败结果
+    bgg_server.respond = lambda game_ids, hits: (200, game_ids)
+    time.sleep(0.6)
+    assert service.get_game_image_url(7) == image_url(7)
+    assert bgg_server.hits == {'7': 3}
+    assert service.image_cache.lookup(7) == (True, image_url(7))
+
+
+def test_concurrent_enqueue_adds_each_game_once(bgg_server, make_service):
+    bgg_server.respond = lambda game_ids, hits: (time.sleep(0.2), (200, game_ids))[1]
+    prefetcher = ImagePrefetcher(make_service())
+    game_ids = list(range(1, 41))
+    added, barrier = [], threading.Barrier(8)
+
+    def enqueue(offset):
+        barrier.wait()
+        added.extend(prefetcher.enqueue(game_ids[offset:] + game_ids[:offset]))
+
+    threads = [threading.Thread(target=enqueue, args=(i * 5,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(added) == game_ids
+    deadline = time.monotonic() + 10
+    while prefetcher.stats()['completed'] < len(game_ids) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert prefetcher.stats()['resolved'] == len(game_ids)
+    assert all(hits == 1 for hits in bgg_server.hits.values())
+    assert prefetcher.enqueue(game_ids) == []
@@ -0,0 +1,70 @@
+from enhanced_recommendation import BGG_THING_BATCH_SIZE, BGGImageService
+
+from conftest import image_url
+
+
+def test_queued_batch_is_retried_as_a_whole(bgg_server, make_service):
+    bgg_server.respond = lambda game_ids, hits: (202, []) if hits[game_ids[0]] == 1 else (200, game_ids)
+    service = make_service()
+    game_ids = [11, 12, 13]
+
+    assert service._fetch_image_urls(game_ids) == (BGGImageService.FETCH_QUEUED, {})
+
+    bgg_server.requests.clear()
+    bgg_server.hits.clear()
+    results = service.get_multiple_image_urls(game_ids)
+
+    assert results == {game_id: image_url(game_id) for game_id in game_ids}
+    assert [ids for _, ids in bgg_server.requests] == [['11', '12', '13'], ['11', '12', '13']]
+
+
+def test_partial_response_regroups_missing_games(bgg_server, make_service):
+    # 第一次请求只返回偶数ID的图片，缺失的游戏合并到下一轮请求
+    bgg_server.respond = lambda game_ids, hits: (
+        200, [game_id for game_id in game_ids if int(game_id) % 2 == 0 or hits[game_id] > 1])
+    service = make_service(batch_size=4)
+    game_ids = [1, 2, 3, 4, 5, 6, 7, 8]
+
+    status, image_urls = service._fetch_image_urls([1, 2, 3])
+    assert status == BGGImageService.FETCH_OK
+    assert image_urls == {'2': image_url(2)}
+
+    bgg_server.requests.clear()
+    bgg_server.hits.clear()
+    results = service.get_multiple_image_urls(game_ids)
+
+    assert results == {game_id: image_url(game_id) for game_id in game_ids}
+    requests = [ids for _, ids in bgg_server.requests]
+    assert sorted(requests[:2]) == [['1', '2', '3', '4'], ['5', '6', '7', '8']]
+    assert requests[2:] == [['1', '3', '5', '7']]
+
+
+def test_batches_are_capped_at_thing_api_limit(bgg_server, make_service):
+    # batch_size 超过 BGG 的上限时按上限分组
+    service = make_service(batch_size=50)
+    assert service.batch_size == BGG_THING_BATCH_SIZE
+
+    game_ids = list(range(100, 100 + BGG_THING_BATCH_SIZE))
+    assert service.get_multiple_image_urls(game_ids) == {game_id: image_url(game_id) for game_id in game_ids}
+    assert [len(ids) for _, ids in bgg_server.requests] == [BGG_THING_BATCH_SIZE]
+
+    bgg_server.requests.clear()
+    game_ids = list(range(200, 201 + BGG_THING_BATCH_SIZE))
+    assert len(service.get_multiple_image_urls(game_ids)) == len(game_ids)
+    assert sorted(len(ids) for _, ids in bgg_server.requests) == [1, BGG_THING_BATCH_SIZE]
+
+
+def test_parse_image_urls_keeps_only_bgg_images():
+    content = (b'<items>'
+               b'<item id="1"><image> https://cf.geekdo-images.com/a.jpg </image></item>'
+               b'<item id="2"><image>https://example.com/b.jpg</image></item>'
+               b'<item id="3"><image></image></item>'
+               b'<item id="4"><thumbnail>https://cf.geekdo-images.com/t.jpg</thumbnail></item>'
+               b'<item id="5"><image>https://boardgamegeek.com/image/5.png</image></item>'
+               b'</items>')
+
+    assert BGGImageService._parse_image_urls(content) == {
+        '1': 'https://cf.geekdo-images.com/a.jpg',
+        '5': 'https://boardgamegeek.com/image/5.png'
+    }
+    assert BGGImageService._parse_image_urls(b'<items><item') == {}